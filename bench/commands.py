@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Run kdtool commands end to end against the fake API server in fakeapi.py,
+# for a range of namespace sizes, and report wall time, API request count,
+# response bytes and peak RSS for each.
+#
+#   python3 bench/commands.py [--sizes=10,1000,50000] [--latency=0.005]
+#
+# deploy is run with a stub kubectl that discards the manifest, so it measures
+# only kdtool's own work.  status-cached uses --object-cache; its first run
+# fills the cache, so the best time is that of a run that only fetched deltas.
+
+import argparse, json, os, shutil, subprocess, sys, tempfile, time
+
+import fakeapi
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The commands to benchmark.  Each runs against the first application in the
+# fake namespace, "app0".
+COMMANDS = (
+    ('status',      [ 'status', 'app0' ]),
+    ('status-cached',[ '--object-cache', 'status', 'app0' ]),
+    ('top',         [ 'top', 'app0' ]),
+    ('deploy',      [ 'deploy', '--json', '-r3', '-H', 'app0.example.com',
+                      '-v', 'media:/app/media', '-s', 'SECRET_KEY=x',
+                      'registry.example.com/app0:latest', 'app0' ]),
+    ('deploy-apply',[ 'deploy', '-r3', '-H', 'app0.example.com', '-D', 'postgresql',
+                      'registry.example.com/app0:latest', 'app0' ]),
+    ('undeploy',    [ 'undeploy', '-f', '-A', '-w', 'app0' ]),
+    ('gc',          [ 'gc', '-f', '--match', '^app[0-9]$' ]),
+)
+
+KUBECONFIG = """\
+apiVersion: v1
+kind: Config
+clusters:
+- name: fake
+  cluster:
+    server: {url}
+users:
+- name: fake
+  user:
+    token: benchmark
+contexts:
+- name: fake
+  context:
+    cluster: fake
+    user: fake
+    namespace: default
+current-context: fake
+"""
+
+# setup: create a temporary home directory with a kubeconfig for the server and
+# a stub kubectl.  returns the directory and the environment to run kdtool in.
+def setup(server):
+    home = tempfile.mkdtemp(prefix='kdtool-bench-')
+
+    kubeconfig = os.path.join(home, 'kubeconfig')
+    with open(kubeconfig, 'w') as f:
+        f.write(KUBECONFIG.format(url=server.url))
+
+    kubectl = os.path.join(home, 'kubectl')
+    with open(kubectl, 'w') as f:
+        f.write('#! /bin/sh\ncat >/dev/null\nexit 0\n')
+    os.chmod(kubectl, 0o755)
+
+    env = dict(os.environ)
+    env.update({
+        'HOME': home,
+        'XDG_CACHE_HOME': os.path.join(home, 'cache'),
+        'KUBECONFIG': kubeconfig,
+        'PATH': home + os.pathsep + env.get('PATH', ''),
+    })
+    env.pop('KDTOOL_SOCKET', None)
+
+    return (home, env)
+
+# run: run kdtool once.  returns (exit status, wall time, peak RSS in KiB,
+# stderr output).
+def run(kdtool, cmdargs, env):
+    kargs = [ sys.executable, kdtool ] + cmdargs
+
+    with tempfile.TemporaryFile() as errf:
+        start = time.monotonic()
+        p = subprocess.Popen(kargs, env=env,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errf)
+        # Use wait4() rather than Popen.wait() to get the child's own rusage.
+        (pid, status, rusage) = os.wait4(p.pid, 0)
+        elapsed = time.monotonic() - start
+        p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+        errf.seek(0)
+        errors = errf.read().decode('utf-8', 'replace')
+
+    return (p.returncode, elapsed, rusage.ru_maxrss, errors)
+
+def main():
+    parser = argparse.ArgumentParser(description='kdtool command benchmarks')
+    parser.add_argument('--kdtool', type=str,
+        default=os.path.join(HERE, '..', '__main__.py'),
+        help='kdtool script or zipapp to run')
+    parser.add_argument('--sizes', type=str, default='10,100,1000,10000,50000',
+        help='comma-separated list of namespace sizes, in pods')
+    parser.add_argument('--latency', type=float, default=0,
+        help='latency to add to every API request, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='proportion of API requests to reject with 429')
+    parser.add_argument('--runs', type=int, default=3,
+        help='number of runs per command; the best time is reported')
+    parser.add_argument('--commands', type=str,
+        default=','.join([ name for (name, cmdargs) in COMMANDS ]),
+        help='comma-separated list of commands to run')
+    parser.add_argument('--json', type=str, metavar='FILE',
+        help='also write results to FILE as JSON')
+    args = parser.parse_args()
+
+    sizes = [ int(s) for s in args.sizes.split(',') ]
+    wanted = args.commands.split(',')
+    results = []
+    failed = False
+
+    sys.stdout.write('{0:<14} {1:>7} {2:>9} {3:>6} {4:>12} {5:>10}\n'.format(
+        'command', 'pods', 'wall', 'reqs', 'bytes', 'rss'))
+
+    for size in sizes:
+        server = fakeapi.start(pods=size, latency=args.latency,
+                               error_rate=args.error_rate)
+        (home, env) = setup(server)
+
+        try:
+            for (name, cmdargs) in COMMANDS:
+                if name not in wanted:
+                    continue
+
+                best = None
+                for i in range(args.runs):
+                    server.cluster.reset()
+                    server.reset_stats()
+                    (status, elapsed, rss, errors) = run(args.kdtool, cmdargs, env)
+                    if status != 0:
+                        sys.stderr.write('{0} failed with status {1}:\n{2}'.format(
+                            name, status, errors))
+                        failed = True
+                        break
+
+                    result = {
+                        'command': name,
+                        'pods': size,
+                        'wall': elapsed,
+                        'requests': server.requests,
+                        'bytes': server.bytes,
+                        'rss': rss,
+                    }
+                    if best is None or elapsed < best['wall']:
+                        best = result
+
+                if best is None:
+                    continue
+
+                results.append(best)
+                sys.stdout.write('{command:<14} {pods:>7} {wall:>8.3f}s {requests:>6} {bytes:>12} {rss:>7} KiB\n'.format(**best))
+                sys.stdout.flush()
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(home, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
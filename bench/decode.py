@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Compare decoding list responses from JSON, as deployment.py did with
+# json.loads(resp.data.decode(...)), against parsing it incrementally with
+# jsonstream as it arrives, and against decoding the protobuf form into the
+# kubeproto views.  Reports body size, best decode time and peak memory
+# allocated while decoding, for pod and replicaset lists of each size.
+#
+#   python3 bench/decode.py [--sizes=100,1000,10000]
+
+import argparse, json, os, sys, time, tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import fakeapi, jsonstream, kubeproto
+
+# The lists to decode, as (resource type, view).
+LISTS = (
+    ('pods',        kubeproto.POD_LIST),
+    ('replicasets', kubeproto.REPLICASET_LIST),
+)
+
+# measure: decode data with func.  returns (best time, peak memory in bytes).
+def measure(func, data, runs):
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        func(data)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    func(data)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (best, peak)
+
+def decode_json(data):
+    return json.loads(data.decode('utf-8'))
+
+# decode_stream: parse the body in chunks of the size deployment.get_json
+# reads.
+def decode_stream(data):
+    chunk = 65536
+    return jsonstream.load(data[i:i + chunk] for i in range(0, len(data), chunk))
+
+def main():
+    parser = argparse.ArgumentParser(description='kdtool list decoding benchmark')
+    parser.add_argument('--sizes', type=str, default='100,1000,10000',
+        help='comma-separated list of namespace sizes, in pods')
+    parser.add_argument('--runs', type=int, default=3,
+        help='number of runs per decoder; the best time is reported')
+    parser.add_argument('--json', type=str, metavar='FILE',
+        help='also write results to FILE as JSON')
+    args = parser.parse_args()
+
+    results = []
+    sys.stdout.write('{0:<12} {1:>7} {2:<9} {3:>11} {4:>9} {5:>11}\n'.format(
+        'list', 'pods', 'format', 'bytes', 'decode', 'peak mem'))
+
+    for size in [ int(s) for s in args.sizes.split(',') ]:
+        cluster = fakeapi.Cluster(pods=size)
+
+        for (res, view) in LISTS:
+            decoders = (
+                ('json',     cluster.list(res, '', 'List'),     decode_json),
+                ('stream',   cluster.list(res, '', 'List'),     decode_stream),
+                ('protobuf', cluster.list(res, '', 'Protobuf'),
+                    lambda data: kubeproto.decode(data, view)),
+            )
+
+            for (fmt, data, func) in decoders:
+                (elapsed, peak) = measure(func, data, args.runs)
+                result = {
+                    'list': res,
+                    'pods': size,
+                    'format': fmt,
+                    'bytes': len(data),
+                    'decode': elapsed,
+                    'peak': peak,
+                }
+                results.append(result)
+                sys.stdout.write('{list:<12} {pods:>7} {format:<9} {bytes:>11} {decode:>8.3f}s {peak:>11}\n'.format(**result))
+                sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
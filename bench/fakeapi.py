@@ -0,0 +1,1076 @@
+#! /usr/bin/env python3
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# A small stand-in for the Kubernetes API server, for benchmarks.  It serves a
+# namespace of synthetic applications created by kdtool: Deployments,
+# ReplicaSets, Pods, Services, Ingresses, PVCs, Secrets and torchbox.com/v1
+# Databases, and supports the requests kdtool makes (GET, list with
+# labelSelector, as Table or PartialObjectMetadataList, protobuf for built-in
+# types, watch from a resourceVersion, DELETE, and POST and merge PATCH; a
+# created DaemonSet gets a pod on each of NODES nodes), and metrics.k8s.io
+# usage for pods.  Like the API server, it
+# gzips large responses for clients that accept it.  It counts requests and
+# response bytes as sent, and can add a fixed latency to every request and fail a proportion of requests with
+# 429 Too Many Requests.
+#
+# Run it on its own with:
+#
+#   python3 bench/fakeapi.py --pods=1000 --port=8001
+#
+# and point kdtool at it with -S http://127.0.0.1:8001.
+
+import argparse, calendar, gzip, json, random, re, select, socket, sys, threading, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# Every synthetic application has this many replicas in its current
+# ReplicaSet.  It also has one scaled-down old ReplicaSet.
+REPLICAS = 3
+
+# Nodes in the cluster.  A DaemonSet gets a pod on each.
+NODES = 3
+
+TIMESTAMP = '2017-10-01T12:00:00Z'
+
+# The stand-in metrics API reports new usage for each pod this often, in
+# seconds.  metrics-server's default is a minute.
+METRICS_RESOLUTION = 5
+
+# The label kdtool's deploy puts on every object it creates.
+APP_LABEL = 'kdtool.torchbox.com/app'
+
+# The API server only compresses responses at least this large, and uses the
+# fastest gzip level.
+GZIP_MIN_SIZE = 128 * 1024
+GZIP_LEVEL = 1
+
+# encode_json: encode a response body compactly, as the API server does.
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+# make_pod_template: a pod spec of a realistic size for an application.
+def make_pod_template(name):
+    return {
+        'metadata': {
+            'labels': { 'app': name },
+        },
+        'spec': {
+            'containers': [{
+                'name': 'app',
+                'image': 'registry.example.com/{0}:0123456789abcdef'.format(name),
+                'imagePullPolicy': 'IfNotPresent',
+                'ports': [{ 'name': 'http', 'containerPort': 80, 'protocol': 'TCP' }],
+                'env': [ { 'name': 'SETTING_{0}'.format(i), 'value': 'x' * 40 }
+                            for i in range(20) ],
+                'envFrom': [{ 'secretRef': { 'name': name } }],
+                'resources': {
+                    'limits': { 'memory': '268435456' },
+                    'requests': { 'memory': '134217728', 'cpu': '100m' },
+                },
+                'volumeMounts': [{ 'name': 'media', 'mountPath': '/app/media' }],
+                'terminationMessagePath': '/dev/termination-log',
+            }],
+            'volumes': [{
+                'name': 'media',
+                'persistentVolumeClaim': { 'claimName': name + '-media' },
+            }],
+            'restartPolicy': 'Always',
+            'dnsPolicy': 'ClusterFirst',
+        },
+    }
+
+# metadata: object metadata common to everything we generate.
+def metadata(namespace, name, uid, labels=None, owner=None, annotations=None):
+    md = {
+        'name': name,
+        'namespace': namespace,
+        'uid': uid,
+        'resourceVersion': '1',
+        'creationTimestamp': TIMESTAMP,
+        'labels': labels or {},
+        'annotations': annotations or {},
+    }
+
+    if owner is not None:
+        md['ownerReferences'] = [{
+            'apiVersion': 'extensions/v1beta1',
+            'kind': owner[0],
+            'name': owner[1],
+            'uid': owner[2],
+            'controller': True,
+        }]
+
+    return md
+
+# make_app: generate all the objects for one application.  returns a dict
+# mapping resource type to a list of objects.
+def make_app(namespace, name):
+    objs = {}
+    template = make_pod_template(name)
+    labels = { 'app': name }
+    # deploy labels every object it creates, but not the pod template.
+    app_labels = dict(labels, **{ APP_LABEL: name })
+
+    dp_uid = 'dp-' + name
+    objs['deployments'] = [{
+        'apiVersion': 'extensions/v1beta1',
+        'kind': 'Deployment',
+        'metadata': metadata(namespace, name, dp_uid, app_labels, annotations={
+            'deployment.kubernetes.io/revision': '2',
+        }),
+        'spec': {
+            'replicas': REPLICAS,
+            'selector': { 'matchLabels': labels },
+            'template': template,
+        },
+        'status': {
+            'observedGeneration': 1,
+            'replicas': REPLICAS,
+            'updatedReplicas': REPLICAS,
+            'readyReplicas': REPLICAS,
+            'availableReplicas': REPLICAS,
+        },
+    }]
+
+    objs['replicasets'] = []
+    objs['pods'] = []
+    for (rev, replicas) in ((1, 0), (2, REPLICAS)):
+        rs_hash = '{0:08x}'.format(rev)
+        rs_name = '{0}-{1}'.format(name, rs_hash)
+        rs_uid = 'rs-' + rs_name
+        rs_labels = dict(labels, **{ 'pod-template-hash': rs_hash })
+        objs['replicasets'].append({
+            'apiVersion': 'extensions/v1beta1',
+            'kind': 'ReplicaSet',
+            'metadata': metadata(namespace, rs_name, rs_uid, rs_labels,
+                owner=('Deployment', name, dp_uid),
+                annotations={ 'deployment.kubernetes.io/revision': str(rev) }),
+            'spec': {
+                'replicas': replicas,
+                'selector': { 'matchLabels': rs_labels },
+                'template': template,
+            },
+            'status': {
+                'replicas': replicas,
+                'readyReplicas': replicas,
+            },
+        })
+
+        for i in range(replicas):
+            pod_name = '{0}-{1:05x}'.format(rs_name, i)
+            pod = {
+                'apiVersion': 'v1',
+                'kind': 'Pod',
+                'metadata': metadata(namespace, pod_name, 'pod-' + pod_name,
+                    rs_labels, owner=('ReplicaSet', rs_name, rs_uid)),
+                'spec': dict(template['spec'], nodeName='node-{0}'.format(i)),
+                'status': {
+                    'phase': 'Running',
+                    'conditions': [
+                        { 'type': t, 'status': 'True', 'lastTransitionTime': TIMESTAMP }
+                            for t in ('PodScheduled', 'Initialized', 'Ready')
+                    ],
+                    'containerStatuses': [{
+                        'name': 'app',
+                        'ready': True,
+                        'restartCount': 0,
+                        'image': template['spec']['containers'][0]['image'],
+                        'state': { 'running': { 'startedAt': TIMESTAMP } },
+                    }],
+                },
+            }
+            objs['pods'].append(pod)
+
+    objs['services'] = [{
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': metadata(namespace, name, 'svc-' + name, app_labels),
+        'spec': {
+            'ports': [{ 'name': 'http', 'port': 80, 'protocol': 'TCP', 'targetPort': 'http' }],
+            'selector': labels,
+            'type': 'ClusterIP',
+        },
+    }]
+
+    objs['ingresses'] = [{
+        'apiVersion': 'extensions/v1beta1',
+        'kind': 'Ingress',
+        'metadata': metadata(namespace, name, 'ing-' + name, app_labels),
+        'spec': {
+            'rules': [{
+                'host': name + '.example.com',
+                'http': { 'paths': [{ 'backend': { 'serviceName': name, 'servicePort': 80 } }] },
+            }],
+        },
+    }]
+
+    objs['persistentvolumeclaims'] = [{
+        'apiVersion': 'v1',
+        'kind': 'PersistentVolumeClaim',
+        'metadata': metadata(namespace, name + '-media', 'pvc-' + name, app_labels),
+        'spec': {
+            'accessModes': [ 'ReadWriteMany' ],
+            'resources': { 'requests': { 'storage': '1Gi' } },
+        },
+        'status': {
+            'phase': 'Bound',
+            'accessModes': [ 'ReadWriteMany' ],
+            'capacity': { 'storage': '1Gi' },
+        },
+    }]
+
+    objs['secrets'] = [{
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': metadata(namespace, name, 'secret-' + name, app_labels),
+        'type': 'Opaque',
+        'data': { 'SECRET_KEY': 'c2VjcmV0' },
+    }]
+
+    objs['databases'] = [{
+        'apiVersion': 'torchbox.com/v1',
+        'kind': 'Database',
+        'metadata': metadata(namespace, name, 'db-' + name, app_labels),
+        'spec': { 'class': 'default', 'secretName': name + '-database', 'type': 'postgresql' },
+        'status': { 'phase': 'Provisioned', 'server': 'db1' },
+    }]
+
+    return objs
+
+# API paths for each resource type.
+PATHS = {
+    'deployments':              '/apis/extensions/v1beta1',
+    'replicasets':              '/apis/extensions/v1beta1',
+    'ingresses':                '/apis/extensions/v1beta1',
+    'daemonsets':               '/apis/extensions/v1beta1',
+    'horizontalpodautoscalers': '/apis/autoscaling/v1',
+    'poddisruptionbudgets':     '/apis/policy/v1beta1',
+    'pods':                     '/api/v1',
+    'services':                 '/api/v1',
+    'persistentvolumeclaims':   '/api/v1',
+    'secrets':                  '/api/v1',
+    'databases':                '/apis/torchbox.com/v1',
+}
+
+# Table columns for each resource type, as (name, type, function returning the
+# cell for an object).  Other types only have Name and Age.
+def pod_ready(pod):
+    statuses = pod['status'].get('containerStatuses', [])
+    return '{0}/{1}'.format(len([ cs for cs in statuses if cs['ready'] ]),
+                            len(pod['spec']['containers']))
+
+NAME_COLUMN = ('Name', 'string', lambda o: o['metadata']['name'])
+AGE_COLUMN = ('Age', 'string', lambda o: '1d')
+
+TABLE_COLUMNS = {
+    'deployments': [
+        NAME_COLUMN,
+        ('Ready', 'string', lambda o: '{0}/{1}'.format(
+            o['status'].get('readyReplicas', 0), o['spec']['replicas'])),
+        ('Up-to-date', 'integer', lambda o: o['status'].get('replicas', 0)),
+        ('Available', 'integer', lambda o: o['status'].get('availableReplicas', 0)),
+        AGE_COLUMN,
+    ],
+    'replicasets': [
+        NAME_COLUMN,
+        ('Desired', 'integer', lambda o: o['spec']['replicas']),
+        ('Current', 'integer', lambda o: o['status'].get('replicas', 0)),
+        ('Ready', 'integer', lambda o: o['status'].get('readyReplicas', 0)),
+        AGE_COLUMN,
+    ],
+    'pods': [
+        NAME_COLUMN,
+        ('Ready', 'string', pod_ready),
+        ('Status', 'string', lambda o: o['status']['phase']),
+        ('Restarts', 'integer', lambda o: sum([ cs['restartCount']
+                    for cs in o['status'].get('containerStatuses', []) ])),
+        AGE_COLUMN,
+    ],
+}
+
+# partial_metadata: an object as a PartialObjectMetadata.
+def partial_metadata(obj):
+    return {
+        'kind': 'PartialObjectMetadata',
+        'apiVersion': 'meta.k8s.io/v1',
+        'metadata': obj['metadata'],
+    }
+
+# Protobuf schemas for the built-in types we generate, in the same form as
+# the views in kubeproto.py but covering every field we set.  a field with an
+# empty name is inlined in JSON: its fields are those of the enclosing object,
+# as for Volume.volumeSource.  'quantities' is a map<string, Quantity>.
+TIME = { 1: ('seconds', 'int') }
+MAP_ENTRY = { 1: ('key', 'string'), 2: ('value', 'string') }
+QUANTITY_ENTRY = { 1: ('key', 'string'), 2: ('value', { 1: ('string', 'string') }) }
+
+LIST_META = { 2: ('resourceVersion', 'string') }
+
+OBJECT_META = {
+    1: ('name', 'string'),
+    3: ('namespace', 'string'),
+    5: ('uid', 'string'),
+    6: ('resourceVersion', 'string'),
+    8: ('creationTimestamp', 'time'),
+    11: ('labels', 'map'),
+    12: ('annotations', 'map'),
+    13: ('ownerReferences', [{
+        1: ('kind', 'string'),
+        3: ('name', 'string'),
+        4: ('uid', 'string'),
+        5: ('apiVersion', 'string'),
+        6: ('controller', 'bool'),
+    }]),
+}
+
+POD_SPEC = {
+    1: ('volumes', [{
+        1: ('name', 'string'),
+        2: ('', { 10: ('persistentVolumeClaim', { 1: ('claimName', 'string') }) }),
+    }]),
+    2: ('containers', [{
+        1: ('name', 'string'),
+        2: ('image', 'string'),
+        6: ('ports', [{
+            1: ('name', 'string'),
+            3: ('containerPort', 'int'),
+            4: ('protocol', 'string'),
+        }]),
+        7: ('env', [{ 1: ('name', 'string'), 2: ('value', 'string') }]),
+        8: ('resources', { 1: ('limits', 'quantities'), 2: ('requests', 'quantities') }),
+        9: ('volumeMounts', [{ 1: ('name', 'string'), 3: ('mountPath', 'string') }]),
+        13: ('terminationMessagePath', 'string'),
+        14: ('imagePullPolicy', 'string'),
+        19: ('envFrom', [{ 3: ('secretRef', { 1: ('', { 1: ('name', 'string') }) }) }]),
+    }]),
+    3: ('restartPolicy', 'string'),
+    6: ('dnsPolicy', 'string'),
+    10: ('nodeName', 'string'),
+}
+
+POD_TEMPLATE_SPEC = { 1: ('metadata', OBJECT_META), 2: ('spec', POD_SPEC) }
+LABEL_SELECTOR = { 1: ('matchLabels', 'map') }
+
+PROTO_TYPES = {
+    'deployments': ('extensions/v1beta1', 'Deployment', {
+        1: ('metadata', OBJECT_META),
+        2: ('spec', {
+            1: ('replicas', 'int'),
+            2: ('selector', LABEL_SELECTOR),
+            3: ('template', POD_TEMPLATE_SPEC),
+        }),
+        3: ('status', {
+            2: ('replicas', 'int'),
+            4: ('availableReplicas', 'int'),
+            7: ('readyReplicas', 'int'),
+        }),
+    }),
+    'replicasets': ('extensions/v1beta1', 'ReplicaSet', {
+        1: ('metadata', OBJECT_META),
+        2: ('spec', {
+            1: ('replicas', 'int'),
+            2: ('selector', LABEL_SELECTOR),
+            3: ('template', POD_TEMPLATE_SPEC),
+        }),
+        3: ('status', { 1: ('replicas', 'int'), 4: ('readyReplicas', 'int') }),
+    }),
+    'pods': ('v1', 'Pod', {
+        1: ('metadata', OBJECT_META),
+        2: ('spec', POD_SPEC),
+        3: ('status', {
+            1: ('phase', 'string'),
+            2: ('conditions', [{
+                1: ('type', 'string'),
+                2: ('status', 'string'),
+                4: ('lastTransitionTime', 'time'),
+            }]),
+            8: ('containerStatuses', [{
+                1: ('name', 'string'),
+                2: ('state', {
+                    1: ('waiting', { 1: ('reason', 'string'), 2: ('message', 'string') }),
+                    2: ('running', { 1: ('startedAt', 'time') }),
+                }),
+                4: ('ready', 'bool'),
+                5: ('restartCount', 'int'),
+                6: ('image', 'string'),
+            }]),
+        }),
+    }),
+}
+
+def encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def encode_field(number, data):
+    return encode_varint(number << 3 | 2) + encode_varint(len(data)) + data
+
+# encode_message: encode a JSON object as a protobuf message using schema.
+def encode_message(obj, schema):
+    out = []
+    for (number, (name, kind)) in sorted(schema.items()):
+        if name == '':
+            out.append(encode_field(number, encode_message(obj, kind)))
+            continue
+        if name not in obj:
+            continue
+
+        value = obj[name]
+        if kind == 'string':
+            out.append(encode_field(number, value.encode('utf-8')))
+        elif kind in ('int', 'bool'):
+            out.append(encode_varint(number << 3) + encode_varint(int(value) % (1 << 64)))
+        elif kind == 'time':
+            seconds = calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+            out.append(encode_field(number, encode_message({ 'seconds': seconds }, TIME)))
+        elif kind == 'map':
+            for (k, v) in sorted(value.items()):
+                out.append(encode_field(number,
+                    encode_message({ 'key': k, 'value': v }, MAP_ENTRY)))
+        elif kind == 'quantities':
+            for (k, v) in sorted(value.items()):
+                out.append(encode_field(number,
+                    encode_message({ 'key': k, 'value': { 'string': v } }, QUANTITY_ENTRY)))
+        elif isinstance(kind, list):
+            for item in value:
+                out.append(encode_field(number, encode_message(item, kind[0])))
+        else:
+            out.append(encode_field(number, encode_message(value, kind)))
+
+    return b''.join(out)
+
+# encode_protobuf: encode an object in the Kubernetes protobuf envelope.
+def encode_protobuf(api_version, kind, raw):
+    type_meta = encode_message({ 'apiVersion': api_version, 'kind': kind },
+                               { 1: ('apiVersion', 'string'), 2: ('kind', 'string') })
+    return b'k8s\x00' + encode_field(1, type_meta) + encode_field(2, raw)
+
+# encode_object: encode one object of a resource type as protobuf.
+def encode_object(res, obj):
+    (api_version, kind, schema) = PROTO_TYPES[res]
+    return encode_protobuf(api_version, kind, encode_message(obj, schema))
+
+# encode_list: encode a list of objects of a resource type as protobuf.
+def encode_list(res, items, version):
+    (api_version, kind, schema) = PROTO_TYPES[res]
+    raw = encode_field(1, encode_message({ 'resourceVersion': str(version) }, LIST_META))
+    raw += b''.join([ encode_field(2, encode_message(obj, schema)) for obj in items ])
+    return encode_protobuf(api_version, kind + 'List', raw)
+
+# get_view: return the form of response requested by an Accept header for a
+# resource type: 'Table', 'PartialObjectMetadataList', 'Protobuf' or 'List'.
+# the API server uses the first alternative it supports.
+def get_view(accept, res):
+    for alternative in (accept or '').split(','):
+        parts = alternative.split(';')
+        if parts[0].strip() == 'application/vnd.kubernetes.protobuf':
+            if res in PROTO_TYPES:
+                return 'Protobuf'
+            continue
+
+        params = dict([ p.strip().split('=', 1) for p in parts[1:] if '=' in p ])
+        if params.get('g') != 'meta.k8s.io':
+            return 'List'
+        if params.get('as') in ('Table', 'PartialObjectMetadataList'):
+            return params['as']
+    return 'List'
+
+CONTENT_TYPES = { 'Protobuf': 'application/vnd.kubernetes.protobuf' }
+
+METRICS_PATH_RE = re.compile(r'^/apis/metrics.k8s.io/v1beta1/namespaces/([^/]+)/pods/([^/]+)$')
+PATH_RE = re.compile(r'^(/api/v1|/apis/[^/]+/[^/]+)/namespaces/([^/]+)/([^/]+)(?:/([^/]+))?$')
+
+# merge_patch: apply a JSON merge patch (RFC 7386) to an object.
+def merge_patch(obj, patch):
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(obj, dict):
+        obj = {}
+
+    obj = dict(obj)
+    for (k, v) in patch.items():
+        if v is None:
+            obj.pop(k, None)
+        else:
+            obj[k] = merge_patch(obj.get(k), v)
+    return obj
+
+# make_daemonset_pods: generate a DaemonSet's pods, one on each node.  their
+# containers have already run, so their images have been pulled.
+def make_daemonset_pods(ds):
+    md = ds['metadata']
+    template = ds['spec']['template']
+    pods = []
+
+    for i in range(NODES):
+        pod_name = '{0}-{1:05x}'.format(md['name'], i)
+        pods.append({
+            'apiVersion': 'v1',
+            'kind': 'Pod',
+            'metadata': metadata(md['namespace'], pod_name, 'pod-' + pod_name,
+                template['metadata'].get('labels'),
+                owner=('DaemonSet', md['name'], md['uid'])),
+            'spec': dict(template['spec'], nodeName='node-{0}'.format(i)),
+            'status': {
+                'phase': 'Running',
+                'containerStatuses': [{
+                    'name': container['name'],
+                    'ready': False,
+                    'restartCount': 1,
+                    'image': container['image'],
+                    'state': { 'waiting': { 'reason': 'CrashLoopBackOff' } },
+                    'lastState': { 'terminated': { 'exitCode': 0 } },
+                } for container in template['spec']['containers'] ],
+            },
+        })
+
+    return pods
+
+# Cluster: the synthetic cluster state.
+class Cluster(object):
+    def __init__(self, namespace='default', pods=100):
+        self.namespace = namespace
+        self.npods = pods
+        self.lock = threading.Lock()
+        self.version = 0
+        self.modified = True
+        self.reset()
+
+    # reset: regenerate the namespace, so it has enough applications for the
+    # requested number of pods.  the first application is always "app0".  if
+    # nothing has changed since the last reset, this does nothing, so clients
+    # can resume watches across benchmark runs; otherwise the event history is
+    # discarded and watches from before the reset fail with 410 Gone.
+    def reset(self):
+        with self.lock:
+            if not self.modified:
+                return
+
+            self.objects = { res: {} for res in PATHS }
+            napps = max(1, (self.npods + REPLICAS - 1) // REPLICAS)
+            for i in range(napps):
+                for (res, objs) in make_app(self.namespace, 'app{0}'.format(i)).items():
+                    for obj in objs:
+                        self.objects[res][obj['metadata']['name']] = obj
+            self.version += 1
+            self.compacted = self.version
+            self.events = []
+            self.modified = False
+            self.list_cache = {}
+
+    def get(self, res, name):
+        with self.lock:
+            return self.objects[res].get(name)
+
+    # list: return the encoded list response for a resource type, optionally
+    # filtered by a label selector of "key=value" and "key" (exists) terms, in
+    # the form given by view (see get_view).
+    def list(self, res, selector, view='List'):
+        with self.lock:
+            key = (res, selector, view)
+            if key in self.list_cache:
+                return self.list_cache[key]
+
+            match = {}
+            if selector:
+                for term in selector.split(','):
+                    (k, v) = term.split('=', 1) if '=' in term else (term, None)
+                    match[k] = v
+
+            items = [ obj for obj in self.objects[res].values()
+                        if all(k in obj['metadata']['labels'] if v is None
+                                else obj['metadata']['labels'].get(k) == v
+                                    for (k, v) in match.items()) ]
+
+            if view == 'Protobuf':
+                self.list_cache[key] = encode_list(res, items, self.version)
+                return self.list_cache[key]
+
+            if view == 'Table':
+                columns = TABLE_COLUMNS.get(res, [ NAME_COLUMN, AGE_COLUMN ])
+                body = {
+                    'kind': 'Table',
+                    'apiVersion': 'meta.k8s.io/v1',
+                    'metadata': { 'resourceVersion': str(self.version) },
+                    'columnDefinitions': [ { 'name': name, 'type': type, 'format': '',
+                                             'description': '', 'priority': 0 }
+                                                for (name, type, cell) in columns ],
+                    'rows': [ { 'cells': [ cell(obj) for (name, type, cell) in columns ],
+                                'object': partial_metadata(obj) }
+                                    for obj in items ],
+                }
+            elif view == 'PartialObjectMetadataList':
+                body = {
+                    'kind': 'PartialObjectMetadataList',
+                    'apiVersion': 'meta.k8s.io/v1',
+                    'metadata': { 'resourceVersion': str(self.version) },
+                    'items': [ partial_metadata(obj) for obj in items ],
+                }
+            else:
+                body = {
+                    'kind': 'List',
+                    'apiVersion': 'v1',
+                    'metadata': { 'resourceVersion': str(self.version) },
+                    'items': items,
+                }
+
+            body = encode_json(body)
+
+            self.list_cache[key] = body
+            return body
+
+    # pod_metrics: return a PodMetrics for a pod, with usage that varies around
+    # a level chosen for each pod, or None if there is no such pod.
+    def pod_metrics(self, name):
+        pod = self.get('pods', name)
+        if pod is None:
+            return None
+
+        window = int(time.time()) // METRICS_RESOLUTION * METRICS_RESOLUTION
+        level = random.Random(name)
+        sample = random.Random('{0}/{1}'.format(name, window))
+        return {
+            'kind': 'PodMetrics',
+            'apiVersion': 'metrics.k8s.io/v1beta1',
+            'metadata': {
+                'name': name,
+                'namespace': pod['metadata']['namespace'],
+                'creationTimestamp': TIMESTAMP,
+            },
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(window)),
+            'window': '{0}s'.format(METRICS_RESOLUTION),
+            'containers': [{
+                'name': c['name'],
+                'usage': {
+                    'cpu': '{0}n'.format(int(level.uniform(0.02, 0.2)
+                                             * sample.uniform(0.5, 1.5) * 1e9)),
+                    'memory': '{0}Ki'.format(int(level.uniform(64, 256)
+                                                 * sample.uniform(0.9, 1.1) * 1024)),
+                },
+            } for c in pod['spec']['containers'] ],
+        }
+
+    # changed: record events for changed objects, and forget cached lists.
+    # the lock must be held.
+    def changed(self, kind, objs):
+        for (r, o) in objs:
+            self.version += 1
+            o = dict(o, metadata=dict(o['metadata'],
+                                      resourceVersion=str(self.version)))
+            self.events.append((self.version, r, kind, o))
+
+        self.modified = True
+        self.list_cache = {}
+
+    # create: create an object.  returns it, or None if it already exists.
+    # creating a DaemonSet also creates its pods, as the controller would.
+    def create(self, res, obj):
+        with self.lock:
+            name = obj['metadata']['name']
+            if name in self.objects[res]:
+                return None
+
+            obj = dict(obj, metadata=metadata(
+                self.namespace, name, '{0}-{1}'.format(res, name),
+                obj['metadata'].get('labels'),
+                annotations=obj['metadata'].get('annotations')))
+            self.objects[res][name] = obj
+            created = [ (res, obj) ]
+
+            if res == 'daemonsets':
+                obj['status'] = {
+                    'observedGeneration': 1,
+                    'desiredNumberScheduled': NODES,
+                    'currentNumberScheduled': NODES,
+                }
+                for pod in make_daemonset_pods(obj):
+                    self.objects['pods'][pod['metadata']['name']] = pod
+                    created.append(('pods', pod))
+
+            self.changed('ADDED', created)
+            return obj
+
+    # patch: apply a JSON merge patch to an object.  returns the object, or
+    # None if it doesn't exist.
+    def patch(self, res, name, patch):
+        with self.lock:
+            obj = self.objects[res].get(name)
+            if obj is None:
+                return None
+
+            obj = merge_patch(obj, patch)
+            self.objects[res][name] = obj
+            self.changed('MODIFIED', [ (res, obj) ])
+            return obj
+
+    # delete: delete an object.  deleting a Deployment also deletes its
+    # ReplicaSets and their pods, and deleting a DaemonSet deletes its pods,
+    # as the garbage collector would.
+    def delete(self, res, name):
+        with self.lock:
+            obj = self.objects[res].pop(name, None)
+            if obj is None:
+                return None
+
+            deleted = [ (res, obj) ]
+            if res == 'deployments':
+                for (rsname, rs) in list(self.objects['replicasets'].items()):
+                    owners = rs['metadata'].get('ownerReferences', [])
+                    if any(o['name'] == name for o in owners):
+                        deleted.append(('replicasets',
+                                        self.objects['replicasets'].pop(rsname)))
+                        for (podname, pod) in list(self.objects['pods'].items()):
+                            if any(o['name'] == rsname
+                                    for o in pod['metadata'].get('ownerReferences', [])):
+                                deleted.append(('pods',
+                                                self.objects['pods'].pop(podname)))
+            elif res == 'daemonsets':
+                for (podname, pod) in list(self.objects['pods'].items()):
+                    if any(o['name'] == name
+                            for o in pod['metadata'].get('ownerReferences', [])):
+                        deleted.append(('pods', self.objects['pods'].pop(podname)))
+
+            self.changed('DELETED', deleted)
+            return obj
+
+    # watch_events: return (events, version): the events for a resource type
+    # after version, and the version they bring the caller up to.  events is
+    # None if that version has been compacted.  with no version, every current
+    # object is returned as ADDED, as the API server does.
+    def watch_events(self, res, version):
+        with self.lock:
+            if version is None:
+                return ([ ('ADDED', obj) for obj in self.objects[res].values() ],
+                        self.version)
+            if version < self.compacted:
+                return (None, version)
+            return ([ (kind, obj) for (v, r, kind, obj) in self.events
+                        if r == res and v > version ], self.version)
+
+# Server: a threaded HTTP server that collects request statistics.
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cluster, latency=0, error_rate=0):
+        HTTPServer.__init__(self, address, Handler)
+        self.cluster = cluster
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.requests = 0
+            self.bytes = 0
+            self.throttled = 0
+            self.paths = {}
+
+    def record(self, method, path, nbytes):
+        with self.stats_lock:
+            self.requests += 1
+            self.bytes += nbytes
+            key = method + ' ' + path
+            self.paths[key] = self.paths.get(key, 0) + 1
+
+    def record_bytes(self, nbytes):
+        with self.stats_lock:
+            self.bytes += nbytes
+
+    # handle_error: clients close watches and pooled connections whenever
+    # they like, so don't report that.
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are written separately; without this, delayed ACKs add
+    # 40ms to every request.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = encode_json(body)
+
+        encoding = None
+        if (len(body) >= GZIP_MIN_SIZE
+                and 'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body, GZIP_LEVEL)
+            encoding = 'gzip'
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(self.command, urlparse(self.path).path, len(body))
+
+    # throttle: randomly reject the request with 429, according to the
+    # server's error rate.  returns True if the request was rejected.
+    def throttle(self):
+        if not self.server.error_rate or random.random() >= self.server.error_rate:
+            return False
+
+        body = encode_json({
+            'kind': 'Status',
+            'apiVersion': 'v1',
+            'status': 'Failure',
+            'reason': 'TooManyRequests',
+            'message': 'too many requests',
+            'code': 429,
+        })
+
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+        with self.server.stats_lock:
+            self.server.throttled += 1
+        self.server.record(self.command, urlparse(self.path).path, len(body))
+        return True
+
+    def send_status(self, code, reason, message):
+        self.send_json(code, {
+            'kind': 'Status',
+            'apiVersion': 'v1',
+            'status': 'Failure' if code >= 400 else 'Success',
+            'reason': reason,
+            'message': message,
+            'code': code,
+        })
+
+    # parse: return (resource, name, query) for the request, or None.
+    def parse(self):
+        url = urlparse(self.path)
+        m = PATH_RE.match(url.path)
+        if m is None:
+            return None
+
+        (prefix, namespace, res, name) = m.groups()
+        if res not in PATHS or PATHS[res] != prefix \
+                or namespace != self.server.cluster.namespace:
+            return None
+
+        return (res, name, parse_qs(url.query))
+
+    # send_chunk: write one chunk of a chunked response.
+    def send_chunk(self, data):
+        self.wfile.write('{0:x}\r\n'.format(len(data)).encode('ascii')
+                         + data + b'\r\n')
+        self.wfile.flush()
+
+    # client_closed: wait up to timeout for the client to close the connection;
+    # returns True if it has.
+    def client_closed(self, timeout):
+        (readable, _, _) = select.select([ self.connection ], [], [], timeout)
+        return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+
+    # watch: stream watch events for a resource type until the watch times out
+    # or the client goes away.
+    def watch(self, res, query):
+        cluster = self.server.cluster
+        version = query.get('resourceVersion', [''])[0]
+        version = int(version) if version else None
+        timeout = min(int(query.get('timeoutSeconds', ['60'])[0]), 60)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.server.record('WATCH', urlparse(self.path).path, 0)
+
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                (events, version) = cluster.watch_events(res, version)
+                if events is None:
+                    event = { 'type': 'ERROR', 'object': {
+                        'kind': 'Status',
+                        'apiVersion': 'v1',
+                        'status': 'Failure',
+                        'reason': 'Expired',
+                        'message': 'too old resource version: {0} ({1})'.format(
+                            version, cluster.compacted),
+                        'code': 410,
+                    }}
+                    events = [ (event['type'], event['object']) ]
+
+                for (kind, obj) in events:
+                    data = encode_json({ 'type': kind, 'object': obj }) + b'\n'
+                    self.send_chunk(data)
+                    self.server.record_bytes(len(data))
+                    if kind == 'ERROR':
+                        deadline = 0
+
+                if time.monotonic() >= deadline:
+                    break
+                if self.client_closed(0.05):
+                    self.close_connection = True
+                    return
+
+            self.send_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            return self.rfile.read(length)
+        return b''
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.throttle():
+            return
+
+        m = METRICS_PATH_RE.match(urlparse(self.path).path)
+        if m is not None and m.group(1) == self.server.cluster.namespace:
+            metrics = self.server.cluster.pod_metrics(m.group(2))
+            if metrics is None:
+                return self.send_status(404, 'NotFound',
+                    'podmetrics.metrics.k8s.io "{0}" not found'.format(m.group(2)))
+            return self.send_json(200, metrics)
+
+        req = self.parse()
+        if req is None:
+            return self.send_status(404, 'NotFound', 'unknown path ' + self.path)
+
+        (res, name, query) = req
+        cluster = self.server.cluster
+
+        if name is None and query.get('watch', [''])[0] in ('true', '1'):
+            return self.watch(res, query)
+
+        if name is None:
+            selector = query.get('labelSelector', [''])[0]
+            view = get_view(self.headers.get('Accept'), res)
+            return self.send_json(200, cluster.list(res, selector, view),
+                CONTENT_TYPES.get(view, 'application/json'))
+
+        obj = cluster.get(res, name)
+        if obj is None:
+            return self.send_status(404, 'NotFound',
+                '{0} "{1}" not found'.format(res, name))
+
+        if get_view(self.headers.get('Accept'), res) == 'Protobuf':
+            return self.send_json(200, encode_object(res, obj), CONTENT_TYPES['Protobuf'])
+        self.send_json(200, obj)
+
+    def do_DELETE(self):
+        self.read_body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.throttle():
+            return
+
+        req = self.parse()
+        if req is None or req[1] is None:
+            return self.send_status(404, 'NotFound', 'unknown path ' + self.path)
+
+        (res, name, query) = req
+        obj = self.server.cluster.delete(res, name)
+        if obj is None:
+            return self.send_status(404, 'NotFound',
+                '{0} "{1}" not found'.format(res, name))
+        self.send_status(200, 'Deleted', '{0} "{1}" deleted'.format(res, name))
+
+    def do_POST(self):
+        body = json.loads(self.read_body().decode('utf-8'))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.throttle():
+            return
+
+        req = self.parse()
+        if req is None or req[1] is not None:
+            return self.send_status(404, 'NotFound', 'unknown path ' + self.path)
+
+        (res, name, query) = req
+        obj = self.server.cluster.create(res, body)
+        if obj is None:
+            return self.send_status(409, 'AlreadyExists',
+                '{0} "{1}" already exists'.format(res, body['metadata']['name']))
+        self.send_json(201, obj)
+
+    # do_PATCH: patches are all applied as merge patches, which is enough for
+    # what kdtool sends.
+    def do_PATCH(self):
+        body = json.loads(self.read_body().decode('utf-8'))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.throttle():
+            return
+
+        req = self.parse()
+        if req is None or req[1] is None:
+            return self.send_status(404, 'NotFound', 'unknown path ' + self.path)
+
+        (res, name, query) = req
+        obj = self.server.cluster.patch(res, name, body)
+        if obj is None:
+            return self.send_status(404, 'NotFound',
+                '{0} "{1}" not found'.format(res, name))
+        self.send_json(200, obj)
+
+# start: start a server in a background thread and return it.
+def start(pods=100, latency=0, namespace='default', port=0, error_rate=0):
+    cluster = Cluster(namespace=namespace, pods=pods)
+    server = Server(('127.0.0.1', port), cluster, latency=latency,
+                    error_rate=error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='fake Kubernetes API server')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--pods', type=int, default=100,
+        help='number of pods in the namespace')
+    parser.add_argument('--latency', type=float, default=0,
+        help='latency to add to every request, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='proportion of requests to reject with 429')
+    parser.add_argument('--namespace', type=str, default='default')
+    args = parser.parse_args()
+
+    server = start(pods=args.pods, latency=args.latency,
+                   namespace=args.namespace, port=args.port,
+                   error_rate=args.error_rate)
+    print('serving {0} pods on {1}'.format(args.pods, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
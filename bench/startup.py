@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Measure kdtool startup time for commands that don't talk to the API server,
+# and check that they don't import any of our heavy dependencies.  Exits
+# non-zero if the budget is exceeded.
+#
+#   python3 bench/startup.py [--kdtool=kdtool.pyz] [--budget=0.3]
+
+import argparse, os, subprocess, sys, time
+
+HEAVY_MODULES = ('kubernetes', 'yaml', 'passlib', 'humanfriendly', 'urllib3',
+                 'asyncio', 'ssl', 'kubeasync')
+
+COMMANDS = (
+    ('-h',),
+    ('-V',),
+    ('deploy', '--json', 'nginx:latest', 'bench'),
+)
+
+# run: run kdtool once with the given arguments.  returns the wall time and the
+# set of top-level packages it imported.
+def run(kdtool, cmdargs):
+    kargs = [ sys.executable, '-X', 'importtime', kdtool, '-K', '/bin/true' ]
+    kargs.extend(cmdargs)
+
+    start = time.monotonic()
+    p = subprocess.run(kargs, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.monotonic() - start
+
+    modules = set()
+    for line in p.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        name = line.rsplit('|', 1)[-1].strip()
+        modules.add(name.split('.')[0])
+
+    return (elapsed, modules)
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='kdtool startup benchmark')
+    parser.add_argument('--kdtool', type=str,
+        default=os.path.join(here, '..', '__main__.py'),
+        help='kdtool script or zipapp to run')
+    parser.add_argument('--budget', type=float, default=0.3,
+        help='maximum startup time in seconds for deploy --json')
+    parser.add_argument('--runs', type=int, default=5,
+        help='number of runs per command; the best time is reported')
+    args = parser.parse_args()
+
+    failed = False
+
+    for cmdargs in COMMANDS:
+        best = None
+        heavy = set()
+
+        for i in range(args.runs):
+            (elapsed, modules) = run(args.kdtool, cmdargs)
+            heavy |= modules.intersection(HEAVY_MODULES)
+            if best is None or elapsed < best:
+                best = elapsed
+
+        sys.stdout.write('{0:<40} {1:8.3f}s{2}\n'.format(
+            'kdtool ' + ' '.join(cmdargs),
+            best,
+            '  imports: ' + ', '.join(sorted(heavy)) if heavy else ''))
+
+        if heavy:
+            failed = True
+        if cmdargs[0] == 'deploy' and best > args.budget:
+            sys.stdout.write('  over budget of {0:.3f}s\n'.format(args.budget))
+            failed = True
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+import re
+from datetime import datetime
+from sys import stdout, stderr, exit
+
+import deployment, kubeutil, undeploy
+
+# parse_timestamp: convert a Kubernetes timestamp into a datetime.
+def parse_timestamp(ts):
+    return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ')
+
+# last_rollout: return the time of the last rollout of a deployment, which is
+# the creation time of its newest replicaset.  if the deployment has no
+# replicasets, use the deployment's own creation time.
+def last_rollout(dp, replicasets):
+    times = [ parse_timestamp(rs['metadata']['creationTimestamp'])
+                for rs in replicasets ]
+    times.append(parse_timestamp(dp['metadata']['creationTimestamp']))
+    return max(times)
+
+# gc: find stale applications and undeploy them, including attached resources.
+def gc(args):
+    import humanfriendly
+
+    if not (args.selector or args.match or args.older_than):
+        stderr.write('gc: at least one of --selector, --match or --older-than is required\n')
+        exit(1)
+
+    try:
+        match = re.compile(args.match) if args.match else None
+    except re.error as e:
+        stderr.write('gc: invalid --match expression: {0}\n'.format(str(e)))
+        exit(1)
+
+    try:
+        max_age = humanfriendly.parse_timespan(args.older_than) \
+                    if args.older_than else None
+    except humanfriendly.InvalidTimespan as e:
+        stderr.write('gc: invalid --older-than: {0}\n'.format(str(e)))
+        exit(1)
+
+    try:
+        dps = deployment.get_deployments(args.namespace, args.selector,
+                                         metadata_only=True)
+        replicasets = deployment.get_namespace_replicasets(args.namespace) \
+                        if max_age is not None else {}
+        attached = deployment.get_namespace_attached_resources(args.namespace)
+    except Exception as e:
+        stderr.write('cannot list deployments: {0}\n'.format(
+            kubeutil.get_error(e)))
+        exit(1)
+
+    now = datetime.utcnow()
+    plan = []
+
+    for dp in sorted(dps, key=lambda dp: dp['metadata']['name']):
+        name = dp['metadata']['name']
+
+        if match and not match.search(name):
+            continue
+
+        # Deployments attached to another application, like a shared Redis,
+        # are removed with that application.
+        app = dp['metadata'].get('labels', {}).get(deployment.APP_LABEL)
+        if app is not None and app != name:
+            continue
+
+        age = None
+        if max_age is not None:
+            age = (now - last_rollout(dp, replicasets.get(name, []))).total_seconds()
+            if age < max_age:
+                continue
+
+        resources = attached.get(name, [])
+        try:
+            # Applications deployed before resources were labelled.
+            found = set([ (res['kind'], res['name']) for res in resources ])
+            resources = resources + [ res for res in deployment.get_legacy_resources(dp)
+                                        if (res['kind'], res['name']) not in found ]
+        except ValueError as e:
+            stderr.write("warning: {0}: could not decode kdtool.torchbox.com/attached-resources annotation: {1}\n".format(
+                name, str(e)))
+
+        plan.append((name, age, resources))
+
+    if not len(plan):
+        stdout.write('no applications to remove\n')
+        exit(0)
+
+    stdout.write('\nthe following applications will be removed:\n')
+    for (name, age, resources) in plan:
+        if age is not None:
+            stdout.write('- {0}/{1} (last rollout {2} ago)\n'.format(
+                args.namespace, name, humanfriendly.format_timespan(age, max_units=2)))
+        else:
+            stdout.write('- {0}/{1}\n'.format(args.namespace, name))
+
+        for res in resources:
+            stdout.write('    {0}: {1}\n'.format(res['kind'], res['name']))
+
+    stdout.write('\n')
+
+    if args.dry_run:
+        exit(0)
+
+    if not args.force:
+        pr = input('continue [y/N]? ')
+        if pr.lower() not in ['yes', 'y']:
+            stdout.write("okay, aborting\n")
+            exit(0)
+
+    items = []
+    for (name, age, resources) in plan:
+        items.append({ 'kind': 'deployment', 'name': name })
+        items.extend(resources)
+
+    failed = undeploy.delete_resources(args.namespace, items, args.propagation,
+                                       parallel=args.parallel)
+
+    stdout.write('\n{0} resources deleted, {1} failed\n'.format(
+        len(items) - len(failed), len(failed)))
+    exit(1 if failed else 0)
+
+gc.help = "undeploy stale applications in bulk"
+gc.arguments = (
+    ( ('-l', '--selector'), {
+        'type': str,
+        'metavar': 'LABEL=VALUE',
+        'help': 'only consider deployments matching this label selector',
+    }),
+    ( ('-m', '--match'), {
+        'type': str,
+        'metavar': 'REGEX',
+        'help': 'only consider deployments whose name matches this regular expression',
+    }),
+    ( ('-o', '--older-than'), {
+        'type': str,
+        'metavar': 'AGE',
+        'help': 'only consider deployments last rolled out longer ago than AGE (e.g. 14d)',
+    }),
+    ( ('-f', '--force'), {
+        'action': 'store_true',
+        'help': 'do not prompt for confirmation',
+    }),
+    ( ('--dry-run',), {
+        'action': 'store_true',
+        'help': 'show what would be removed and exit',
+    }),
+    ( ('--propagation',), {
+        'type': str,
+        'choices': ('Foreground', 'Background', 'Orphan'),
+        'default': 'Foreground',
+        'help': 'deletion propagation policy for dependent objects',
+    }),
+    ( ('-j', '--parallel'), {
+        'type': int,
+        'default': 10,
+        'metavar': 'N',
+        'help': 'number of concurrent deletions',
+    }),
+)
+
+# Deleting hundreds of applications shouldn't overload the API server.
+gc.api_policy = {
+    'qps': 10,
+    'burst': 10,
+}
+
+commands = {
+    'gc':   gc,
+}
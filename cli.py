@@ -0,0 +1,197 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+
+import argparse, json, subprocess, re, time
+from base64 import b64encode
+from os import environ
+from sys import stdout, stderr, exit
+
+from kubectl import find_kubectl
+
+# Command modules are imported here for their argument definitions, so they
+# must not import kubernetes, kubeasync, yaml, passlib or humanfriendly at
+# module level; those are imported by the functions that use them.
+# bench/startup.py checks this.
+import deploy, undeploy, shell, status, cleanup, serve, history, metrics, deployment, informer, kubeutil, tracing
+
+imported = time.monotonic()
+
+class PrintVersion(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string):
+    try:
+        import version
+        print('kdtool version {}, {}.'.format(
+                        version.__version__, version.__info__))
+    except ImportError:
+        print('kdtool, development build or manual installation.')
+    exit(0)
+
+# Create our argument parser.
+parser = argparse.ArgumentParser(description='Kubernetes deployment tool')
+subparsers = parser.add_subparsers(
+                title='commands',
+                description='valid commands',
+                help='additional help')
+
+# Global options for all modes; mostly to do with Kubernetes connection.
+parser.add_argument('-V', '--version', nargs=0, action=PrintVersion,
+    help="Type program version and exit")
+parser.add_argument('-K', '--kubectl', type=str, metavar='PATH',
+    help='Location of kubectl binary')
+parser.add_argument('-n', '--namespace', type=str,
+    help='Kubernetes namespace to deploy in')
+parser.add_argument('-S', '--server', type=str, metavar='URL',
+    help="Kubernetes API server URL")
+parser.add_argument('-T', '--token', type=str,
+    help="Kubernetes authentication token")
+parser.add_argument('-C', '--ca-certificate', type=str,
+    help="Kubernetes API server CA certificate")
+parser.add_argument('-G', '--gitlab', action='store_true',
+    help="Configure Kubernetes from Gitlab CI")
+parser.add_argument('-c', '--context', type=str, metavar='CLUSTER',
+    help='Configuration context from kubeconfig')
+parser.add_argument('--no-credential-cache', action='store_true',
+    help='Do not cache credentials resolved from kubeconfig')
+parser.add_argument('--object-cache', action='store_true',
+    help='Keep a local cache of deployments, replicasets and pods (default: $KDTOOL_OBJECT_CACHE)')
+parser.add_argument('--trace', type=str, nargs='?', metavar='FILE',
+    help='Print a timing summary at exit; with FILE, also write a Chrome trace')
+parser.add_argument('--api-qps', type=float, metavar='N',
+    help='Limit API requests to N per second (0 for no limit)')
+parser.add_argument('--api-burst', type=int, metavar='N',
+    help='Allow bursts of up to N API requests above --api-qps')
+parser.add_argument('--api-retries', type=int, metavar='N',
+    help='Retry API requests that fail with a transient error up to N times')
+parser.add_argument('--connect', type=str, metavar='SOCKET',
+    help='Run the command in a "kdtool serve" daemon (default: $KDTOOL_SOCKET)')
+
+# Add commands and their options from modules.
+def add_commands(cmds):
+  for cmd in sorted(cmds):
+    func = cmds[cmd]
+    if hasattr(func, 'arguments'):
+      p = subparsers.add_parser(cmd, help=func.help)
+      p.set_defaults(func=func)
+      for arg in func.arguments:
+        p.add_argument(*arg[0], **arg[1])
+
+add_commands(cleanup.commands)
+add_commands(deploy.commands)
+add_commands(history.commands)
+add_commands(metrics.commands)
+add_commands(serve.commands)
+add_commands(shell.commands)
+add_commands(status.commands)
+add_commands(undeploy.commands)
+
+# main: parse the command line and run the requested command.  returns the exit
+# status.  if serving is True, we are running a request inside "kdtool serve"
+# and must not forward it to another daemon.
+def main(argv, serving=False):
+    # --trace takes an optional filename, which would otherwise swallow the
+    # command name in "kdtool --trace deploy ...".
+    argv = list(argv)
+    for (i, arg) in enumerate(argv):
+        if arg in subparsers.choices:
+            break
+        if arg == '--trace':
+            argv[i] = '--trace='
+
+    parse_start = time.monotonic()
+    args = parser.parse_args(argv)
+
+    if args.trace is not None:
+        tracing.start()
+        if not serving:
+            tracing.add('startup', 'imports', tracing.loaded, imported)
+        tracing.add('startup', 'parse arguments', parse_start, time.monotonic())
+
+    try:
+        return run(args, argv, serving)
+    finally:
+        if args.trace is not None:
+            stdout.flush()
+            tracing.finish(stderr, args.trace or None)
+
+# run: run the command for the parsed arguments.
+def run(args, argv, serving):
+
+    # Hand the command to a running daemon if one was requested.
+    if args.connect is None and not serving:
+        args.connect = environ.get('KDTOOL_SOCKET')
+    if args.connect and not serving and getattr(args, 'func', None) is not serve.serve:
+        status = serve.client(args.connect, argv)
+        if status is not None:
+            return status
+
+    # Try to find kubectl.
+    if args.kubectl is None:
+        args.kubectl = find_kubectl()
+    if args.kubectl is None:
+        stderr.write('could not find kubectl executable anywhere in $PATH.\n')
+        stderr.write('install kubectl in $PATH or pass -K/path/to/kubectl.\n')
+        return 1
+
+    # The Python client doesn't seem to pick up the namespace from kubeconfig,
+    # which breaks GitLab's automatic configuration.  Try to guess what it should
+    # be.
+    if args.namespace is None:
+        if 'KUBE_NAMESPACE' in environ:
+            args.namespace = environ['KUBE_NAMESPACE']
+        else:
+            args.namespace = 'default'
+
+    # Check for GitLab mode.
+    if args.gitlab:
+        if 'KUBECONFIG' in environ:
+            stderr.write("""\
+warning: argument -G/--gitlab specified but $KUBECONFIG is set in environment.
+         since GitLab 9.4, the --gitlab option is no longer required and should
+         be removed.
+warning: $KUBECONFIG will be ignored and Kubernetes configuration will be taken
+         from legacy GitLab environment configuration.
+""")
+            del environ['KUBECONFIG']
+
+        try:
+            if 'KUBE_CA_PEM_FILE' in environ:
+                args.ca_certificate = environ['KUBE_CA_PEM_FILE']
+            elif 'KUBE_CA_PEM' in environ:
+                args.ca_certificate = kubeutil.cache_file(
+                    environ['KUBE_CA_PEM'].encode('utf-8'), '.crt')
+            else:
+                stderr.write("--gitlab: cannot determine Kubernetes CA certificate\n")
+                return 1
+            args.namespace = environ['KUBE_NAMESPACE']
+            args.server = environ['KUBE_URL']
+            args.token = environ['KUBE_TOKEN']
+        except KeyError as e:
+            stderr.write("--gitlab: missing ${0} in environment\n".format(e.args[0]))
+            return 1
+
+    kubeutil.configure(args)
+    informer.configure(args)
+    deployment.reset_command_cache()
+
+    # Apply the command's request policy, with any overrides from the command
+    # line.
+    policy = dict(getattr(getattr(args, 'func', None), 'api_policy', {}))
+    for k in ('qps', 'burst', 'retries'):
+        if getattr(args, 'api_' + k) is not None:
+            policy[k] = getattr(args, 'api_' + k)
+    kubeutil.set_policy(**policy)
+
+    # Run the subcommand requested by the user.
+    if not hasattr(args, 'func'):
+      stderr.write("no command given\n")
+      return 0
+
+    with tracing.span('command', args.func.__name__):
+        return args.func(args)
@@ -8,116 +8,424 @@
 # warranty.
 
 
-import json, kubernetes
+import json, threading, time
 
-import kubeutil
+import informer, jsonstream, kubeproto, kubeutil
+
+# Objects read by get_deployment and get_replicasets can be cached for a short
+# time.  This is only enabled by "kdtool serve", where several commands run in
+# the same process; cache_ttl is the lifetime of an entry in seconds.
+cache = {}
+cache_ttl = 0
+cache_lock = threading.Lock()
+
+# cache_get: return a cached object for an API path, or None.
+def cache_get(path):
+    if not cache_ttl:
+        return None
+
+    with cache_lock:
+        try:
+            (expires, obj) = cache[path]
+        except KeyError:
+            return None
+
+        if expires < time.monotonic():
+            del cache[path]
+            return None
+
+        return obj
+
+# cache_put: store an object for an API path.
+def cache_put(path, obj):
+    if not cache_ttl:
+        return
+
+    with cache_lock:
+        cache[path] = (time.monotonic() + cache_ttl, obj)
+
+# clear_cache: discard all cached objects.  with --object-cache, the
+# informer's stores are brought up to date before they are next read.
+def clear_cache():
+    with cache_lock:
+        cache.clear()
+        attached_cache.clear()
+    informer.invalidate()
+
+# not_found: the error the API server would return for a missing object.
+def not_found(resource, name):
+    body = json.dumps({
+        'kind': 'Status',
+        'status': 'Failure',
+        'reason': 'NotFound',
+        'message': '{0} "{1}" not found'.format(resource, name),
+        'code': 404,
+    }).encode('utf-8')
+    return kubeutil.ApiError(404, 'Not Found', body)
+
+# Accept headers for the projections the API server can return instead of full
+# objects.  Each asks for the meta.k8s.io/v1 form, then v1beta1 for older
+# servers, then plain JSON for servers with neither; callers check the kind of
+# what comes back.
+ACCEPT_TABLE = ('application/json;as=Table;v=v1;g=meta.k8s.io,'
+                'application/json;as=Table;v=v1beta1;g=meta.k8s.io,'
+                'application/json')
+ACCEPT_METADATA = ('application/json;as=PartialObjectMetadataList;v=v1;g=meta.k8s.io,'
+                   'application/json;as=PartialObjectMetadataList;v=v1beta1;g=meta.k8s.io,'
+                   'application/json')
+
+# How much of a response body get_json reads at a time.
+CHUNK_SIZE = 65536
+
+# get_json: fetch an API path and decode the response.  if cached is True, the
+# response may come from (and is stored in) the short-lived cache.  if view is
+# a kubeproto schema, ask for protobuf and decode only the fields in the view;
+# servers that can't send protobuf for the resource send full JSON objects.
+def get_json(resource_path, query_params=None, accept='application/json', cached=False,
+             view=None):
+    query_params = query_params or {}
+    if view is not None:
+        accept = kubeproto.CONTENT_TYPE + ',' + accept
+    key = '{0}?{1} {2}'.format(resource_path, sorted(query_params.items()), accept)
+
+    if cached:
+        obj = cache_get(key)
+        if obj is not None:
+            return obj
 
-# get_deployment: return the named deployment.
-def get_deployment(namespace, name):
     api_client = kubeutil.get_client()
 
     # We can't use the normal client API here because it returns Python objects
     # that can't be converted back into JSON.  Instead, fetch the JSON by hand.
+    # Large responses are gzipped by the API server if we ask; the body is
+    # decompressed and parsed as it arrives, rather than read into memory
+    # first.
+    header_params = {}
+    header_params['Accept'] = accept
+    header_params['Accept-Encoding'] = 'gzip'
+    header_params['Content-Type'] = api_client.select_header_content_type(['*/*'])
+    header_params.update(kubeutil.get_config().api_key)
+
+    (resp, code, header) = api_client.call_api(
+            resource_path, 'GET', {}, query_params, header_params, None, [],
+            _preload_content=False)
+    try:
+        content_type = resp.headers.get('Content-Type', '')
+        if view is not None and content_type.startswith(kubeproto.CONTENT_TYPE):
+            obj = kubeproto.decode(resp.data, view)
+        else:
+            obj = jsonstream.load(resp.stream(CHUNK_SIZE))
+    finally:
+        resp.release_conn()
+
+    if cached:
+        cache_put(key, obj)
+    return obj
+
+# selector_string: convert a matchLabels dict into a label selector string, or
+# None if there are no labels.
+def selector_string(labels):
+    if not labels:
+        return None
+    return ','.join([ '{0}={1}'.format(k, v) for (k, v) in sorted(labels.items()) ])
+
+# owned_by: return True if an object's metadata has an owner of this kind and
+# name.
+def owned_by(md, kind, name):
+    for owner in md.get('ownerReferences', []):
+        if owner['kind'] == kind and owner['name'] == name:
+            return True
+    return False
+
+# table_rows: return the rows of a Table as (cells, metadata) pairs, where cells
+# maps column names to values.
+def table_rows(table):
+    columns = [ c['name'] for c in table['columnDefinitions'] ]
+    return [ (dict(zip(columns, row['cells'])),
+              (row.get('object') or {}).get('metadata', {}))
+                for row in table['rows'] ]
+
+# get_deployment: return the named deployment.
+def get_deployment(namespace, name):
+    if informer.enabled:
+        dp = informer.get(namespace, 'deployments', name)
+        if dp is None:
+            raise not_found('deployments.extensions', name)
+        return dp
+
     resource_path = ('/apis/extensions/v1beta1/namespaces/'
                     + namespace
                     + '/deployments/'
                     + name)
 
-    header_params = {}
-    header_params['Accept'] = api_client.select_header_accept(['application/json'])
-    header_params['Content-Type'] = api_client.select_header_content_type(['*/*'])
-    header_params.update(kubeutil.config.api_key)
+    return get_json(resource_path, cached=True)
 
-    (resp, code, header) = api_client.call_api(
-            resource_path, 'GET', {}, {}, header_params, None, [], _preload_content=False)
-    dp = json.loads(resp.data.decode('utf-8'))
+# get_replicaset: return the named replicaset.  the replicaset may only have
+# the fields in kubeproto.REPLICASET.
+def get_replicaset(namespace, name):
+    resource_path = ('/apis/extensions/v1beta1/namespaces/'
+                    + namespace
+                    + '/replicasets/'
+                    + name)
 
-    return dp
+    return get_json(resource_path, cached=True, view=kubeproto.REPLICASET)
 
 # get_replicasets: return all the active replicasets for a deployment.
-# old replicasets (with zero replicas) are not included.
+# old replicasets (with zero replicas) are not included.  the replicasets may
+# only have the fields in kubeproto.REPLICASET.
 def get_replicasets(dp):
-    ret = []
+    namespace = dp['metadata']['namespace']
+    name = dp['metadata']['name']
 
-    api_client = kubeutil.get_client()
+    if informer.enabled:
+        return [ rs for rs in informer.select(namespace, 'replicasets')
+                    if owned_by(rs['metadata'], 'Deployment', name)
+                        and rs['spec']['replicas'] != 0 ]
 
-    # We can't use the normal client API here because it returns Python objects
-    # that can't be converted back into JSON.  Instead, fetch the JSON by hand.
+    # A deployment can have a long history of old replicasets, each with a
+    # copy of the pod template.  List them as a table, which has the owner and
+    # replica count but not the template, and only fetch the active ones.
     resource_path = ('/apis/extensions/v1beta1/namespaces/'
-                    + dp['metadata']['namespace']
+                    + namespace
                     + '/replicasets')
 
-    header_params = {}
-    header_params['Accept'] = api_client.select_header_accept(['application/json'])
-    header_params['Content-Type'] = api_client.select_header_content_type(['*/*'])
-    header_params.update(kubeutil.config.api_key)
-
-    (resp, code, header) = api_client.call_api(
-            resource_path, 'GET', {}, {}, header_params, None, [], _preload_content=False)
+    query_params = { 'includeObject': 'Metadata' }
+    selector = selector_string(dp['spec'].get('selector', {}).get('matchLabels'))
+    if selector:
+        query_params['labelSelector'] = selector
 
-    rslist = json.loads(resp.data.decode('utf-8'))
+    rslist = get_json(resource_path, query_params, ACCEPT_TABLE, cached=True)
 
-    for rs in rslist['items']:
-        md = rs['metadata']
+    # If the server doesn't support tables, we already have the objects.
+    if rslist.get('kind') != 'Table':
+        return [ rs for rs in rslist['items']
+                    if owned_by(rs['metadata'], 'Deployment', name)
+                        and rs['spec']['replicas'] != 0 ]
 
-        # Check if this RS is owned by the correct deployment.
-        if 'ownerReferences' not in md:
+    ret = []
+    for (cells, md) in table_rows(rslist):
+        if not owned_by(md, 'Deployment', name):
             continue
-        has_owner = False
-        for owner in md['ownerReferences']:
-            if owner['kind'] == 'Deployment' and owner['name'] == dp['metadata']['name']:
-                has_owner = True
-                break
-        if not has_owner:
+        if cells.get('Desired') == 0:
             continue
 
-        if rs['spec']['replicas'] == 0:
-            continue
+        try:
+            rs = get_replicaset(namespace, md['name'])
+        except Exception as e:
+            # Deleted since we listed it.
+            if kubeutil.get_status(e) == 404:
+                continue
+            raise
 
-        ret.append(rs)
+        if rs['spec']['replicas'] != 0:
+            ret.append(rs)
 
     return ret
 
-
-# get_rs_pods: get all the pods for a replicaset.
+# get_rs_pods: get all the pods for a replicaset.  the pods may only have the
+# fields in kubeproto.POD.
 def get_rs_pods(rs):
-    ret = []
+    namespace = rs['metadata']['namespace']
+    name = rs['metadata']['name']
 
-    api_client = kubeutil.get_client()
+    if informer.enabled:
+        pods = informer.select(namespace, 'pods')
+    else:
+        # The replicaset's selector includes its pod-template-hash label, so
+        # this only returns its own pods.
+        resource_path = ('/api/v1/namespaces/'
+                        + namespace
+                        + '/pods')
 
-    # We can't use the normal client API here because it returns Python objects
-    # that can't be converted back into JSON.  Instead, fetch the JSON by hand.
-    resource_path = ('/api/v1/namespaces/'
-                    + rs['metadata']['namespace']
-                    + '/pods')
+        query_params = {}
+        selector = selector_string(rs['spec'].get('selector', {}).get('matchLabels'))
+        if selector:
+            query_params['labelSelector'] = selector
 
-    header_params = {}
-    header_params['Accept'] = api_client.select_header_accept(['application/json'])
-    header_params['Content-Type'] = api_client.select_header_content_type(['*/*'])
-    header_params.update(kubeutil.config.api_key)
+        podlist = get_json(resource_path, query_params, view=kubeproto.POD_LIST)
+        pods = podlist.get('items', [])
 
-    (resp, code, header) = api_client.call_api(
-            resource_path, 'GET', {}, {}, header_params, None, [], _preload_content=False)
+    return [ pod for pod in pods
+                if owned_by(pod['metadata'], 'ReplicaSet', name) ]
+
+
+# get_deployments: return all deployments in a namespace, optionally filtered
+# by a label selector.  if metadata_only is True, the deployments may only
+# have their metadata.
+def get_deployments(namespace, label_selector=None, metadata_only=False):
+    if informer.enabled:
+        terms = informer.parse_selector(label_selector)
+        if terms is not None:
+            return informer.select(namespace, 'deployments', terms)
+
+    resource_path = ('/apis/extensions/v1beta1/namespaces/'
+                    + namespace
+                    + '/deployments')
+
+    query_params = {}
+    if label_selector:
+        query_params['labelSelector'] = label_selector
+
+    accept = ACCEPT_METADATA if metadata_only else 'application/json'
+    return get_json(resource_path, query_params, accept)['items']
+
+
+# get_namespace_replicasets: return all replicasets in a namespace, grouped by
+# the name of the deployment that owns them.  unlike get_replicasets, this
+# includes old replicasets with zero replicas.  the replicasets may only have
+# their metadata.
+def get_namespace_replicasets(namespace):
+    ret = {}
+
+    if informer.enabled:
+        replicasets = informer.select(namespace, 'replicasets')
+    else:
+        resource_path = ('/apis/extensions/v1beta1/namespaces/'
+                        + namespace
+                        + '/replicasets')
+        replicasets = get_json(resource_path, accept=ACCEPT_METADATA)['items']
 
-    podlist = json.loads(resp.data.decode('utf-8'))
-    for pod in podlist['items']:
-        md = pod['metadata']
-        if 'ownerReferences' not in md:
+    for rs in replicasets:
+        for owner in rs['metadata'].get('ownerReferences', []):
+            if owner['kind'] == 'Deployment':
+                ret.setdefault(owner['name'], []).append(rs)
+
+    return ret
+
+
+# The label deploy puts on every object it creates for an application, set to
+# the application's name, so the objects can be found again.
+APP_LABEL = 'kdtool.torchbox.com/app'
+
+# Attached resources with this label set to "true" are no use without the
+# application, so undeploy always deletes them with it.
+DEPENDENT_LABEL = 'kdtool.torchbox.com/dependent'
+
+# The kinds of resource that can be attached to an application, as (kind,
+# API group, resource type).
+ATTACHED_KINDS = (
+    ('volume',           'api/v1',                   'persistentvolumeclaims'),
+    ('secret',           'api/v1',                   'secrets'),
+    ('service',          'api/v1',                   'services'),
+    ('ingress',          'apis/extensions/v1beta1',  'ingresses'),
+    ('autoscaler',       'apis/autoscaling/v1',      'horizontalpodautoscalers'),
+    ('disruptionbudget', 'apis/policy/v1beta1',      'poddisruptionbudgets'),
+    ('deployment',       'apis/extensions/v1beta1',  'deployments'),
+    ('database',         'apis/torchbox.com/v1',     'databases'),
+)
+
+# Attached resources found for each application during this command; see
+# get_attached_resources.
+attached_cache = {}
+
+# reset_command_cache: forget what the previous command found.  called before
+# each command.
+def reset_command_cache():
+    with cache_lock:
+        attached_cache.clear()
+
+# get_legacy_resources: return the attached resources recorded in a
+# deployment's kdtool.torchbox.com/attached-resources annotation, which was
+# written by versions of kdtool before APP_LABEL.  raises ValueError if the
+# annotation can't be decoded.
+def get_legacy_resources(dp):
+    try:
+        annotation = dp['metadata']['annotations']['kdtool.torchbox.com/attached-resources']
+    except KeyError:
+        return []
+
+    kinds = [ k[0] for k in ATTACHED_KINDS ]
+    return [ { 'kind': res['kind'], 'name': res['name'] }
+                for res in json.loads(annotation) if res['kind'] in kinds ]
+
+# list_attached: list every labelled attached resource of each kind, with
+# the label selector.  returns a dict mapping application names to lists of
+# { 'kind', 'name', 'object' } entries.  accept is passed to the list
+# requests, e.g. to fetch only metadata.
+async def list_attached(client, namespace, selector, accept=None):
+    import asyncio, kubeasync
+
+    async def list_kind(kind, api, resource):
+        try:
+            objlist = await client.list(kubeasync.path(api, namespace, resource),
+                                        label_selector=selector, accept=accept)
+        except Exception as e:
+            # Databases are a custom resource, which might not be installed.
+            if kind == 'database' and kubeutil.get_status(e) == 404:
+                return []
+            raise
+        return [ (kind, obj) for obj in objlist['items'] ]
+
+    lists = await asyncio.gather(*[ list_kind(*k) for k in ATTACHED_KINDS ])
+
+    ret = {}
+    for (kind, obj) in [ entry for objs in lists for entry in objs ]:
+        app = obj['metadata'].get('labels', {}).get(APP_LABEL)
+        # The application's own Deployment is labelled too.
+        if kind == 'deployment' and obj['metadata']['name'] == app:
             continue
+        ret.setdefault(app, []).append({
+            'kind': kind,
+            'name': obj['metadata']['name'],
+            'object': obj,
+        })
+    return ret
 
-        has_owner = False
+# get_attached_resources: return the resources attached to a deployment, as a
+# list of { 'kind', 'name', 'object' } entries.  they are found by APP_LABEL,
+# with one list request per kind run concurrently; resources named in the
+# annotation written by older versions are fetched by name at the same time.
+# if one of those can't be loaded, its entry has an 'error' instead of an
+# 'object'.  raises ValueError if the annotation can't be decoded.  the result
+# is cached for the rest of the command.
+def get_attached_resources(dp):
+    import kubeasync
 
-        for owner in md['ownerReferences']:
-            if owner['kind'] != 'ReplicaSet':
-                continue
-            if owner['name'] != rs['metadata']['name']:
-                continue
-            has_owner = True
-            break
+    namespace = dp['metadata']['namespace']
+    name = dp['metadata']['name']
+    with cache_lock:
+        if (namespace, name) in attached_cache:
+            return attached_cache[(namespace, name)]
+
+    legacy = get_legacy_resources(dp)
+    paths = { kind: (api, resource) for (kind, api, resource) in ATTACHED_KINDS }
+    client = kubeasync.client()
+
+    results = kubeasync.gather(
+        list_attached(client, namespace, '{0}={1}'.format(APP_LABEL, name)),
+        *[ client.get(kubeasync.path(paths[res['kind']][0], namespace,
+                                     paths[res['kind']][1], res['name']))
+            for res in legacy ],
+        return_exceptions=True)
 
-        if not has_owner:
+    if isinstance(results[0], Exception):
+        raise results[0]
+    ret = results[0].get(name, [])
+
+    # Anything in the annotation that isn't labelled yet.
+    found = set([ (res['kind'], res['name']) for res in ret ])
+    for (res, obj) in zip(legacy, results[1:]):
+        if (res['kind'], res['name']) in found:
             continue
+        if isinstance(obj, Exception):
+            res['error'] = obj
+        else:
+            res['object'] = obj
+        ret.append(res)
 
-        ret.append(pod)
+    order = [ k[0] for k in ATTACHED_KINDS ]
+    ret.sort(key=lambda res: (order.index(res['kind']), res['name']))
 
+    with cache_lock:
+        attached_cache[(namespace, name)] = ret
     return ret
+
+# get_namespace_attached_resources: return the labelled attached resources of
+# every application in a namespace, as a dict mapping application names to
+# lists of entries as for get_attached_resources, except that the objects may
+# only have their metadata.  this takes one list request per kind however many
+# applications there are.
+def get_namespace_attached_resources(namespace):
+    import kubeasync
+    return kubeasync.call(list_attached(kubeasync.client(), namespace, APP_LABEL,
+                                        ACCEPT_METADATA))
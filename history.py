@@ -0,0 +1,340 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Rollout timing history.  With "deploy --wait", kdtool waits for the rollout
+# to finish, works out how long each phase of it took, and records that in an
+# annotation on the Deployment, so the history is kept with the application
+# rather than on whichever machine (often a CI runner) ran the deploy.  Only
+# the most recent HISTORY_SIZE rollouts are kept.  "kdtool history" reports
+# percentiles from it.
+#
+# The phases of a rollout are:
+#
+#   apply       running kubectl apply
+#   schedule    the new ReplicaSet being created until its first pod is
+#               scheduled
+#   pull        the first pod being scheduled until a container first starts,
+#               which is mostly pulling the image
+#   ready       the first container starting until the first pod is ready
+#   available   the first new pod being ready until the last one is
+#
+# Apply is timed locally; the others come from timestamps on the ReplicaSet
+# and the pods' conditions, so the local clock doesn't matter, but they only
+# have a resolution of one second.
+
+import calendar, json, math, time
+from sys import stdout, stderr, exit
+
+import deployment, kubeutil
+from manifest import manifest_items
+
+HISTORY_ANNOTATION = 'kdtool.torchbox.com/rollout-history'
+REVISION_ANNOTATION = 'deployment.kubernetes.io/revision'
+
+# How many rollouts to keep.  each takes about 150 bytes of the annotation.
+HISTORY_SIZE = 50
+
+PHASES = ('apply', 'schedule', 'pull', 'ready', 'available')
+PERCENTILES = (50, 95, 99)
+
+# How often to check the deployment while waiting for a rollout.
+WAIT_INTERVAL = 2
+
+# parse_time: convert a Kubernetes timestamp to seconds since the epoch.
+def parse_time(ts):
+    return calendar.timegm(time.strptime(ts, '%Y-%m-%dT%H:%M:%SZ'))
+
+# format_time: the reverse of parse_time.
+def format_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+# get_history: return the rollouts recorded on a deployment, oldest first.
+# raises ValueError if the annotation can't be decoded.
+def get_history(dp):
+    annotation = dp['metadata'].get('annotations', {}).get(HISTORY_ANNOTATION)
+    if not annotation:
+        return []
+    return json.loads(annotation)
+
+# rollout_status: check whether a deployment's rollout has finished.  returns
+# (done, error), where error is the reason the rollout failed, if it has.
+def rollout_status(dp):
+    replicas = dp['spec'].get('replicas', 1)
+    st = dp.get('status', {})
+
+    # The controller hasn't seen the new spec yet.
+    if st.get('observedGeneration', 0) < dp['metadata'].get('generation', 0):
+        return (False, None)
+
+    for condition in st.get('conditions', []):
+        if condition['type'] == 'Progressing' \
+                and condition.get('reason') == 'ProgressDeadlineExceeded':
+            return (False, condition.get('message') or 'progress deadline exceeded')
+
+    updated = st.get('updatedReplicas', 0)
+    done = (updated >= replicas
+            and st.get('replicas', 0) == updated
+            and st.get('availableReplicas', 0) >= replicas)
+    return (done, None)
+
+# wait_rollout: wait until a deployment's rollout has finished, printing its
+# progress.  returns the deployment, or None on timeout; exits if the rollout
+# fails.
+def wait_rollout(namespace, name, timeout):
+    deadline = time.time() + timeout
+    last = None
+
+    stdout.write('waiting for rollout of deployment {0}/{1}...\n'.format(
+        namespace, name))
+
+    while True:
+        # Anything cached is stale by now.
+        deployment.clear_cache()
+        dp = deployment.get_deployment(namespace, name)
+        (done, error) = rollout_status(dp)
+
+        if error:
+            stderr.write('rollout of deployment {0}/{1} failed: {2}\n'.format(
+                namespace, name, error))
+            exit(1)
+
+        st = dp.get('status', {})
+        progress = '  {0}/{1} updated, {2} available'.format(
+            st.get('updatedReplicas', 0), dp['spec'].get('replicas', 1),
+            st.get('availableReplicas', 0))
+        if progress != last:
+            stdout.write(progress + '\n')
+            last = progress
+
+        if done:
+            return dp
+        if time.time() >= deadline:
+            return None
+
+        time.sleep(WAIT_INTERVAL)
+
+# rollout_timings: work out the phase timings of a finished rollout from its
+# ReplicaSet and pods.  returns a history entry, or None if the timestamps
+# aren't there.
+def rollout_timings(dp, apply_start, apply_end):
+    revision = dp['metadata'].get('annotations', {}).get(REVISION_ANNOTATION)
+    replicasets = [ rs for rs in deployment.get_replicasets(dp)
+                        if rs['metadata'].get('annotations', {})
+                            .get(REVISION_ANNOTATION) == revision ]
+    if not replicasets:
+        return None
+
+    rs = replicasets[0]
+    created = parse_time(rs['metadata']['creationTimestamp'])
+
+    scheduled = []
+    started = []
+    ready = []
+    for pod in deployment.get_rs_pods(rs):
+        status = pod.get('status', {})
+        for condition in status.get('conditions', []):
+            if condition.get('status') != 'True' or 'lastTransitionTime' not in condition:
+                continue
+            if condition['type'] == 'PodScheduled':
+                scheduled.append(parse_time(condition['lastTransitionTime']))
+            elif condition['type'] == 'Ready':
+                ready.append(parse_time(condition['lastTransitionTime']))
+
+        for cs in status.get('containerStatuses', []):
+            running = cs.get('state', {}).get('running', {})
+            if 'startedAt' in running:
+                started.append(parse_time(running['startedAt']))
+
+    if not (scheduled and started and ready):
+        return None
+
+    # A pod that restarted has a later start time than its first one, so
+    # clamp each phase at zero.
+    times = [ created, min(scheduled), min(started), min(ready), max(ready) ]
+    entry = {
+        'time': format_time(apply_start),
+        'revision': revision,
+        'image': rs['spec']['template']['spec']['containers'][0]['image'],
+        'apply': round(apply_end - apply_start, 1),
+    }
+    for (phase, start, end) in zip(PHASES[1:], times, times[1:]):
+        entry[phase] = max(0, end - start)
+    entry['total'] = entry['apply'] + max(0, times[-1] - created)
+    return entry
+
+# record_rollout: add a rollout to a deployment's history.
+def record_rollout(namespace, name, entry):
+    import kubeasync
+
+    deployment.clear_cache()
+    dp = deployment.get_deployment(namespace, name)
+    try:
+        rollouts = get_history(dp)
+    except ValueError:
+        # Start again rather than failing every deploy.
+        rollouts = []
+
+    rollouts = (rollouts + [ entry ])[-HISTORY_SIZE:]
+    kubeasync.sync_client().patch(
+        kubeasync.path('apis/extensions/v1beta1', namespace, 'deployments', name),
+        { 'metadata': { 'annotations': {
+            HISTORY_ANNOTATION: json.dumps(rollouts, separators=(',', ':')),
+        } } })
+    deployment.clear_cache()
+
+# get_revision: return the current revision of a deployment, or None if it
+# doesn't exist yet.
+def get_revision(namespace, name):
+    try:
+        dp = deployment.get_deployment(namespace, name)
+    except Exception as e:
+        if kubeutil.get_status(e) == 404:
+            return None
+        raise
+    return dp['metadata'].get('annotations', {}).get(REVISION_ANNOTATION)
+
+# wait_and_record: wait for the rollout of one deployment and record its
+# timings.  returns the exit status.
+def wait_and_record(namespace, name, before, apply_start, apply_end, timeout):
+    dp = wait_rollout(namespace, name, timeout)
+    if dp is None:
+        stderr.write('timed out waiting for rollout of deployment {0}\n'.format(
+            name))
+        return 1
+
+    # Applying an unchanged manifest doesn't start a rollout.
+    if dp['metadata'].get('annotations', {}).get(REVISION_ANNOTATION) == before:
+        stdout.write('rollout complete (nothing changed)\n')
+        return 0
+
+    entry = rollout_timings(dp, apply_start, apply_end)
+    if entry is None:
+        stdout.write('rollout complete (no timings available)\n')
+        return 0
+
+    stdout.write('rollout complete in {0}: {1}\n'.format(
+        format_duration(entry['total']),
+        ', '.join([ '{0} {1}'.format(phase, format_duration(entry[phase]))
+                        for phase in PHASES ])))
+
+    record_rollout(namespace, name, entry)
+    return 0
+
+# apply_and_wait: apply a manifest with kubectl, wait for the rollouts of the
+# deployments in it to finish and record how long they took.  returns the
+# exit status.
+def apply_and_wait(spec, args):
+    import kubectl
+
+    names = [ item['metadata']['name'] for item in manifest_items(spec)
+                if item.get('kind') == 'Deployment' ]
+    before = {}
+    for name in names:
+        try:
+            before[name] = get_revision(args.namespace, name)
+        except Exception as e:
+            stderr.write('cannot load deployment {0}: {1}\n'.format(
+                name, kubeutil.get_error(e)))
+            return 1
+
+    apply_start = time.time()
+    status = kubectl.apply_manifest(spec, args)
+    apply_end = time.time()
+    if status != 0:
+        return status
+
+    for name in names:
+        try:
+            status = wait_and_record(args.namespace, name, before[name],
+                                     apply_start, apply_end, args.timeout)
+        except Exception as e:
+            stderr.write('cannot check rollout of deployment {0}: {1}\n'.format(
+                name, kubeutil.get_error(e)))
+            return 1
+
+        if status != 0:
+            return status
+
+    return 0
+
+# percentile: the p'th percentile of a list of values, by the nearest-rank
+# method.
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def format_duration(seconds):
+    return '{0:.1f}s'.format(seconds)
+
+# history: report rollout timings for deployments.
+def history(args):
+    for name in args.name:
+        try:
+            dp = deployment.get_deployment(args.namespace, name)
+            rollouts = get_history(dp)
+        except ValueError as e:
+            stderr.write('{0}: could not decode {1} annotation: {2}\n'.format(
+                name, HISTORY_ANNOTATION, str(e)))
+            exit(1)
+        except Exception as e:
+            stderr.write('cannot load deployment {0}: {1}\n'.format(
+                name, kubeutil.get_error(e)))
+            exit(1)
+
+        stdout.write('deployment {0}/{1}:\n'.format(
+            dp['metadata']['namespace'], name))
+
+        if not rollouts:
+            stdout.write('  no rollouts recorded (use "deploy --wait")\n\n')
+            continue
+
+        stdout.write('  {0} rollouts since {1}\n\n'.format(
+            len(rollouts), rollouts[0]['time']))
+
+        stdout.write('  {0:<10}'.format('phase') + ''.join([
+            '{0:>9}'.format('p' + str(p)) for p in PERCENTILES ]) + '{0:>9}\n'.format('max'))
+
+        for phase in PHASES + ('total',):
+            values = [ r[phase] for r in rollouts if phase in r ]
+            stdout.write('  {0:<10}'.format(phase) + ''.join([
+                '{0:>9}'.format(format_duration(percentile(values, p)))
+                    for p in PERCENTILES ]) + '{0:>9}\n'.format(format_duration(max(values))))
+
+        slowest = max(PHASES, key=lambda phase:
+                        percentile([ r[phase] for r in rollouts ], 50))
+        stdout.write('\n  slowest phase: {0} (p50 {1})\n'.format(
+            slowest, format_duration(percentile([ r[slowest] for r in rollouts ], 50))))
+
+        if args.recent:
+            stdout.write('\n  recent rollouts:\n')
+            for r in rollouts[-args.recent:]:
+                stdout.write('    {0}  revision {1:<4} {2:>8}  {3}\n'.format(
+                    r['time'], r.get('revision') or '?',
+                    format_duration(r['total']), r.get('image', '?')))
+
+        stdout.write('\n')
+
+history.help = "show rollout timing history"
+history.arguments = (
+    ( ('-r', '--recent'), {
+        'type': int,
+        'default': 5,
+        'metavar': 'N',
+        'help': 'also list the N most recent rollouts (0 for none)',
+    }),
+    ( ('name',), {
+        'type': str,
+        'nargs': '+',
+        'help': 'deployment name',
+    }),
+)
+
+commands = {
+    'history': history,
+}
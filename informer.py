@@ -0,0 +1,238 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# A local cache of the Deployments, ReplicaSets and Pods in a namespace, in the
+# style of a client-go informer.  It is enabled with --object-cache (or
+# $KDTOOL_OBJECT_CACHE), and deployment.get_* then read from it.
+#
+# The first time a namespace is used, each resource type is listed in full.
+# The objects and the list's resourceVersion are then written to a compressed
+# snapshot in the cache directory.  Later runs load the snapshot and watch from
+# its resourceVersion, so they only fetch what has changed since.  If the
+# server has compacted that version away it answers 410 Gone, and we fall back
+# to listing again.
+#
+# A watch never says when it has caught up, so we stop reading once the server
+# has been quiet for IDLE_TIMEOUT.  An event delivered later than that is seen
+# by the next run instead, since the snapshot's resourceVersion never advances
+# past an event we haven't applied.
+
+import gzip, hashlib, json, os, threading
+
+import kubeutil, tracing
+
+# The API group for each resource type we cache.
+RESOURCES = {
+    'deployments':  'apis/extensions/v1beta1',
+    'replicasets':  'apis/extensions/v1beta1',
+    'pods':         'api/v1',
+}
+
+# How long to wait for the next event before deciding a watch has caught up.
+IDLE_TIMEOUT = 0.2
+
+# Ask the server to end a resumed watch after this long in any case.
+WATCH_TIMEOUT = 30
+
+enabled = False
+stores = {}
+stores_lock = threading.Lock()
+
+# configure: enable or disable the cache for this command.  objects already in
+# memory (in "kdtool serve") are kept, but are brought up to date again before
+# they are next read.
+def configure(args):
+    global enabled
+    enabled = bool(getattr(args, 'object_cache', False)
+                   or os.environ.get('KDTOOL_OBJECT_CACHE'))
+    invalidate()
+
+# invalidate: mark every store as needing to catch up before its next read;
+# called after we change something in the cluster.
+def invalidate():
+    with stores_lock:
+        for store in stores.values():
+            store.synced = False
+
+# strip: remove metadata we never use from an object, to keep the snapshot
+# small.
+def strip(obj):
+    md = obj.get('metadata', {})
+    md.pop('managedFields', None)
+    md.get('annotations', {}).pop(
+        'kubectl.kubernetes.io/last-applied-configuration', None)
+    return obj
+
+# Store: the cached objects of one resource type in one namespace.
+class Store(object):
+    def __init__(self, host, namespace, resource):
+        self.namespace = namespace
+        self.resource = resource
+        self.path = '/{0}/namespaces/{1}/{2}'.format(
+            RESOURCES[resource], namespace, resource)
+        self.objects = {}
+        self.resource_version = None
+        self.loaded = False
+        self.synced = False
+        self.dirty = False
+
+        key = '\0'.join((host, namespace, resource)).encode('utf-8')
+        self.filename = os.path.join(kubeutil.cache_dir(),
+            'objects-' + hashlib.sha256(key).hexdigest()[:32] + '.json.gz')
+
+    # load: read the snapshot from disk, if there is a usable one.
+    def load(self):
+        self.loaded = True
+        try:
+            with gzip.open(self.filename, 'rb') as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+            items = snapshot['items']
+            resource_version = snapshot['resourceVersion']
+        except (OSError, EOFError, ValueError, KeyError):
+            return
+
+        self.objects = { obj['metadata']['name']: obj for obj in items }
+        self.resource_version = resource_version
+
+    # save: write the snapshot to disk if anything has changed.
+    def save(self):
+        if not self.dirty:
+            return
+
+        snapshot = {
+            'resourceVersion': self.resource_version,
+            'items': list(self.objects.values()),
+        }
+        data = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+        kubeutil.write_private(self.filename, gzip.compress(data, 1))
+        self.dirty = False
+
+    # apply: apply one watch event.
+    def apply(self, kind, obj):
+        version = obj.get('metadata', {}).get('resourceVersion')
+
+        if kind in ('ADDED', 'MODIFIED'):
+            self.objects[obj['metadata']['name']] = strip(obj)
+        elif kind == 'DELETED':
+            self.objects.pop(obj['metadata']['name'], None)
+
+        if version:
+            self.resource_version = version
+        self.dirty = True
+
+    # relist: replace the contents of the store with a full list.
+    async def relist(self, client):
+        with tracing.span('cache', 'list ' + self.resource):
+            objlist = await client.list(self.path)
+
+        self.objects = { obj['metadata']['name']: strip(obj)
+                            for obj in objlist['items'] }
+        self.resource_version = objlist['metadata']['resourceVersion']
+        self.dirty = True
+
+    # catch_up: apply every change since our resourceVersion.  raises
+    # kubeutil.ApiError with status 410 if that version is too old.
+    async def catch_up(self, client):
+        import asyncio
+
+        watch = client.watch(self.path, resource_version=self.resource_version,
+                             timeout=WATCH_TIMEOUT, bookmarks=True)
+        with tracing.span('cache', 'watch ' + self.resource) as attrs:
+            events = 0
+            try:
+                await watch.start()
+                while True:
+                    try:
+                        (kind, obj) = await asyncio.wait_for(watch.__anext__(),
+                                                             IDLE_TIMEOUT)
+                    except (asyncio.TimeoutError, StopAsyncIteration):
+                        break
+                    self.apply(kind, obj)
+                    events += 1
+            finally:
+                watch.close()
+            attrs['events'] = events
+
+    # sync: bring the store up to date.
+    async def sync(self, client):
+        if not self.loaded:
+            self.load()
+
+        if self.resource_version is not None:
+            try:
+                await self.catch_up(client)
+                self.synced = True
+                return
+            except kubeutil.ApiError as e:
+                if e.status != 410:
+                    raise
+
+        await self.relist(client)
+        self.synced = True
+
+# get_store: return the up-to-date store for a resource type in a namespace.
+# all the resource types for the namespace are brought up to date together,
+# since a command that needs one usually needs the others.
+def get_store(namespace, resource):
+    import kubeasync
+
+    host = kubeutil.get_config().host
+    with stores_lock:
+        for res in RESOURCES:
+            key = (host, namespace, res)
+            if key not in stores:
+                stores[key] = Store(host, namespace, res)
+
+        pending = [ stores[(host, namespace, res)] for res in RESOURCES
+                        if not stores[(host, namespace, res)].synced ]
+        if pending:
+            client = kubeasync.client()
+            kubeasync.gather(*[ store.sync(client) for store in pending ])
+            for store in pending:
+                try:
+                    store.save()
+                except OSError:
+                    # The snapshot is only an optimisation.
+                    pass
+
+        return stores[(host, namespace, resource)]
+
+# get: return a cached object, or None if it doesn't exist.
+def get(namespace, resource, name):
+    return get_store(namespace, resource).objects.get(name)
+
+# parse_selector: parse a label selector into a list of (key, op, value)
+# terms.  only equality-based selectors ("a=b,c!=d") are supported; returns
+# None for anything else, so the caller can ask the server instead.
+def parse_selector(selector):
+    terms = []
+    for term in (selector or '').split(','):
+        if not term.strip():
+            continue
+        for op in ('!=', '==', '='):
+            if op in term:
+                (k, v) = term.split(op, 1)
+                break
+        else:
+            return None
+
+        (k, v) = (k.strip(), v.strip())
+        if not k or any(c in k + v for c in '!=() '):
+            return None
+        terms.append((k, op != '!=', v))
+
+    return terms
+
+# select: return all cached objects of a resource type that match terms from
+# parse_selector.
+def select(namespace, resource, terms=()):
+    objects = get_store(namespace, resource).objects.values()
+    return [ obj for obj in objects
+                if all((obj['metadata'].get('labels', {}).get(k) == v) == equal
+                        for (k, equal, v) in terms) ]
@@ -0,0 +1,267 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Incremental JSON parsing for API responses.  A list response is an object
+# whose "items" (or a Table's "rows") can run to hundreds of megabytes; rather
+# than reading the whole body, decoding it to a string and then parsing it,
+# Parser is fed the body a chunk at a time and parses each element of a
+# top-level array as soon as it has arrived, so only the parsed objects and
+# the current chunk are held in memory.  Each element (and every other
+# top-level value) is still parsed by the json module's C scanner.
+#
+# The scanner only shares identical dict keys between the objects parsed in
+# one call, so where possible all the complete elements in the buffer are
+# parsed together as one array; otherwise every element would have its own
+# copy of "metadata", "name" and so on, which for a large list costs more
+# memory than the response body.
+
+import codecs, json
+
+decoder = json.JSONDecoder()
+
+WHITESPACE = ' \t\n\r'
+
+# What can follow a complete value.
+DELIMITERS = WHITESPACE + ',]}'
+
+# Parser states.
+(START, VALUE_ONLY, FIRST_KEY, KEY, COLON, VALUE, FIRST_ITEM, ITEM,
+ AFTER_ITEM, AFTER_VALUE, DONE) = range(11)
+
+# Returned by Parser.value when it needs more input.
+MORE = object()
+
+# Parser: an incremental parser.  call feed() with each chunk of the body,
+# then close() to get the parsed value.  raises ValueError for invalid JSON.
+class Parser(object):
+    def __init__(self):
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.state = START
+        self.result = None
+        self.key = None
+        self.items = None
+
+        # What the text between two elements of the current array looks
+        # like, if we know; see batch().
+        self.separator = None
+
+        # Don't try to parse an incomplete value again until the buffer has
+        # this many characters from pos, so a value larger than a chunk isn't
+        # parsed over and over as it arrives.
+        self.wanted = 0
+
+    def feed(self, data):
+        # Drop what we've already parsed.
+        self.buf = self.buf[self.pos:] + self.utf8.decode(data)
+        self.pos = 0
+        self.parse()
+
+    def close(self):
+        self.buf = self.buf[self.pos:] + self.utf8.decode(b'', True)
+        self.pos = 0
+        self.eof = True
+        self.parse()
+
+        if self.state != DONE:
+            raise ValueError('unexpected end of JSON input')
+        return self.result
+
+    # peek: skip whitespace and return the next character, or None if we need
+    # more input.
+    def peek(self):
+        buf = self.buf
+        pos = self.pos
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+        self.pos = pos
+
+        if pos < len(buf):
+            return buf[pos]
+        return None
+
+    # value: parse a complete value at pos, or return MORE.
+    def value(self):
+        available = len(self.buf) - self.pos
+        if not self.eof and available < self.wanted:
+            return MORE
+
+        try:
+            (obj, end) = decoder.raw_decode(self.buf, self.pos)
+        except ValueError:
+            if self.eof:
+                raise
+            end = None
+
+        # A value at the end of the buffer might continue in the next chunk,
+        # so only accept it if something follows.  a number can also stop
+        # early: "2e" decodes as 2 when the next chunk is "3", so only accept a
+        # number once a delimiter follows it.
+        if end is not None and not self.eof:
+            if end == len(self.buf):
+                end = None
+            elif isinstance(obj, (int, float)) and not isinstance(obj, bool) \
+                    and self.buf[end] not in DELIMITERS:
+                end = None
+
+        if end is not None:
+            self.pos = end
+            self.wanted = 0
+            return obj
+
+        self.wanted = 2 * available
+        return MORE
+
+    # batch: parse every complete element of the current array that is in
+    # the buffer, in one call.  returns a list of elements, or None if that
+    # isn't possible.
+    #
+    # Elements of an API list are objects whose first key is the same, so the
+    # last complete element in the buffer is probably followed by the
+    # separator learned from the first one, e.g. '},{"metadata":'.  That text
+    # could also separate objects in an array nested inside an element, so we
+    # only accept the batch if it parses as a complete array by itself, which
+    # can only happen if it ends between two elements of the real array.
+    def batch(self):
+        if self.separator is None:
+            return None
+
+        cut = self.buf.rfind(self.separator, self.pos)
+        if cut < 0:
+            return None
+
+        text = '[' + self.buf[self.pos:cut + 1] + ']'
+        try:
+            (objs, end) = decoder.raw_decode(text)
+        except ValueError:
+            end = None
+
+        if end != len(text):
+            # This list doesn't look like we expected; don't try again.
+            self.separator = None
+            return None
+
+        self.pos = cut + 1
+        return objs
+
+    # learn: remember the separator for batch() from the first element of an
+    # array.
+    def learn(self, obj):
+        self.separator = None
+        if isinstance(obj, dict) and obj:
+            key = next(iter(obj))
+            self.separator = '},{' + json.dumps(key, ensure_ascii=False) + ':'
+
+    # expect: consume the character c, or raise ValueError.
+    def expect(self, c, expected):
+        if c not in expected:
+            raise ValueError('invalid JSON: expected {0} at {1!r}'.format(
+                ' or '.join(expected), self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    # parse: make as much progress as possible with the input we have.
+    def parse(self):
+        while True:
+            c = self.peek()
+            if c is None:
+                return
+
+            state = self.state
+            if state == START:
+                if c == '{':
+                    self.pos += 1
+                    self.result = {}
+                    self.state = FIRST_KEY
+                else:
+                    self.state = VALUE_ONLY
+
+            elif state == VALUE_ONLY:
+                obj = self.value()
+                if obj is MORE:
+                    return
+                self.result = obj
+                self.state = DONE
+
+            elif state in (FIRST_KEY, KEY):
+                if c == '}' and state == FIRST_KEY:
+                    self.pos += 1
+                    self.state = DONE
+                    continue
+
+                if c != '"':
+                    self.expect(c, ['"'])
+                key = self.value()
+                if key is MORE:
+                    return
+                self.key = key
+                self.state = COLON
+
+            elif state == COLON:
+                self.expect(c, [':'])
+                self.state = VALUE
+
+            elif state == VALUE:
+                if c == '[':
+                    self.pos += 1
+                    self.items = []
+                    self.result[self.key] = self.items
+                    self.state = FIRST_ITEM
+                    continue
+
+                obj = self.value()
+                if obj is MORE:
+                    return
+                self.result[self.key] = obj
+                self.state = AFTER_VALUE
+
+            elif state == FIRST_ITEM:
+                if c == ']':
+                    self.pos += 1
+                    self.state = AFTER_VALUE
+                    continue
+
+                obj = self.value()
+                if obj is MORE:
+                    return
+                self.items.append(obj)
+                self.learn(obj)
+                self.state = AFTER_ITEM
+
+            elif state == ITEM:
+                objs = self.batch()
+                if objs:
+                    self.items.extend(objs)
+                    self.state = AFTER_ITEM
+                    continue
+
+                obj = self.value()
+                if obj is MORE:
+                    return
+                self.items.append(obj)
+                self.state = AFTER_ITEM
+
+            elif state == AFTER_ITEM:
+                self.expect(c, [',', ']'])
+                self.state = ITEM if c == ',' else AFTER_VALUE
+
+            elif state == AFTER_VALUE:
+                self.expect(c, [',', '}'])
+                self.state = KEY if c == ',' else DONE
+
+            else:
+                raise ValueError('invalid JSON: extra data after value')
+
+# load: parse JSON from an iterable of bytes chunks.
+def load(chunks):
+    parser = Parser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
@@ -0,0 +1,515 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# An asyncio-based Kubernetes API client, so commands can overlap many API
+# requests on one thread.  It uses the credentials loaded by kubeutil, and the
+# same rate limit, retry policy and tracing as the kubernetes client.
+#
+# The HTTP client is a small HTTP/1.1 implementation on asyncio streams with a
+# pool of keep-alive connections; it is written against the standard library
+# only so that it works from inside the kdtool.pyz zipapp.
+#
+# Coroutines run on an event loop in a background thread.  Synchronous code
+# can use them through call() and gather(), or through SyncClient, which has
+# the same methods as Client but blocks until they complete:
+#
+#   client = kubeasync.sync_client()
+#   dp = client.get(kubeasync.path('apis/extensions/v1beta1', ns, 'deployments', name))
+#
+#   (svc, ing) = kubeasync.gather(
+#       kubeasync.client().get(path(..., 'services', name)),
+#       kubeasync.client().get(path(..., 'ingresses', name)))
+
+import asyncio, base64, json, ssl, threading, zlib
+from urllib.parse import urlparse, urlencode, quote
+
+import jsonstream, kubeutil, tracing
+
+# Maximum number of connections to the API server.
+MAX_CONNECTIONS = 20
+# How long to wait for the server to start responding to a request.
+REQUEST_TIMEOUT = 60
+
+USER_AGENT = 'kdtool'
+
+# path: build an API path, e.g. path('api/v1', 'default', 'pods').
+def path(api, namespace, resource, name=None):
+    p = '/{0}/namespaces/{1}/{2}'.format(api, quote(namespace), resource)
+    if name is not None:
+        p += '/' + quote(name)
+    return p
+
+# Headers: response headers, looked up case-insensitively.
+class Headers(dict):
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key.lower(), value)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+# Response: an HTTP response whose body has not been read yet.  the connection
+# is returned to the pool once the body has been read completely; close()
+# must be called if the body is abandoned.  a gzip-encoded body is
+# decompressed as it is read; nbytes counts the bytes actually received.
+class Response(object):
+    def __init__(self, session, conn, status, reason, headers, method):
+        self.session = session
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.nbytes = 0
+
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self.remaining = None
+        if method == 'HEAD' or status in (204, 304):
+            self.remaining = 0
+        elif not self.chunked and 'Content-Length' in headers:
+            self.remaining = int(headers['Content-Length'])
+
+        self.reusable = (headers.get('Connection', '').lower() != 'close'
+                         and (self.chunked or self.remaining is not None))
+        self.done = False
+
+        self.decompressor = None
+        if headers.get('Content-Encoding', '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if self.remaining == 0 and not self.chunked:
+            self.finish()
+
+    # read_chunk: return the next piece of the body, or b'' at the end.
+    async def read_chunk(self):
+        while True:
+            data = await self.read_encoded()
+            if self.decompressor is None:
+                return data
+            if not data:
+                return self.decompressor.flush()
+
+            # A chunk may be too short to produce any output.
+            data = self.decompressor.decompress(data)
+            if data:
+                return data
+
+    # read_encoded: return the next piece of the body as sent by the server.
+    async def read_encoded(self):
+        if self.done:
+            return b''
+
+        reader = self.conn[0]
+
+        if self.chunked:
+            line = await reader.readline()
+            if not line:
+                raise EOFError('connection closed in chunked response')
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Discard any trailers.
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                self.finish()
+                return b''
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)
+        elif self.remaining is not None:
+            data = await reader.read(min(self.remaining, 65536))
+            if not data:
+                raise EOFError('connection closed with {0} bytes unread'.format(
+                    self.remaining))
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                self.finish()
+        else:
+            data = await reader.read(65536)
+            if not data:
+                self.finish()
+                return b''
+
+        self.nbytes += len(data)
+        return data
+
+    # read: read the whole body.
+    async def read(self):
+        chunks = []
+        while True:
+            data = await self.read_chunk()
+            if not data:
+                return b''.join(chunks)
+            chunks.append(data)
+
+    def finish(self):
+        self.done = True
+        if self.conn is not None:
+            self.session.release(self.conn, self.reusable)
+            self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.session.release(self.conn, False)
+            self.conn = None
+        self.done = True
+
+# Session: a pool of HTTP connections to one server.
+class Session(object):
+    def __init__(self, url, ssl_context, headers):
+        u = urlparse(url)
+        self.secure = (u.scheme == 'https')
+        self.host = u.hostname
+        self.port = u.port or (443 if self.secure else 80)
+        self.prefix = u.path.rstrip('/')
+        self.ssl = ssl_context if self.secure else None
+        self.headers = headers
+        self.idle = []
+        self.slots = None
+
+    # connect: return (connection, reused), using an idle connection from the
+    # pool unless fresh is True.
+    async def connect(self, fresh=False):
+        if self.idle and not fresh:
+            return (self.idle.pop(), True)
+
+        conn = await asyncio.open_connection(self.host, self.port, ssl=self.ssl,
+            server_hostname=self.host if self.ssl else None)
+        return (conn, False)
+
+    def release(self, conn, reusable):
+        if reusable:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self.slots.release()
+
+    # send: send a request and read the response headers.
+    #
+    # The server (or a load balancer) may have closed an idle connection
+    # while it was in the pool.  if a reused connection fails before any of
+    # the response arrives, the request can't have been processed, so it is
+    # sent once more on a new connection, whatever the method; the other idle
+    # connections are probably just as old, so they are dropped.
+    async def send(self, method, path, query=None, body=None, headers=None):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(MAX_CONNECTIONS)
+        await self.slots.acquire()
+
+        target = self.prefix + path
+        if query:
+            target += '?' + urlencode(query)
+
+        all_headers = {
+            'Host': '{0}:{1}'.format(self.host, self.port),
+            'User-Agent': USER_AGENT,
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+        }
+        all_headers.update(self.headers)
+        all_headers.update(headers or {})
+
+        lines = [ '{0} {1} HTTP/1.1'.format(method, target) ]
+        for (k, v) in all_headers.items():
+            lines.append('{0}: {1}'.format(k, v))
+        if body is not None:
+            lines.append('Content-Length: {0}'.format(len(body)))
+
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        fresh = False
+        while True:
+            try:
+                (conn, reused) = await self.connect(fresh)
+            except:
+                self.slots.release()
+                raise
+
+            (reader, writer) = conn
+            try:
+                writer.write(head)
+                if body is not None:
+                    writer.write(body)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            except (ConnectionError, EOFError):
+                if not reused:
+                    self.release(conn, False)
+                    raise
+                status_line = b''
+            except:
+                self.release(conn, False)
+                raise
+
+            if status_line or not reused:
+                break
+
+            # A stale connection; keep the slot for the new one.
+            writer.close()
+            for idle in self.idle:
+                idle[1].close()
+            self.idle = []
+            fresh = True
+
+        try:
+            if not status_line:
+                raise EOFError('connection closed by server')
+            (version, status, reason) = (status_line.decode('latin-1').rstrip('\r\n')
+                                            .split(' ', 2) + [''])[:3]
+
+            resp_headers = Headers()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                (k, v) = line.decode('latin-1').split(':', 1)
+                resp_headers[k.strip()] = v.strip()
+        except:
+            self.release(conn, False)
+            raise
+
+        return Response(self, conn, int(status), reason, resp_headers, method)
+
+# Client: the asynchronous API.  each method retries transient failures and is
+# rate limited according to kubeutil's request policy.
+class Client(object):
+    def __init__(self, cfg):
+        headers = {}
+        if cfg.api_key.get('authorization'):
+            headers['Authorization'] = cfg.api_key['authorization']
+        elif getattr(cfg, 'username', None):
+            token = '{0}:{1}'.format(cfg.username, cfg.password)
+            headers['Authorization'] = 'Basic ' + \
+                base64.b64encode(token.encode('utf-8')).decode('ascii')
+
+        context = None
+        if cfg.host.startswith('https:'):
+            context = ssl.create_default_context(cafile=cfg.ssl_ca_cert or None)
+            if cfg.cert_file:
+                context.load_cert_chain(cfg.cert_file, cfg.key_file)
+            if not cfg.verify_ssl:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+
+        self.session = Session(cfg.host, context, headers)
+
+    # open: send a request, with rate limiting and retries, and return the
+    # Response for a successful status.  error responses raise
+    # kubeutil.ApiError.
+    async def open(self, method, path, query=None, body=None, headers=None):
+        attempt = 0
+        while True:
+            await asyncio.sleep(kubeutil.limiter.reserve())
+
+            try:
+                resp = await self.session.send(method, path, query, body, headers)
+                if resp.status >= 300:
+                    data = await resp.read()
+                    raise kubeutil.ApiError(resp.status, resp.reason, data, resp.headers)
+                return resp
+            except Exception as e:
+                delay = kubeutil.get_retry_delay(method, e, attempt)
+                if delay is None:
+                    raise
+                status = kubeutil.get_status(e)
+
+            attempt += 1
+            with tracing.span('retry', method + ' ' + path, status=status, attempt=attempt):
+                await asyncio.sleep(delay)
+
+    # request: make a request and return the decoded JSON response.
+    async def request(self, method, path, query=None, body=None, headers=None):
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+
+        with tracing.span('http', method + ' ' + path) as attrs:
+            if query:
+                attrs['query'] = urlencode(query)
+            try:
+                resp = await self.open(method, path, query, body, headers)
+                # Parse the body as it arrives rather than reading it all
+                # first; lists can be very large.
+                parser = jsonstream.Parser()
+                empty = True
+                try:
+                    while True:
+                        data = await resp.read_chunk()
+                        if not data:
+                            break
+                        parser.feed(data)
+                        empty = False
+                finally:
+                    # Does nothing if the whole body was read.
+                    resp.close()
+            except Exception as e:
+                attrs['status'] = kubeutil.get_status(e)
+                raise
+            attrs['status'] = resp.status
+            attrs['bytes'] = resp.nbytes
+
+        if empty:
+            return None
+        return parser.close()
+
+    async def get(self, path, query=None):
+        return await self.request('GET', path, query)
+
+    async def list(self, path, label_selector=None, field_selector=None, query=None,
+                   accept=None):
+        query = dict(query or {})
+        if label_selector:
+            query['labelSelector'] = label_selector
+        if field_selector:
+            query['fieldSelector'] = field_selector
+        headers = { 'Accept': accept } if accept else None
+        return await self.request('GET', path, query, headers=headers)
+
+    async def create(self, path, body):
+        return await self.request('POST', path, body=body,
+                                  headers={ 'Content-Type': 'application/json' })
+
+    async def patch(self, path, body, patch_type='application/strategic-merge-patch+json'):
+        return await self.request('PATCH', path, body=body,
+                                  headers={ 'Content-Type': patch_type })
+
+    async def delete(self, path, propagation=None):
+        body = None
+        if propagation:
+            body = { 'propagationPolicy': propagation }
+        return await self.request('DELETE', path, body=body,
+                                  headers={ 'Content-Type': 'application/json' })
+
+    # watch: watch a collection, starting from resource_version if given.
+    # returns a Watch, which is an async iterator of (type, object) events.
+    # with bookmarks, the server may also send BOOKMARK events, whose object
+    # carries only a newer resourceVersion.
+    def watch(self, path, resource_version=None, label_selector=None, timeout=None,
+              bookmarks=False):
+        query = { 'watch': 'true' }
+        if resource_version:
+            query['resourceVersion'] = resource_version
+        if bookmarks:
+            query['allowWatchBookmarks'] = 'true'
+        if label_selector:
+            query['labelSelector'] = label_selector
+        if timeout:
+            query['timeoutSeconds'] = str(int(timeout))
+        return Watch(self, path, query)
+
+# Watch: an async iterator over watch events.  it stops when the server ends
+# the watch; call close() to stop early.  a 410 Gone error (the requested
+# resource version is too old) is raised as kubeutil.ApiError.
+class Watch(object):
+    def __init__(self, client, path, query):
+        self.client = client
+        self.path = path
+        self.query = query
+        self.resp = None
+        self.buffer = b''
+
+    def __aiter__(self):
+        return self
+
+    # start: send the request and wait for the response headers.  this is
+    # done by the first iteration if it hasn't been called.
+    async def start(self):
+        if self.resp is None:
+            with tracing.span('http', 'WATCH ' + self.path):
+                self.resp = await self.client.open('GET', self.path, self.query)
+
+    async def __anext__(self):
+        await self.start()
+
+        while b'\n' not in self.buffer:
+            data = await self.resp.read_chunk()
+            if not data:
+                self.close()
+                raise StopAsyncIteration
+            self.buffer += data
+
+        (line, self.buffer) = self.buffer.split(b'\n', 1)
+        if not line.strip():
+            return await self.__anext__()
+
+        event = json.loads(line.decode('utf-8'))
+        if event['type'] == 'ERROR':
+            status = event['object']
+            raise kubeutil.ApiError(status.get('code', 500), status.get('reason', ''),
+                                    line)
+        return (event['type'], event['object'])
+
+    def close(self):
+        if self.resp is not None:
+            self.resp.close()
+
+# The event loop thread, and a Client for the current configuration.
+loop = None
+loop_lock = threading.Lock()
+current = None
+
+# get_loop: return the event loop, starting its thread if necessary.
+def get_loop():
+    global loop
+
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='kubeasync')
+            thread.daemon = True
+            thread.start()
+        return loop
+
+# client: return the asynchronous Client.  it is recreated if kubeutil's
+# configuration has changed (for example, between commands in "kdtool serve").
+def client():
+    global current
+
+    cfg = kubeutil.get_config()
+    with loop_lock:
+        if current is None or current[0] is not cfg:
+            current = (cfg, Client(cfg))
+        return current[1]
+
+# call: run a coroutine on the event loop and return its result.  safe to call
+# from any thread other than the event loop's.
+def call(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+# gather: run several coroutines concurrently and return their results in
+# order.  with return_exceptions, exceptions are returned rather than raised.
+def gather(*coros, return_exceptions=False):
+    async def run():
+        return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+    return call(run())
+
+# SyncClient: a blocking interface to Client, for code that hasn't been
+# converted to coroutines.
+class SyncClient(object):
+    def get(self, path, query=None):
+        return call(client().get(path, query))
+
+    def list(self, path, label_selector=None, field_selector=None, query=None,
+             accept=None):
+        return call(client().list(path, label_selector, field_selector, query, accept))
+
+    def create(self, path, body):
+        return call(client().create(path, body))
+
+    def patch(self, path, body, patch_type='application/strategic-merge-patch+json'):
+        return call(client().patch(path, body, patch_type))
+
+    def delete(self, path, propagation=None):
+        return call(client().delete(path, propagation))
+
+def sync_client():
+    return SyncClient()
@@ -11,6 +11,8 @@
 import os, json, subprocess
 from sys import stdout, stderr, exit
 
+import deployment, tracing
+
 
 # get_kubectl_args: return a kubectl command line to connect to the cluster
 # based on our arguments.
@@ -58,9 +60,10 @@ def apply_manifest(manifest, args):
     kargs = get_kubectl_args(args)
 
     if args.undeploy:
-        kargs.append('delete')
+        verb = 'delete'
     else:
-        kargs.append('apply')
+        verb = 'apply'
+    kargs.append(verb)
 
     if args.dry_run:
         kargs.append('--dry-run')
@@ -69,6 +72,12 @@ def apply_manifest(manifest, args):
 
     spec = json.dumps(manifest)
 
-    kubectl = subprocess.Popen(kargs, stdin=subprocess.PIPE)
-    kubectl.communicate(spec.encode('utf-8'))
+    with tracing.span('subprocess', 'kubectl ' + verb) as attrs:
+        kubectl = subprocess.Popen(kargs, stdin=subprocess.PIPE)
+        kubectl.communicate(spec.encode('utf-8'))
+        attrs['status'] = kubectl.returncode
+
+    # Anything we cached about the application may have changed.
+    deployment.clear_cache()
+
     return kubectl.returncode
@@ -0,0 +1,264 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# A decoder for the Kubernetes protobuf wire format
+# (application/vnd.kubernetes.protobuf), in pure Python since kdtool is
+# distributed as a zipapp.
+#
+# Rather than decoding whole objects, decode() takes a view: a schema listing
+# only the fields we use.  Everything else, such as a pod's spec, is skipped
+# using its length prefix without being looked at, which is what makes this
+# faster than parsing the equivalent JSON.  The result has the same shape as
+# the JSON object, but only has the fields in the view; add fields to the
+# views below when something needs them.
+#
+# A schema maps field numbers (from the generated.proto files in k8s.io/api
+# and k8s.io/apimachinery) to (JSON name, type), where type is one of
+# 'string', 'int', 'bool', 'time' (a meta.v1.Time, returned as a timestamp
+# string), 'map' (map<string, string>), 'raw' (the (start, end) offsets of the
+# undecoded field), a schema for an embedded message, or a one-element list of
+# a schema for a repeated message.
+#
+# The API server writes most scalar fields even when they are zero, while JSON
+# leaves many of them out, so read optional fields with .get() and a default.
+#
+# Only built-in types support protobuf; custom resources such as Databases are
+# always JSON.
+
+import time
+
+# Every protobuf response starts with this, followed by a runtime.Unknown
+# containing the type and the encoded object.
+MAGIC = b'k8s\x00'
+
+CONTENT_TYPE = 'application/vnd.kubernetes.protobuf'
+
+TIME = {
+    1: ('seconds', 'int'),
+}
+
+TYPE_META = {
+    1: ('apiVersion', 'string'),
+    2: ('kind', 'string'),
+}
+
+LIST_META = {
+    2: ('resourceVersion', 'string'),
+    3: ('continue', 'string'),
+}
+
+OWNER_REFERENCE = {
+    1: ('kind', 'string'),
+    3: ('name', 'string'),
+    4: ('uid', 'string'),
+    5: ('apiVersion', 'string'),
+    6: ('controller', 'bool'),
+}
+
+OBJECT_META = {
+    1: ('name', 'string'),
+    3: ('namespace', 'string'),
+    5: ('uid', 'string'),
+    6: ('resourceVersion', 'string'),
+    7: ('generation', 'int'),
+    8: ('creationTimestamp', 'time'),
+    9: ('deletionTimestamp', 'time'),
+    11: ('labels', 'map'),
+    12: ('annotations', 'map'),
+    13: ('ownerReferences', [ OWNER_REFERENCE ]),
+}
+
+LABEL_SELECTOR = {
+    1: ('matchLabels', 'map'),
+}
+
+CONTAINER = {
+    1: ('name', 'string'),
+    2: ('image', 'string'),
+}
+
+POD_TEMPLATE_SPEC = {
+    1: ('metadata', OBJECT_META),
+    2: ('spec', {
+        2: ('containers', [ CONTAINER ]),
+    }),
+}
+
+# extensions/v1beta1 ReplicaSet.
+REPLICASET = {
+    1: ('metadata', OBJECT_META),
+    2: ('spec', {
+        1: ('replicas', 'int'),
+        2: ('selector', LABEL_SELECTOR),
+        3: ('template', POD_TEMPLATE_SPEC),
+    }),
+    3: ('status', {
+        1: ('replicas', 'int'),
+        4: ('readyReplicas', 'int'),
+        5: ('availableReplicas', 'int'),
+        6: ('conditions', [{
+            1: ('type', 'string'),
+            2: ('status', 'string'),
+            4: ('reason', 'string'),
+            5: ('message', 'string'),
+        }]),
+    }),
+}
+
+REPLICASET_LIST = {
+    1: ('metadata', LIST_META),
+    2: ('items', [ REPLICASET ]),
+}
+
+CONTAINER_STATUS = {
+    1: ('name', 'string'),
+    2: ('state', {
+        1: ('waiting', {
+            1: ('reason', 'string'),
+            2: ('message', 'string'),
+        }),
+        2: ('running', {
+            1: ('startedAt', 'time'),
+        }),
+        3: ('terminated', {
+            1: ('exitCode', 'int'),
+            3: ('reason', 'string'),
+            4: ('message', 'string'),
+        }),
+    }),
+    4: ('ready', 'bool'),
+    5: ('restartCount', 'int'),
+    6: ('image', 'string'),
+}
+
+# v1 Pod, without its spec.
+POD = {
+    1: ('metadata', OBJECT_META),
+    3: ('status', {
+        1: ('phase', 'string'),
+        2: ('conditions', [{
+            1: ('type', 'string'),
+            2: ('status', 'string'),
+            4: ('lastTransitionTime', 'time'),
+        }]),
+        3: ('message', 'string'),
+        4: ('reason', 'string'),
+        8: ('containerStatuses', [ CONTAINER_STATUS ]),
+    }),
+}
+
+POD_LIST = {
+    1: ('metadata', LIST_META),
+    2: ('items', [ POD ]),
+}
+
+UNKNOWN = {
+    1: ('typeMeta', TYPE_META),
+    2: ('raw', 'raw'),
+    3: ('contentEncoding', 'string'),
+}
+
+MAP_ENTRY = {
+    1: ('key', 'string'),
+    2: ('value', 'string'),
+}
+
+# read_varint: decode a varint at pos.  returns (value, new pos).
+def read_varint(buf, pos):
+    b = buf[pos]
+    if b < 0x80:
+        return (b, pos + 1)
+
+    value = b & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        b = buf[pos]
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (value, pos + 1)
+        shift += 7
+
+# format_time: format a decoded meta.v1.Time as in JSON.
+def format_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t.get('seconds', 0)))
+
+# decode_message: decode the message in buf[pos:end] using schema.
+def decode_message(buf, pos, end, schema):
+    obj = {}
+
+    while pos < end:
+        (key, pos) = read_varint(buf, pos)
+        wire = key & 7
+
+        if wire == 0:
+            (value, pos) = read_varint(buf, pos)
+        elif wire == 2:
+            (length, value) = read_varint(buf, pos)
+            pos = value + length
+        elif wire == 1:
+            pos += 8
+            continue
+        elif wire == 5:
+            pos += 4
+            continue
+        else:
+            raise ValueError('unsupported protobuf wire type {0}'.format(wire))
+
+        field = schema.get(key >> 3)
+        if field is None:
+            continue
+
+        (name, kind) = field
+        if kind == 'string':
+            obj[name] = buf[value:pos].decode('utf-8')
+        elif kind == 'int':
+            # Negative numbers are sign-extended to 64 bits.
+            obj[name] = value - (1 << 64) if value >= (1 << 63) else value
+        elif kind == 'bool':
+            obj[name] = bool(value)
+        elif kind == 'time':
+            obj[name] = format_time(decode_message(buf, value, pos, TIME))
+        elif kind == 'raw':
+            obj[name] = (value, pos)
+        elif kind == 'map':
+            entry = decode_message(buf, value, pos, MAP_ENTRY)
+            obj.setdefault(name, {})[entry.get('key', '')] = entry.get('value', '')
+        elif isinstance(kind, list):
+            obj.setdefault(name, []).append(decode_message(buf, value, pos, kind[0]))
+        else:
+            obj[name] = decode_message(buf, value, pos, kind)
+
+    return obj
+
+# is_protobuf: return True if a response body is in protobuf format.
+def is_protobuf(data):
+    return data[:4] == MAGIC
+
+# decode: decode a protobuf response body using the view schema.  raises
+# ValueError if the body isn't a protobuf response we can decode.
+def decode(data, schema):
+    if not is_protobuf(data):
+        raise ValueError('not a protobuf response')
+
+    try:
+        envelope = decode_message(data, len(MAGIC), len(data), UNKNOWN)
+        if envelope.get('contentEncoding'):
+            raise ValueError('unsupported protobuf content encoding {0}'.format(
+                envelope['contentEncoding']))
+        if 'raw' not in envelope:
+            raise ValueError('protobuf response has no object')
+
+        (start, end) = envelope['raw']
+        obj = decode_message(data, start, end, schema)
+    except IndexError:
+        raise ValueError('truncated protobuf response')
+
+    obj.update(envelope.get('typeMeta', {}))
+    return obj
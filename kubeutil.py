@@ -8,36 +8,285 @@
 # warranty.
 
 
+# The kubernetes client package is large and slow to import, so it's only
+# imported once a command actually needs to talk to the API server.
+
 from sys import stdout, stderr, exit
-import kubernetes, json, urllib3
+from os import environ
+import base64, hashlib, json, os, random, threading, time
+
+import tracing
+
+# How long to reuse cached credentials whose expiry time isn't known.
+CREDENTIAL_TTL = 600
+# Stop using a cached token this long before it expires.
+CREDENTIAL_MARGIN = 60
 
-config = kubernetes.client.Configuration()
+config = None
+config_args = None
+config_key = None
+config_lock = threading.Lock()
+client = None
 
-# configure: set configuration based on args.
+# configure: record the connection arguments.  the kubeconfig is not loaded
+# until get_config() is first called.  if a configuration was already loaded
+# for different connection arguments (in "kdtool serve"), it is discarded.
 def configure(args):
+    global config, config_args, config_key, client
+
+    key = (environ.get('KUBECONFIG'), args.context, args.server, args.token,
+           args.ca_certificate)
+    with config_lock:
+        if key != config_key:
+            config = None
+            client = None
+        config_args = args
+        config_key = key
+
+# cache_dir: return our private cache directory, creating it if necessary.
+def cache_dir():
+    base = environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'kdtool')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+# write_private: atomically write data to a file only our user can read.
+def write_private(path, data):
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+# cache_file: store data in a file in the cache directory named after its
+# contents, and return the filename.  the file is only written if it doesn't
+# already exist, so the same certificate always ends up at the same path.
+def cache_file(data, suffix):
+    name = hashlib.sha256(data).hexdigest()[:32] + suffix
+    path = os.path.join(cache_dir(), name)
+    if not os.path.exists(path):
+        write_private(path, data)
+    return path
+
+# credential_key: return the credential cache key for the current kubeconfig
+# and the given context, or None if there is no kubeconfig.
+def credential_key(context):
+    path = os.path.expanduser(environ.get('KUBECONFIG', '~/.kube/config'))
     try:
-        kubernetes.config.kube_config.load_kube_config(
-            client_configuration=config,
-            context=args.context)
-    except:
-        stderr.write("warning: could not load kubeconfig\n")
-        args.server = 'http://localhost:8080'
-
-    if args.server:
-        config.host = args.server
-    if args.token:
-        config.api_key['authorization'] = "bearer " + args.token
-    if args.ca_certificate:
-        config.ssl_ca_cert = args.ca_certificate
-
-# get_client: return a Kubernetes API client.
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    key = json.dumps([ os.path.abspath(path), st.st_mtime, st.st_size, context ])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# token_expiry: return the expiry time of a JWT bearer token, or None if it
+# isn't a JWT or has no expiry.
+def token_expiry(authorization):
+    try:
+        token = authorization.split(' ', 1)[1]
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload).decode('utf-8'))['exp'])
+    except Exception:
+        return None
+
+# load_credentials: load cached credentials for the given key into cfg.
+# returns False if there are no usable cached credentials.
+def load_credentials(key, cfg):
+    try:
+        with open(os.path.join(cache_dir(), 'credentials.json'), 'r') as f:
+            entry = json.load(f)[key]
+    except (OSError, ValueError, KeyError):
+        return False
+
+    if entry['expires'] < time.time():
+        return False
+
+    cfg.host = entry['host']
+    cfg.verify_ssl = entry['verify_ssl']
+    cfg.api_key.update(entry['api_key'])
+    for (attr, suffix) in (('ssl_ca_cert', '.crt'),
+                           ('cert_file', '.crt'),
+                           ('key_file', '.key')):
+        if entry.get(attr):
+            setattr(cfg, attr, cache_file(base64.b64decode(entry[attr]), suffix))
+
+    return True
+
+# save_credentials: store the credentials from a freshly loaded cfg.
+def save_credentials(key, cfg):
+    now = time.time()
+    expires = token_expiry(cfg.api_key.get('authorization', ''))
+    if expires is None:
+        expires = now + CREDENTIAL_TTL
+    else:
+        expires -= CREDENTIAL_MARGIN
+
+    entry = {
+        'expires': expires,
+        'host': cfg.host,
+        'verify_ssl': cfg.verify_ssl,
+        'api_key': dict(cfg.api_key),
+    }
+
+    # The client writes inline certificates to temporary files that are
+    # deleted on exit, so store the certificate data rather than the paths.
+    for attr in ('ssl_ca_cert', 'cert_file', 'key_file'):
+        filename = getattr(cfg, attr, None)
+        if filename:
+            with open(filename, 'rb') as f:
+                entry[attr] = base64.b64encode(f.read()).decode('ascii')
+
+    path = os.path.join(cache_dir(), 'credentials.json')
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    # Drop anything that has expired while we're here.
+    cache = { k: v for (k, v) in cache.items() if v.get('expires', 0) > now }
+    cache[key] = entry
+    write_private(path, json.dumps(cache).encode('utf-8'))
+
+# get_config: return the client configuration, loading it on first use.
+# credentials resolved from the kubeconfig are cached between runs (unless
+# --no-credential-cache is given), so auth providers that run helpers or
+# refresh tokens are only invoked when the cached token expires.
+def get_config():
+    global config
+
+    with config_lock:
+        if config is not None:
+            return config
+
+        with tracing.span('startup', 'import kubernetes'):
+            import kubernetes
+
+        with tracing.span('config', 'load configuration') as attrs:
+            args = config_args
+            cfg = kubernetes.client.Configuration()
+
+            key = None
+            if not getattr(args, 'no_credential_cache', False):
+                key = credential_key(args.context)
+
+            attrs['cached'] = key is not None and load_credentials(key, cfg)
+            if not attrs['cached']:
+                try:
+                    kubernetes.config.kube_config.load_kube_config(
+                        client_configuration=cfg,
+                        context=args.context)
+                except:
+                    stderr.write("warning: could not load kubeconfig\n")
+                    args.server = 'http://localhost:8080'
+                    key = None
+
+                if key is not None:
+                    try:
+                        save_credentials(key, cfg)
+                    except OSError as e:
+                        stderr.write("warning: could not cache credentials: {0}\n".format(
+                            str(e)))
+
+            if args.server:
+                cfg.host = args.server
+            if args.token:
+                cfg.api_key['authorization'] = "bearer " + args.token
+            if args.ca_certificate:
+                cfg.ssl_ca_cert = args.ca_certificate
+
+        config = cfg
+        return config
+
+# trace_requests: wrap an API client's request method so each request is
+# recorded when --trace is enabled.  the span ends once the response body has
+# been read, so that the latency includes the download; for a streamed
+# (_preload_content=False) response that is when the caller reaches the end
+# of it.  bytes is the size of the body on the wire, before decompression.
+def trace_requests(client):
+    from urllib.parse import urlparse
+    request = client.request
+
+    def traced_request(method, url, *args, **kwargs):
+        if not tracing.enabled:
+            return request(method, url, *args, **kwargs)
+
+        name = method + ' ' + urlparse(url).path
+        attrs = {}
+        query = kwargs.get('query_params')
+        if query:
+            attrs['query'] = '&'.join([ '{0}={1}'.format(k, v) for (k, v) in query ])
+
+        start = time.monotonic()
+        try:
+            resp = request(method, url, *args, **kwargs)
+        except Exception as e:
+            attrs['status'] = get_status(e)
+            tracing.add('http', name, start, time.monotonic(), **attrs)
+            raise
+
+        attrs['status'] = resp.status
+        if kwargs.get('_preload_content', True):
+            raw = getattr(resp, 'urllib3_response', None)
+            attrs['bytes'] = raw.tell() if raw is not None else len(resp.data or b'')
+            tracing.add('http', name, start, time.monotonic(), **attrs)
+            return resp
+
+        read = resp.read
+        def traced_read(amt=None, *rargs, **rkwargs):
+            data = read(amt, *rargs, **rkwargs)
+            if (amt is None or not data or resp.closed) and 'bytes' not in attrs:
+                attrs['bytes'] = resp.tell()
+                tracing.add('http', name, start, time.monotonic(), **attrs)
+            return data
+
+        resp.read = traced_read
+        return resp
+
+    client.request = traced_request
+
+# get_client: return a Kubernetes API client.  the client is shared, so its
+# connections to the API server are reused.  get_config() is called first so
+# that the kubernetes import is traced there.
 def get_client():
-    client = kubernetes.client.ApiClient(config=config)
-    return client
+    global client
+
+    cfg = get_config()
+    import kubernetes
+    with config_lock:
+        if client is None:
+            client = kubernetes.client.ApiClient(config=cfg)
+            trace_requests(client)
+            limit_requests(client)
+        return client
+
+# ApiError: an error response from the API server to a request made without
+# the kubernetes client (see kubeasync).  it has the same attributes as the
+# client's ApiException.
+class ApiError(Exception):
+    def __init__(self, status, reason, body=b'', headers=None):
+        Exception.__init__(self, '({0}) {1}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.headers = headers or {}
+
+# get_status: return the HTTP status of a failed API request, or None if the
+# exception didn't come from the API server.
+def get_status(exc):
+    if isinstance(exc, ApiError):
+        return exc.status
+
+    from kubernetes.client.rest import ApiException
+    if isinstance(exc, ApiException):
+        return exc.status
+    return None
 
 # get_error: try to extract a printable error message from an exception.
 def get_error(exc):
-    if isinstance(exc, kubernetes.client.rest.ApiException):
+    if get_status(exc) is not None:
         try:
             body = exc.body.decode('utf-8')
             d = json.loads(body)
@@ -45,7 +294,157 @@ def get_error(exc):
         except:
             return exc.reason
 
+    import urllib3
+
     if isinstance(exc, urllib3.exceptions.HTTPError):
         return exc.args[0]
 
     return str(exc)
+
+# TokenBucket: limit the rate of API requests across all threads.  up to
+# 'burst' requests can be made at once, after which requests are allowed at
+# 'qps' per second.  a qps of 0 disables the limit.
+class TokenBucket(object):
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # reserve: take a token, and return how long the caller must wait before
+    # using it.  this is for callers that can't block, such as coroutines.
+    def reserve(self):
+        if not self.qps:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.qps)
+            self.last = now
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.qps
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+# The request policy: client-side rate limit, and how many times to retry a
+# request that failed with a transient error.  Commands can set their own
+# defaults with an 'api_policy' attribute; the global --api-qps, --api-burst
+# and --api-retries options override them.
+DEFAULT_POLICY = {
+    'qps': 20,
+    'burst': 40,
+    'retries': 5,
+}
+
+# Statuses worth retrying.  Other methods than these are only retried on 429,
+# since the server may have acted on the first attempt.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Exponential backoff: the first retry waits up to BACKOFF_BASE seconds,
+# doubling each time up to BACKOFF_MAX.  Retry-After is honoured up to
+# RETRY_AFTER_MAX.
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_AFTER_MAX = 120
+
+policy = dict(DEFAULT_POLICY)
+limiter = TokenBucket(policy['qps'], policy['burst'])
+
+# set_policy: set the request policy.  any value not given is reset to the
+# default.
+def set_policy(qps=None, burst=None, retries=None):
+    global limiter
+
+    policy.update(DEFAULT_POLICY)
+    for (k, v) in (('qps', qps), ('burst', burst), ('retries', retries)):
+        if v is not None:
+            policy[k] = v
+    limiter = TokenBucket(policy['qps'], policy['burst'])
+
+# get_retry_after: return the delay requested by a Retry-After header on a
+# failed request, or None.
+def get_retry_after(exc):
+    headers = getattr(exc, 'headers', None)
+    if not headers:
+        return None
+
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    from email.utils import parsedate_tz, mktime_tz
+    try:
+        return max(0, mktime_tz(parsedate_tz(value)) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+# is_connection_error: return True if exc is a failure to connect to or
+# communicate with the API server.
+def is_connection_error(exc):
+    if isinstance(exc, (ConnectionError, EOFError, TimeoutError)):
+        return True
+
+    import asyncio, urllib3
+    return isinstance(exc, (urllib3.exceptions.HTTPError, asyncio.TimeoutError))
+
+# get_retry_delay: return how long to wait before retrying a failed request, or
+# None if it should not be retried.  attempt is the number of retries so far.
+def get_retry_delay(method, exc, attempt):
+    if attempt >= policy['retries']:
+        return None
+
+    status = get_status(exc)
+    if status is None:
+        # Connection errors: the request may not have been sent at all, but
+        # only retry if doing it twice would be harmless.
+        if not is_connection_error(exc) or method not in IDEMPOTENT_METHODS:
+            return None
+    elif status not in RETRY_STATUSES:
+        return None
+    elif status != 429 and method not in IDEMPOTENT_METHODS:
+        return None
+
+    retry_after = get_retry_after(exc)
+    if retry_after is not None:
+        return min(retry_after, RETRY_AFTER_MAX) + random.uniform(0, BACKOFF_BASE)
+
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+# limit_requests: wrap an API client's request method with the rate limiter
+# and retry policy.
+def limit_requests(client):
+    from urllib.parse import urlparse
+    request = client.request
+
+    def limited_request(method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                return request(method, url, *args, **kwargs)
+            except Exception as e:
+                delay = get_retry_delay(method, e, attempt)
+                if delay is None:
+                    raise
+                status = get_status(e)
+
+            attempt += 1
+            with tracing.span('retry', method + ' ' + urlparse(url).path,
+                              status=status, attempt=attempt):
+                time.sleep(delay)
+
+    client.request = limited_request
@@ -11,7 +11,7 @@
 from os import environ
 from base64 import b64encode
 from sys import stdout, stderr, exit
-import re, yaml
+import re
 
 
 # Load a YAML manifest from disk and perform environment substitution on it,
@@ -55,7 +55,22 @@ def load_manifest(args, filename):
 
   spec = re.sub(r"\$({)?([A-Za-z_][A-Za-z0-9_:]+)(?(1)})", envrep, spec)
 
+  import yaml
   items = []
   for item in yaml.load_all(spec):
     items.append(item)
   return items
+
+
+# Return the objects in a manifest, with any Lists flattened.
+def manifest_items(spec):
+  if not isinstance(spec, dict):
+    return []
+
+  if spec.get('kind') == 'List':
+    items = []
+    for item in spec.get('items') or []:
+      items.extend(manifest_items(item))
+    return items
+
+  return [ spec ]
@@ -0,0 +1,338 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Resource usage from the metrics API (metrics.k8s.io, served by
+# metrics-server).  "kdtool top" shows the current CPU and memory use of a
+# deployment's pods against their requests and limits.  "kdtool right-size"
+# samples one container's use over a window and recommends requests and limits
+# for it, as deploy options:
+#
+#   requests    the chosen percentile of the samples, plus headroom
+#   limits      the largest sample, plus headroom, and at least the request
+#
+# metrics-server only updates a pod's usage every so often (a minute by
+# default), so a sample is only counted once however many times it is fetched.
+# The recommendation is only as good as the window: sample while the
+# application is under its usual peak load.
+
+import math, time
+from sys import stdout, stderr, exit
+
+import deployment, kubeutil
+from history import percentile
+
+METRICS_API = 'apis/metrics.k8s.io/v1beta1'
+
+CPU_SUFFIXES = { 'n': 1e-9, 'u': 1e-6, 'm': 1e-3 }
+MEMORY_SUFFIXES = {
+    'Ki': 1 << 10, 'Mi': 1 << 20, 'Gi': 1 << 30, 'Ti': 1 << 40,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12,
+}
+
+MEBIBYTE = 1 << 20
+
+# parse_cpu: convert a CPU quantity like "250m" to cores.
+def parse_cpu(q):
+    q = str(q)
+    if q[-1:] in CPU_SUFFIXES:
+        return float(q[:-1]) * CPU_SUFFIXES[q[-1]]
+    return float(q)
+
+# parse_memory: convert a memory quantity like "128Mi" to bytes.
+def parse_memory(q):
+    q = str(q)
+    for (suffix, scale) in MEMORY_SUFFIXES.items():
+        if q.endswith(suffix):
+            return int(float(q[:-len(suffix)]) * scale)
+    return int(float(q))
+
+def format_cpu(cores):
+    return '{0}m'.format(int(round(cores * 1000)))
+
+def format_memory(nbytes):
+    return '{0}Mi'.format(int(round(float(nbytes) / MEBIBYTE)))
+
+# get_pods: return the pods of a deployment's active replicasets.
+def get_pods(dp):
+    pods = []
+    for rs in deployment.get_replicasets(dp):
+        pods.extend(deployment.get_rs_pods(rs))
+    return pods
+
+# get_pod_metrics: fetch the metrics for pods concurrently.  returns a dict
+# mapping pod names to their PodMetrics, or None for pods which don't have
+# metrics yet.
+def get_pod_metrics(namespace, pods):
+    import kubeasync
+
+    client = kubeasync.client()
+    names = [ pod['metadata']['name'] for pod in pods ]
+    results = kubeasync.gather(
+        *[ client.get(kubeasync.path(METRICS_API, namespace, 'pods', name))
+            for name in names ],
+        return_exceptions=True)
+
+    ret = {}
+    for (name, result) in zip(names, results):
+        if isinstance(result, Exception):
+            # New pods have no metrics until metrics-server next scrapes them.
+            if kubeutil.get_status(result) != 404:
+                raise result
+            result = None
+        ret[name] = result
+    return ret
+
+# container_usage: return the usage in a PodMetrics as a dict mapping
+# container names to (cores, bytes).
+def container_usage(metrics):
+    return { c['name']: (parse_cpu(c['usage'].get('cpu', 0)),
+                         parse_memory(c['usage'].get('memory', 0)))
+                for c in metrics.get('containers', []) }
+
+# container_resources: return the requests and limits of a deployment's
+# containers as a dict mapping container names to
+# { 'requests': (cores, bytes), 'limits': (cores, bytes) }, with None for
+# anything unset.
+def container_resources(dp):
+    ret = {}
+    for c in dp['spec']['template']['spec'].get('containers', []):
+        resources = c.get('resources', {})
+        ret[c['name']] = {}
+        for kind in ('requests', 'limits'):
+            values = resources.get(kind, {})
+            ret[c['name']][kind] = (
+                parse_cpu(values['cpu']) if 'cpu' in values else None,
+                parse_memory(values['memory']) if 'memory' in values else None)
+    return ret
+
+# format_share: format usage as a percentage of a request or limit.
+def format_share(used, total, fmt):
+    if not total:
+        return 'none'
+    return '{0} ({1}%)'.format(fmt(total), int(round(100.0 * used / total)))
+
+# top: show the current resource usage of deployments.
+def top(args):
+    for name in args.name:
+        try:
+            dp = deployment.get_deployment(args.namespace, name)
+            pods = get_pods(dp)
+            metrics = get_pod_metrics(args.namespace, pods)
+        except Exception as e:
+            stderr.write('cannot load metrics for deployment {0}: {1}\n'.format(
+                name, kubeutil.get_error(e)))
+            exit(1)
+
+        stdout.write('deployment {0}/{1}: {2} pods\n\n'.format(
+            dp['metadata']['namespace'], name, len(pods)))
+
+        if not pods:
+            continue
+
+        stdout.write('  {0:<40} {1:>8} {2:>10}\n'.format('pod', 'cpu', 'memory'))
+
+        usage = {}
+        total = (0, 0)
+        for pod in sorted(metrics):
+            if metrics[pod] is None:
+                stdout.write('  {0:<40} {1:>8} {2:>10}\n'.format(pod, '-', '-'))
+                continue
+
+            pod_usage = container_usage(metrics[pod])
+            for (container, (cpu, memory)) in pod_usage.items():
+                usage.setdefault(container, []).append((cpu, memory))
+            cpu = sum([ u[0] for u in pod_usage.values() ])
+            memory = sum([ u[1] for u in pod_usage.values() ])
+            total = (total[0] + cpu, total[1] + memory)
+            stdout.write('  {0:<40} {1:>8} {2:>10}\n'.format(
+                pod, format_cpu(cpu), format_memory(memory)))
+
+        stdout.write('  {0:<40} {1:>8} {2:>10}\n\n'.format(
+            'total', format_cpu(total[0]), format_memory(total[1])))
+
+        resources = container_resources(dp)
+        for container in sorted(usage):
+            cpu = [ u[0] for u in usage[container] ]
+            memory = [ u[1] for u in usage[container] ]
+            res = resources.get(container, { 'requests': (None, None),
+                                             'limits': (None, None) })
+            avg_cpu = sum(cpu) / len(cpu)
+            avg_memory = sum(memory) / len(memory)
+
+            stdout.write('  container {0}, over {1} pods:\n'.format(
+                container, len(usage[container])))
+            stdout.write('    cpu:    avg {0}, max {1}; request {2}, limit {3}\n'.format(
+                format_cpu(avg_cpu), format_cpu(max(cpu)),
+                format_share(avg_cpu, res['requests'][0], format_cpu),
+                format_share(avg_cpu, res['limits'][0], format_cpu)))
+            stdout.write('    memory: avg {0}, max {1}; request {2}, limit {3}\n'.format(
+                format_memory(avg_memory), format_memory(max(memory)),
+                format_share(avg_memory, res['requests'][1], format_memory),
+                format_share(avg_memory, res['limits'][1], format_memory)))
+
+        stdout.write('\n')
+
+top.help = "show resource usage of an application"
+top.arguments = (
+    ( ('name',), {
+        'type': str,
+        'nargs': '+',
+        'help': 'deployment name',
+    }),
+)
+
+# collect_samples: sample a container's usage across a deployment's pods until
+# the deadline.  returns the latest copy of the deployment and a dict mapping
+# (pod, timestamp) to (cores, bytes).  stops early, keeping what it has, on ^C.
+def collect_samples(args, dp, deadline):
+    samples = {}
+    pods = set()
+    last = None
+
+    try:
+        while True:
+            # The pods change as the deployment scales or is updated.
+            deployment.clear_cache()
+            dp = deployment.get_deployment(args.namespace, args.name)
+            metrics = get_pod_metrics(args.namespace, get_pods(dp))
+
+            for (pod, m) in metrics.items():
+                if m is None:
+                    continue
+                usage = container_usage(m).get(args.container)
+                if usage is not None:
+                    samples[(pod, m.get('timestamp'))] = usage
+                    pods.add(pod)
+
+            progress = '  {0} samples from {1} pods'.format(len(samples), len(pods))
+            if progress != last:
+                stdout.write(progress + '\n')
+                last = progress
+
+            if time.time() + args.interval > deadline:
+                return (dp, samples)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        stdout.write('  stopped early\n')
+        return (dp, samples)
+
+# recommend: return the recommended (request, limit) for a list of samples.
+def recommend(values, args):
+    headroom = 1 + args.headroom / 100.0
+    request = percentile(values, args.percentile) * headroom
+    limit = max(values) * headroom
+    return (request, max(request, limit))
+
+# right_size: recommend resource requests and limits for an application from
+# its usage.
+def right_size(args):
+    try:
+        dp = deployment.get_deployment(args.namespace, args.name)
+    except Exception as e:
+        stderr.write('cannot load deployment {0}: {1}\n'.format(
+            args.name, kubeutil.get_error(e)))
+        exit(1)
+
+    resources = container_resources(dp)
+    if args.container not in resources:
+        stderr.write('deployment {0} has no container {1}\n'.format(
+            args.name, args.container))
+        exit(1)
+
+    stdout.write('sampling container {0} of deployment {1}/{2} for {3}s...\n'.format(
+        args.container, dp['metadata']['namespace'], args.name, args.window))
+
+    try:
+        (dp, samples) = collect_samples(args, dp, time.time() + args.window)
+    except Exception as e:
+        stderr.write('cannot load metrics for deployment {0}: {1}\n'.format(
+            args.name, kubeutil.get_error(e)))
+        exit(1)
+
+    if not samples:
+        stderr.write('no metrics for deployment {0}; is metrics-server running?\n'.format(
+            args.name))
+        exit(1)
+    if len(samples) < 10:
+        stderr.write('warning: only {0} samples; sample for longer for a better recommendation\n'.format(
+            len(samples)))
+
+    cpu = [ s[0] for s in samples.values() ]
+    memory = [ s[1] for s in samples.values() ]
+    (cpu_request, cpu_limit) = recommend(cpu, args)
+    (memory_request, memory_limit) = recommend(memory, args)
+
+    # Round up: CPU to hundredths of a core, memory to whole mebibytes.
+    cpu_request = max(0.01, math.ceil(cpu_request * 100) / 100.0)
+    cpu_limit = max(cpu_request, math.ceil(cpu_limit * 100) / 100.0)
+    memory_request = int(math.ceil(float(memory_request) / MEBIBYTE))
+    memory_limit = max(memory_request, int(math.ceil(float(memory_limit) / MEBIBYTE)))
+
+    current = container_resources(dp).get(args.container, resources[args.container])
+    p = 'p' + str(args.percentile)
+
+    stdout.write('\nusage, and the current request and limit:\n\n')
+    stdout.write('  {0:<8} {1:>9} {2:>9} {3:>9} {4:>9}\n'.format(
+        '', p, 'max', 'request', 'limit'))
+    stdout.write('  {0:<8} {1:>9} {2:>9} {3:>9} {4:>9}\n'.format(
+        'cpu', format_cpu(percentile(cpu, args.percentile)), format_cpu(max(cpu)),
+        format_cpu(current['requests'][0]) if current['requests'][0] else 'none',
+        format_cpu(current['limits'][0]) if current['limits'][0] else 'none'))
+    stdout.write('  {0:<8} {1:>9} {2:>9} {3:>9} {4:>9}\n'.format(
+        'memory', format_memory(percentile(memory, args.percentile)),
+        format_memory(max(memory)),
+        format_memory(current['requests'][1]) if current['requests'][1] else 'none',
+        format_memory(current['limits'][1]) if current['limits'][1] else 'none'))
+
+    stdout.write('\nrecommended ({0} + {1}% for requests, max + {1}% for limits):\n\n'.format(
+        p, args.headroom))
+    stdout.write('  --cpu-request={0:g} --cpu-limit={1:g} --memory-request={2}Mi --memory-limit={3}Mi\n'.format(
+        cpu_request, cpu_limit, memory_request, memory_limit))
+
+right_size.help = "recommend resource requests and limits from usage"
+right_size.arguments = (
+    ( ('-w', '--window'), {
+        'type': int,
+        'default': 600,
+        'metavar': 'SECONDS',
+        'help': 'how long to sample usage for (default 600)',
+    }),
+    ( ('-i', '--interval'), {
+        'type': int,
+        'default': 30,
+        'metavar': 'SECONDS',
+        'help': 'how often to sample usage (default 30)',
+    }),
+    ( ('-p', '--percentile'), {
+        'type': int,
+        'default': 95,
+        'metavar': 'N',
+        'help': 'usage percentile to base requests on (default 95)',
+    }),
+    ( ('--headroom',), {
+        'type': int,
+        'default': 20,
+        'metavar': 'PERCENT',
+        'help': 'headroom to add to requests and limits (default 20)',
+    }),
+    ( ('--container',), {
+        'type': str,
+        'default': 'app',
+        'help': 'container to size (default app)',
+    }),
+    ( ('name',), {
+        'type': str,
+        'help': 'deployment name',
+    }),
+)
+
+commands = {
+    'top': top,
+    'right-size': right_size,
+}
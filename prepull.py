@@ -0,0 +1,204 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Image pre-pulling.  During a rolling update each new pod pulls the image on
+# its node, and with maxSurge 1 those pulls happen one after another.  With
+# "deploy --prepull", kdtool first creates a temporary DaemonSet, restricted to
+# the nodes the Deployment's pods could run on, whose pods only exist to pull
+# the Deployment's images; once enough nodes have the images it deletes the
+# DaemonSet and applies the manifest, so the rollout doesn't wait for pulls.
+#
+# The pre-pull pods run "true" from each image.  An image without it will fail
+# to start, but by then it has been pulled, which is all we need.  Pre-pulling
+# is only an optimisation, so if it fails or times out we warn and deploy
+# anyway.
+
+import time
+from sys import stdout, stderr
+
+import kubeutil
+from manifest import manifest_items
+
+PREPULL_LABEL = 'kdtool.torchbox.com/prepull'
+
+# How often to check the pre-pull pods.
+WAIT_INTERVAL = 2
+
+# Pod template fields that decide which nodes a pod can run on, or that are
+# needed to pull its images.  of the affinity, only nodeAffinity is used;
+# (anti-)affinity to the application's pods would keep the pre-pull pods off
+# the nodes they should be on.
+NODE_FIELDS = ('nodeSelector', 'tolerations', 'imagePullSecrets')
+
+# Container waiting reasons which mean the image has been pulled, but the
+# container couldn't be started.
+PULLED_REASONS = ('CrashLoopBackOff', 'RunContainerError', 'CreateContainerError')
+
+# make_daemonset: create the pre-pull DaemonSet for a Deployment.
+def make_daemonset(dp):
+    name = dp['metadata']['name']
+    template = dp['spec']['template'].get('spec', {})
+    labels = { PREPULL_LABEL: name }
+
+    images = []
+    for container in template.get('initContainers', []) + template.get('containers', []):
+        if (container['image'], container.get('imagePullPolicy')) not in images:
+            images.append((container['image'], container.get('imagePullPolicy')))
+
+    podspec = {
+        'containers': [{
+            'name': 'pull{0}'.format(i),
+            'image': image,
+            'imagePullPolicy': policy or 'IfNotPresent',
+            'command': [ 'true' ],
+            'resources': {
+                'requests': { 'cpu': '1m', 'memory': '8Mi' },
+                'limits': { 'memory': '32Mi' },
+            },
+        } for (i, (image, policy)) in enumerate(images)],
+        'terminationGracePeriodSeconds': 0,
+    }
+
+    for field in NODE_FIELDS:
+        if field in template:
+            podspec[field] = template[field]
+    if 'nodeAffinity' in template.get('affinity', {}):
+        podspec['affinity'] = { 'nodeAffinity': template['affinity']['nodeAffinity'] }
+
+    return {
+        'apiVersion': 'extensions/v1beta1',
+        'kind': 'DaemonSet',
+        'metadata': {
+            'name': name + '-prepull',
+            'namespace': dp['metadata'].get('namespace'),
+            'labels': labels,
+        },
+        'spec': {
+            'selector': { 'matchLabels': labels },
+            'template': {
+                'metadata': { 'labels': labels },
+                'spec': podspec,
+            },
+        },
+    }
+
+# image_pulled: return True if a container's image has been pulled.
+def image_pulled(cs):
+    state = cs.get('state', {})
+    if 'running' in state or 'terminated' in state:
+        return True
+    if 'terminated' in cs.get('lastState', {}):
+        return True
+    return state.get('waiting', {}).get('reason') in PULLED_REASONS
+
+# pod_pulled: return True if a pod has pulled all its images.
+def pod_pulled(pod):
+    statuses = pod.get('status', {}).get('containerStatuses', [])
+    return len(statuses) == len(pod['spec']['containers']) \
+            and all(image_pulled(cs) for cs in statuses)
+
+# create_daemonset: create a DaemonSet, replacing one left over from an
+# earlier run.
+def create_daemonset(client, ds):
+    import kubeasync
+
+    path = kubeasync.path('apis/extensions/v1beta1', ds['metadata']['namespace'],
+                          'daemonsets')
+    try:
+        client.create(path, ds)
+    except Exception as e:
+        if kubeutil.get_status(e) != 409:
+            raise
+        client.patch(path + '/' + ds['metadata']['name'],
+                     { 'spec': ds['spec'] }, 'application/merge-patch+json')
+
+# wait_pulled: wait until the given fraction of a DaemonSet's nodes have
+# pulled its images.  returns True if they did before the deadline.
+def wait_pulled(client, ds, fraction, deadline):
+    import kubeasync
+
+    namespace = ds['metadata']['namespace']
+    name = ds['metadata']['name']
+    last = None
+
+    while True:
+        st = client.get(kubeasync.path('apis/extensions/v1beta1', namespace,
+                                       'daemonsets', name)).get('status', {})
+        pods = client.list(kubeasync.path('api/v1', namespace, 'pods'),
+                           label_selector='{0}={1}'.format(
+                               PREPULL_LABEL, ds['metadata']['labels'][PREPULL_LABEL]))
+        pulled = len([ pod for pod in pods.get('items', []) if pod_pulled(pod) ])
+
+        # desiredNumberScheduled is only meaningful once the controller has
+        # seen the DaemonSet.
+        if 'observedGeneration' in st:
+            nodes = st.get('desiredNumberScheduled', 0)
+            if nodes == 0:
+                stderr.write('warning: no nodes to pre-pull images on\n')
+                return False
+
+            progress = '  {0}/{1} nodes have pulled the images'.format(pulled, nodes)
+            if progress != last:
+                stdout.write(progress + '\n')
+                last = progress
+
+            if pulled >= fraction * nodes:
+                return True
+
+        if time.time() >= deadline:
+            return False
+
+        time.sleep(WAIT_INTERVAL)
+
+# prepull: pull the images for the Deployments in a manifest onto their nodes
+# before it is applied.
+def prepull(spec, args):
+    import kubeasync
+
+    deployments = [ item for item in manifest_items(spec)
+                        if item.get('kind') == 'Deployment' ]
+    if not deployments:
+        return
+
+    client = kubeasync.sync_client()
+    daemonsets = []
+    deadline = time.time() + args.timeout
+
+    for dp in deployments:
+        ds = make_daemonset(dp)
+        ds['metadata']['namespace'] = ds['metadata']['namespace'] or args.namespace
+        stdout.write('pre-pulling images for deployment {0}/{1}...\n'.format(
+            ds['metadata']['namespace'], dp['metadata']['name']))
+        try:
+            create_daemonset(client, ds)
+        except Exception as e:
+            stderr.write('warning: cannot create daemonset {0}: {1}\n'.format(
+                ds['metadata']['name'], kubeutil.get_error(e)))
+            continue
+        daemonsets.append(ds)
+
+    try:
+        for ds in daemonsets:
+            try:
+                if not wait_pulled(client, ds, args.prepull_fraction, deadline):
+                    stderr.write('warning: pre-pull for {0} did not finish, deploying anyway\n'.format(
+                        ds['metadata']['name']))
+            except Exception as e:
+                stderr.write('warning: cannot check pre-pull for {0}: {1}\n'.format(
+                    ds['metadata']['name'], kubeutil.get_error(e)))
+    finally:
+        for ds in daemonsets:
+            try:
+                client.delete(kubeasync.path('apis/extensions/v1beta1',
+                                             ds['metadata']['namespace'],
+                                             'daemonsets', ds['metadata']['name']),
+                              'Background')
+            except Exception as e:
+                stderr.write('warning: cannot delete daemonset {0}: {1}\n'.format(
+                    ds['metadata']['name'], kubeutil.get_error(e)))
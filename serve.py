@@ -0,0 +1,237 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# "kdtool serve" runs a long-lived daemon on a Unix socket.  When
+# $KDTOOL_SOCKET (or --connect) is set, kdtool sends its command line,
+# environment, working directory and stdin/stdout/stderr file descriptors to
+# the daemon, which runs the command in-process with those descriptors
+# installed as its own and sends back the exit status.  The daemon keeps the
+# kubernetes client imported, the kubeconfig loaded, API connections open, and
+# a short-lived cache of Deployments and ReplicaSets.
+#
+# Requests are run one at a time, since each one temporarily takes over the
+# daemon's file descriptors, environment and working directory.
+
+import array, json, os, socket, struct, sys, traceback
+from sys import stdout, stderr, exit
+
+import deployment, kubeutil
+
+# default_socket: return the default socket path for this user.
+def default_socket():
+    rundir = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+    return os.path.join(rundir, 'kdtool-{0}.sock'.format(os.getuid()))
+
+# send_message: send a length-prefixed JSON message, optionally with file
+# descriptors attached.
+def send_message(sock, msg, fds=()):
+    data = json.dumps(msg).encode('utf-8')
+    header = struct.pack('!I', len(data))
+
+    if fds:
+        sock.sendmsg([header], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                 array.array('i', fds))])
+    else:
+        sock.sendall(header)
+    sock.sendall(data)
+
+# recv_exactly: read exactly n bytes from a socket.
+def recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+# recv_message: receive a message sent by send_message.  returns the message
+# and a list of any file descriptors received.
+def recv_message(sock, maxfds=0):
+    fds = array.array('i')
+    (header, ancdata, flags, addr) = sock.recvmsg(
+        4, socket.CMSG_LEN(maxfds * fds.itemsize) if maxfds else 0)
+
+    for (level, type_, data) in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+    if len(header) < 4:
+        header += recv_exactly(sock, 4 - len(header))
+
+    (length,) = struct.unpack('!I', header)
+    msg = json.loads(recv_exactly(sock, length).decode('utf-8'))
+    return (msg, list(fds))
+
+# client: run a command in the daemon listening on the given socket.  returns
+# the command's exit status, or None if the daemon couldn't be reached, in
+# which case the caller should run the command itself.
+def client(path, argv):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        stderr.write('warning: cannot connect to kdtool daemon at {0}: {1}; running locally\n'.format(
+            path, e.strerror))
+        sock.close()
+        return None
+
+    with sock:
+        send_message(sock, {
+            'argv': argv,
+            'env': dict(os.environ),
+            'cwd': os.getcwd(),
+        }, fds=(0, 1, 2))
+
+        try:
+            (reply, fds) = recv_message(sock)
+        except (EOFError, OSError, ValueError):
+            stderr.write('kdtool daemon closed the connection\n')
+            return 1
+
+    return reply['status']
+
+# run_request: run one command on behalf of a client.  returns the exit status.
+def run_request(req, fds):
+    import cli, io
+
+    saved_fds = [ os.dup(fd) for fd in (0, 1, 2) ]
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_stdin = sys.stdin
+
+    stdout.flush()
+    stderr.flush()
+
+    for (fd, client_fd) in zip((0, 1, 2), fds):
+        os.dup2(client_fd, fd)
+    sys.stdin = io.TextIOWrapper(io.FileIO(0, 'r', closefd=False))
+
+    try:
+        os.chdir(req['cwd'])
+        os.environ.clear()
+        os.environ.update(req['env'])
+
+        status = cli.main(req['argv'], serving=True)
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            stderr.write('{0}\n'.format(e.code))
+            status = 1
+    except KeyboardInterrupt:
+        status = 130
+    except Exception:
+        traceback.print_exc(file=stderr)
+        status = 1
+    finally:
+        stdout.flush()
+        stderr.flush()
+
+        sys.stdin = saved_stdin
+        for (fd, saved) in zip((0, 1, 2), saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+    return status
+
+# serve: run the daemon.
+def serve(args):
+    path = args.socket or args.connect or os.environ.get('KDTOOL_SOCKET') \
+            or default_socket()
+
+    # Import everything a command might need now, so requests don't have to.
+    # get_config() imports the kubernetes client, even if loading fails.
+    import yaml, passlib.hash, humanfriendly, cli
+    try:
+        kubeutil.get_config()
+    except Exception as e:
+        stderr.write('warning: cannot load configuration: {0}\n'.format(
+            kubeutil.get_error(e)))
+
+    deployment.cache_ttl = args.cache_ttl
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Only our own user may connect, since commands run with our credentials.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldmask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(oldmask)
+    sock.listen(16)
+
+    if args.idle_timeout:
+        sock.settimeout(args.idle_timeout)
+
+    stderr.write('kdtool: listening on {0}\n'.format(path))
+    stderr.flush()
+
+    try:
+        while True:
+            try:
+                (conn, addr) = sock.accept()
+            except socket.timeout:
+                stderr.write('kdtool: idle timeout, exiting\n')
+                break
+
+            with conn:
+                conn.settimeout(None)
+                fds = []
+                try:
+                    (req, fds) = recv_message(conn, maxfds=3)
+                    if len(fds) != 3:
+                        raise ValueError('expected 3 file descriptors, got {0}'.format(len(fds)))
+                    status = run_request(req, fds)
+                    send_message(conn, { 'status': status })
+                except (EOFError, OSError, ValueError, KeyError) as e:
+                    stderr.write('kdtool: bad request: {0}\n'.format(str(e)))
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(path)
+
+    return 0
+
+serve.help = "run a daemon to execute commands without startup overhead"
+serve.arguments = (
+    ( ('-s', '--socket'), {
+        'type': str,
+        'metavar': 'PATH',
+        'help': 'socket to listen on (default: $KDTOOL_SOCKET or a per-user socket)',
+    }),
+    ( ('--cache-ttl',), {
+        'type': float,
+        'default': 5,
+        'metavar': 'SECONDS',
+        'help': 'how long to cache Deployments and ReplicaSets (0 to disable)',
+    }),
+    ( ('--idle-timeout',), {
+        'type': float,
+        'default': 0,
+        'metavar': 'SECONDS',
+        'help': 'exit after this long without a request (default: never)',
+    }),
+)
+
+commands = {
+    'serve':    serve,
+}
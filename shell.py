@@ -9,10 +9,11 @@
 # warranty.
 
 
-from sys import stdout, stderr
-import tempfile, argparse, subprocess, random, string, os, json, kubernetes
+from sys import stdout, stderr, exit
+import tempfile, argparse, subprocess, random, string, os, json
 
 from kubectl import find_kubectl, get_kubectl_args
+import kubeutil, tracing
 
 
 # find the application container for a given deployment.  if there is only one
@@ -74,9 +75,7 @@ def make_envfrom(envfrom):
 
 # start a shell for the given deployment.
 def shell(args, tty=True, command=None):
-    config = kubernetes.client.Configuration()
-    kubernetes.config.kube_config.load_kube_config(client_configuration=config)
-    api_client = kubernetes.client.ApiClient(config=config)
+    api_client = kubeutil.get_client()
 
     # We can't use the normal client API here because it returns Python objects
     # that can't be converted back into JSON.  Instead, fetch the JSON by hand.
@@ -88,6 +87,7 @@ def shell(args, tty=True, command=None):
     header_params = {}
     header_params['Accept'] = api_client.select_header_accept(['application/json'])
     header_params['Content-Type'] = api_client.select_header_content_type(['*/*'])
+    header_params.update(kubeutil.get_config().api_key)
 
     (resp, code, header) = api_client.call_api(
             resource_path, 'GET', {}, {}, header_params, None, [], _preload_content=False)
@@ -129,6 +129,8 @@ def shell(args, tty=True, command=None):
         },
     }
 
+    # Only take what the command needs from the application container;
+    # probes, lifecycle hooks and the grace period are for serving requests.
     if 'env' in app:
         pod['spec']['containers'][0]['env'] = app['env']
     if 'envFrom' in app:
@@ -153,7 +155,8 @@ def shell(args, tty=True, command=None):
         '/bin/false',  # not used
     ])
 
-    ret = subprocess.call(kargs, start_new_session=True)
+    with tracing.span('subprocess', 'kubectl run'):
+        ret = subprocess.call(kargs, start_new_session=True)
     exit(ret)
 
 shell.help = "start an interactive shell for a deployment"
@@ -8,9 +8,7 @@
 # warranty.
 
 
-import json, kubernetes
-from kubernetes.client.apis import core_v1_api, extensions_v1beta1_api
-from sys import stdout, stderr
+from sys import stdout, stderr, exit
 
 import deployment, kubeutil
 
@@ -54,11 +52,9 @@ def status(args):
         else:
             active = ' '
 
-        try:
-            nready = rs['status']['readyReplicas']
-        except KeyError:
+        nready = rs.get('status', {}).get('readyReplicas', 0)
+        if not nready:
             error = '!'
-            nready = 0
 
         errors = []
         try:
@@ -101,106 +97,144 @@ def status(args):
             if 'status' in pod and 'containerStatuses' in pod['status']:
                 for cs in pod['status']['containerStatuses']:
                     if 'waiting' in cs['state']:
-                        try:
-                            message = cs['state']['waiting']['message']
-                        except KeyError:
-                            message = '(no reason)'
+                        message = cs['state']['waiting'].get('message') or '(no reason)'
 
                         stdout.write("          {0}: {1}\n".format(
                             cs['state']['waiting']['reason'],
                             message,
                         ))
 
-    resources = None
     try:
-        resources = json.loads(dp['metadata']['annotations']['kdtool.torchbox.com/attached-resources'])
-    except KeyError:
-        exit(0)
+        resources = deployment.get_attached_resources(dp)
     except ValueError as e:
         stderr.write("warning: could not decode kdtool.torchbox.com/attached-resources annotation: {0}\n".format(str(e)))
         exit(0)
+    except Exception as e:
+        stderr.write("warning: cannot load attached resources: {0}\n".format(
+            kubeutil.get_error(e)))
+        exit(0)
 
+    resources = [ res for res in resources if res['kind'] != 'secret' ]
     if len(resources) == 0:
         exit(0)
 
     stdout.write("\nattached resources:\n")
 
-    client = kubeutil.get_client()
-    v1 = core_v1_api.CoreV1Api(client)
-    extv1beta1 = extensions_v1beta1_api.ExtensionsV1beta1Api(client)
+    for res in resources:
+        if 'error' in res:
+            stdout.write("  {0} {1}: cannot load: {2}\n".format(
+                res['kind'], res['name'], kubeutil.get_error(res['error'])))
+        elif res['kind'] == 'service':
+            print_service(res['object'])
+        elif res['kind'] == 'ingress':
+            print_ingress(res['object'])
+        elif res['kind'] == 'autoscaler':
+            print_autoscaler(res['object'])
+        elif res['kind'] == 'disruptionbudget':
+            print_disruption_budget(res['object'])
+        elif res['kind'] == 'volume':
+            print_volume(res['object'])
+        elif res['kind'] == 'deployment':
+            print_attached_deployment(res['object'])
+        elif res['kind'] == 'database':
+            print_database(res['object'])
+
+# print_service: print an attached Service.
+def print_service(service):
+    stdout.write("  service {0}: selector is ({1})\n".format(
+        service['metadata']['name'],
+        ", ".join([ k+"="+v for k,v in service['spec'].get('selector', {}).items() ]),
+    ))
+    for port in service['spec']['ports']:
+        stdout.write("    port {0}: {1}/{2} -> {3}\n".format(
+            port.get('name'),
+            port['port'],
+            port['protocol'],
+            port.get('targetPort')))
+
+# print_ingress: print an attached Ingress.
+def print_ingress(ingress):
+    stdout.write("  ingress {0}:\n".format(ingress['metadata']['name']))
+    for rule in ingress['spec']['rules']:
+        stdout.write("    http[s]://{0} -> {1}/{2}:{3}\n".format(
+            rule['host'],
+            ingress['metadata']['namespace'],
+            rule['http']['paths'][0]['backend']['serviceName'],
+            rule['http']['paths'][0]['backend']['servicePort'],
+        ))
 
-    services = [resource['name'] for resource in resources if resource['kind'] == 'service']
-    for svc_name in services:
-        service = v1.read_namespaced_service(svc_name, args.namespace)
-        stdout.write("  service {0}: selector is ({1})\n".format(
-            service.metadata.name,
-            ", ".join([ k+"="+v for k,v in service.spec.selector.items() ]),
+# print_autoscaler: print an attached autoscaling/v1 HorizontalPodAutoscaler.
+def print_autoscaler(hpa):
+    hstatus = hpa.get('status', {})
+    stdout.write("  autoscaler {0}: {1}-{2} replicas, {3} current, {4} desired\n".format(
+        hpa['metadata']['name'],
+        hpa['spec'].get('minReplicas', 1),
+        hpa['spec']['maxReplicas'],
+        hstatus.get('currentReplicas', '?'),
+        hstatus.get('desiredReplicas', '?'),
+    ))
+    if 'targetCPUUtilizationPercentage' in hpa['spec']:
+        stdout.write("    cpu: {0}% of request, target {1}%\n".format(
+            hstatus.get('currentCPUUtilizationPercentage', '?'),
+            hpa['spec']['targetCPUUtilizationPercentage'],
         ))
-        for port in service.spec.ports:
-            stdout.write("    port {0}: {1}/{2} -> {3}\n".format(
-                port.name,
-                port.port,
-                port.protocol,
-                port.target_port))
-
-    ingresses = [resource['name'] for resource in resources if resource['kind'] == 'ingress']
-
-    for ing_name in ingresses:
-        ingress = extv1beta1.read_namespaced_ingress(ing_name, args.namespace)
-        stdout.write("  ingress {0}:\n".format(ingress.metadata.name))
-        for rule in ingress.spec.rules:
-            stdout.write("    http[s]://{0} -> {1}/{2}:{3}\n".format(
-                rule.host,
-                ingress.metadata.namespace,
-                rule.http.paths[0].backend.service_name,
-                rule.http.paths[0].backend.service_port,
-            ))
 
-    volumes = [resource['name'] for resource in resources if resource['kind'] == 'volume']
+# print_disruption_budget: print an attached PodDisruptionBudget.
+def print_disruption_budget(pdb):
+    if 'maxUnavailable' in pdb['spec']:
+        limit = 'at most {0} unavailable'.format(pdb['spec']['maxUnavailable'])
+    else:
+        limit = 'at least {0} available'.format(pdb['spec'].get('minAvailable'))
+
+    stdout.write("  disruption budget {0}: {1}, {2} disruptions allowed\n".format(
+        pdb['metadata']['name'],
+        limit,
+        pdb.get('status', {}).get('disruptionsAllowed', '?'),
+    ))
 
-    for vol_name in volumes:
-        volume = v1.read_namespaced_persistent_volume_claim(vol_name, args.namespace)
-        if volume.status:
-            stdout.write("  volume {0}: mode is {1}, size {2}, phase {3}\n".format(
-                volume.metadata.name,
-                ",".join(volume.status.access_modes),
-                volume.status.capacity['storage'],
-                volume.status.phase,
-            ))
-        else:
-            stdout.write("  volume {0} is unknown (not provisioned)\n".format(
-                volume.metadata.name,
-            ))
+# print_volume: print an attached PersistentVolumeClaim.
+def print_volume(volume):
+    vstatus = volume.get('status', {})
+    if 'capacity' in vstatus:
+        stdout.write("  volume {0}: mode is {1}, size {2}, phase {3}\n".format(
+            volume['metadata']['name'],
+            ",".join(vstatus['accessModes']),
+            vstatus['capacity']['storage'],
+            vstatus['phase'],
+        ))
+    else:
+        stdout.write("  volume {0} is unknown (not provisioned)\n".format(
+            volume['metadata']['name'],
+        ))
 
-    databases = [resource['name'] for resource in resources if resource['kind'] == 'database']
-
-    for db_name in databases:
-        resource_path = ('/apis/torchbox.com/v1/namespaces/'
-                        + dp['metadata']['namespace']
-                        + '/databases/'
-                        + db_name)
-
-        header_params = {}
-        header_params['Accept'] = client.select_header_accept(['application/json'])
-        header_params['Content-Type'] = client.select_header_content_type(['*/*'])
-        header_params.update(kubeutil.config.api_key)
-
-        (resp, code, header) = client.call_api(
-                resource_path, 'GET', {}, {}, header_params, None, [], _preload_content=False)
-
-        database = json.loads(resp.data.decode('utf-8'))
-        if 'status' in database:
-            stdout.write("  database {0}: type {1}, phase {2} (on server {3})\n".format(
-                database['metadata']['name'],
-                database['spec']['type'],
-                database['status']['phase'],
-                database['status']['server'],
-            ))
-        else:
-            stdout.write("  database {0}: type {1}, unknown (not provisioned)\n".format(
-                database['metadata']['name'],
-                database['spec']['type'],
-            ))
+# print_attached_deployment: print an attached Deployment, e.g. a shared
+# Redis.
+def print_attached_deployment(dp):
+    stdout.write("  deployment {0}: {1} replicas configured, {2} ready\n".format(
+        dp['metadata']['name'],
+        dp['spec'].get('replicas', 1),
+        dp.get('status', {}).get('readyReplicas', 0),
+    ))
+    for container in dp['spec']['template']['spec']['containers']:
+        stdout.write("    container {0}: image {1}\n".format(
+            container['name'],
+            container['image'],
+        ))
+
+# print_database: print an attached torchbox.com/v1 Database.
+def print_database(database):
+    if 'status' in database:
+        stdout.write("  database {0}: type {1}, phase {2} (on server {3})\n".format(
+            database['metadata']['name'],
+            database['spec']['type'],
+            database['status']['phase'],
+            database['status']['server'],
+        ))
+    else:
+        stdout.write("  database {0}: type {1}, unknown (not provisioned)\n".format(
+            database['metadata']['name'],
+            database['spec']['type'],
+        ))
 
 status.help = "show deployment status"
 status.arguments = (
@@ -0,0 +1,69 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# jsonstream must give the same result as json.loads however the body is
+# split into chunks.
+#
+#   python3 -m unittest discover -s tests
+
+import json, os, sys, unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'bench'))
+
+import fakeapi, jsonstream
+
+FIXTURES = [
+    b'2e3',
+    b'-2500.0',
+    b'0',
+    b'"caf\xc3\xa9 \\u00e9\\n"',
+    b'true',
+    b'null',
+    b'[]',
+    b'{}',
+    b'[1, -2500.0, 2e3, 1.5E-3, true, false, null, "x"]',
+    b'{"x": 2e3}',
+    b'{"a": 1, "b": -0.5, "c": [10, 20E+1], "d": {"e": 300}, "f": "\\"}"}',
+    b'{"items": [{"metadata": {"name": "a"}, "n": 12},'
+        b' {"metadata": {"name": "b"}, "n": 3.25e1}], "count": 42}',
+    b'{"items": [], "metadata": {"resourceVersion": "1"}}',
+]
+
+def list_fixtures():
+    cluster = fakeapi.Cluster(pods=1)
+    return [ cluster.list(res, '', view) for res in ('pods', 'replicasets')
+                                          for view in ('List', 'Table') ]
+
+class TestJSONStream(unittest.TestCase):
+    def check(self, data, chunks):
+        self.assertEqual(jsonstream.load(chunks), json.loads(data.decode('utf-8')))
+
+    # Every fixture split in two at every byte offset.
+    def test_split(self):
+        for data in FIXTURES + list_fixtures():
+            for i in range(len(data) + 1):
+                with self.subTest(data=data[:40], offset=i):
+                    self.check(data, [ data[:i], data[i:] ])
+
+    def test_bytes(self):
+        for data in FIXTURES:
+            with self.subTest(data=data[:40]):
+                self.check(data, [ data[i:i + 1] for i in range(len(data)) ])
+
+    def test_invalid(self):
+        for data in (b'{"x": 2e}', b'[1, 2', b'{"x": 1} 2', b'-'):
+            for i in range(len(data) + 1):
+                with self.subTest(data=data, offset=i):
+                    with self.assertRaises(ValueError):
+                        jsonstream.load([ data[:i], data[i:] ])
+
+if __name__ == '__main__':
+    unittest.main()
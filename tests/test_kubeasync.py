@@ -0,0 +1,103 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# kubeasync's HTTP session against a server which closes keep-alive
+# connections, as an API server or load balancer does when they have been
+# idle for too long.
+#
+#   python3 -m unittest discover -s tests
+
+import asyncio, os, socket, sys, threading, unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import kubeasync
+
+RESPONSE = (b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Content-Length: 2\r\n'
+            b'\r\n'
+            b'{}')
+
+# Server: accepts connections and handles one request on each.  it answers
+# with a keep-alive response and then closes its end, unless respond is
+# False, when it closes the connection without answering.
+class Server(object):
+    def __init__(self, respond=True):
+        self.respond = respond
+        self.requests = []
+        self.connections = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'http://127.0.0.1:{0}'.format(self.sock.getsockname()[1])
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            (conn, addr) = self.sock.accept()
+            self.connections += 1
+            f = conn.makefile('rb')
+            request = f.readline()
+            length = 0
+            while True:
+                line = f.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            f.read(length)
+            self.requests.append(request.split(b' ')[0].decode('ascii'))
+            if self.respond:
+                conn.sendall(RESPONSE)
+            f.close()
+            conn.close()
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def request(self, session, method, body=None):
+        async def run():
+            resp = await session.send(method, '/api/v1/namespaces/default/pods',
+                                      body=body)
+            return (resp.status, await resp.read())
+        return self.loop.run_until_complete(run())
+
+    def test_stale_connection(self):
+        server = Server()
+        session = kubeasync.Session(server.url, None, {})
+
+        self.assertEqual(self.request(session, 'GET'), (200, b'{}'))
+        self.assertEqual(len(session.idle), 1)
+
+        # Let the server close its end of the pooled connection.
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+
+        # Not idempotent, so it would not be retried by the retry policy.
+        self.assertEqual(self.request(session, 'POST', b'{}'), (200, b'{}'))
+        self.assertEqual(server.requests, [ 'GET', 'POST' ])
+        self.assertEqual(server.connections, 2)
+
+    def test_fresh_connection_closed(self):
+        server = Server(respond=False)
+        session = kubeasync.Session(server.url, None, {})
+
+        with self.assertRaises(EOFError):
+            self.request(session, 'POST', b'{}')
+        self.assertEqual(server.requests, [ 'POST' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# vim:set sw=4 ts=4 et:
+#
+# Copyright (c) 2016-2017 Torchbox Ltd.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely. This software is provided 'as-is', without any express or implied
+# warranty.
+
+# Support for --trace: record how long each phase of a command takes (argument
+# parsing, imports, configuration loading, manifest rendering, every API
+# request and every subprocess), print a summary at exit, and optionally write
+# the spans to a file in Chrome trace event format (load it in
+# chrome://tracing or https://ui.perfetto.dev).
+#
+# This module is imported first by __main__.py, so the time it was loaded is
+# close to when the interpreter finished starting.
+
+import json, os, threading, time
+from contextlib import contextmanager
+
+loaded = time.monotonic()
+
+enabled = False
+spans = []
+lock = threading.Lock()
+
+# start: start recording spans.
+def start():
+    global enabled
+    with lock:
+        del spans[:]
+    enabled = True
+
+# add: record a completed span.
+def add(category, name, start, end, **attrs):
+    if not enabled:
+        return
+
+    with lock:
+        spans.append({
+            'category': category,
+            'name': name,
+            'start': start,
+            'duration': end - start,
+            'thread': threading.current_thread().ident,
+            'attrs': attrs,
+        })
+
+# span: a context manager that records a span around its body.  it yields a
+# dict to which the caller can add attributes, such as the response status.
+@contextmanager
+def span(category, name, **attrs):
+    if not enabled:
+        yield attrs
+        return
+
+    start = time.monotonic()
+    try:
+        yield attrs
+    finally:
+        add(category, name, start, time.monotonic(), **attrs)
+
+# summary: write a summary of the recorded spans to out: the total time spent
+# in each category, then every span from slowest to fastest.
+def summary(out, limit=30):
+    with lock:
+        recorded = list(spans)
+
+    if not recorded:
+        return
+
+    categories = {}
+    for s in recorded:
+        (count, total) = categories.get(s['category'], (0, 0))
+        categories[s['category']] = (count + 1, total + s['duration'])
+
+    out.write('\ntrace summary:\n')
+    for (category, (count, total)) in sorted(categories.items(),
+                                             key=lambda c: -c[1][1]):
+        out.write('  {0:<12} {1:>5} span(s) {2:>10.1f} ms\n'.format(
+            category, count, total * 1000))
+
+    out.write('\nslowest spans:\n')
+    for s in sorted(recorded, key=lambda s: -s['duration'])[:limit]:
+        attrs = ' '.join([ '{0}={1}'.format(k, v)
+                            for (k, v) in sorted(s['attrs'].items()) ])
+        out.write('  {0:>10.1f} ms  {1:<12} {2}{3}\n'.format(
+            s['duration'] * 1000, s['category'], s['name'],
+            '  (' + attrs + ')' if attrs else ''))
+
+# write_chrome: write the recorded spans to filename in Chrome trace format.
+def write_chrome(filename):
+    with lock:
+        events = [{
+            'name': s['name'],
+            'cat': s['category'],
+            'ph': 'X',
+            'ts': int((s['start'] - loaded) * 1000000),
+            'dur': int(s['duration'] * 1000000),
+            'pid': os.getpid(),
+            'tid': s['thread'],
+            'args': s['attrs'],
+        } for s in spans]
+
+    with open(filename, 'w') as f:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+# finish: stop recording, print the summary to out and write the trace file
+# if one was requested.
+def finish(out, filename=None):
+    global enabled
+    if not enabled:
+        return
+
+    enabled = False
+    summary(out)
+    if filename:
+        write_chrome(filename)
+        out.write('\ntrace written to {0}\n'.format(filename))
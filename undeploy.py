@@ -7,12 +7,195 @@
 # freely. This software is provided 'as-is', without any express or implied
 # warranty.
 
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sys import stdout, stderr, exit
-from kubernetes.client.apis import core_v1_api, extensions_v1beta1_api
 
 import deployment, kubectl, kubeutil
 
+# How often to poll for deleted resources with --wait.
+WAIT_INTERVAL = 2
+
+# Attached resources which are no use without the deployment, so are always
+# deleted with it.
+DEPENDENT_KINDS = ('autoscaler', 'disruptionbudget')
+
+# is_dependent: return True if an attached resource is always deleted with the
+# deployment: one of DEPENDENT_KINDS, or anything with deployment.DEPENDENT_LABEL,
+# such as a shared Redis.
+def is_dependent(res):
+    if res['kind'] in DEPENDENT_KINDS:
+        return True
+    labels = (res.get('object') or {}).get('metadata', {}).get('labels') or {}
+    return labels.get(deployment.DEPENDENT_LABEL) == 'true'
+
+# delete_path: delete the object at an API path with a DELETE request, for
+# kinds the client has no method for, or whose method doesn't take a body.
+def delete_path(client, resource_path, body):
+    header_params = {}
+    header_params['Accept'] = client.select_header_accept(['application/json'])
+    header_params['Content-Type'] = client.select_header_content_type(['*/*'])
+    header_params.update(kubeutil.get_config().api_key)
+
+    client.call_api(resource_path, 'DELETE', {}, {}, header_params, body, [])
+
+# delete_resource: delete a single resource, identified by an entry from
+# deployment.get_attached_resources (or a 'deployment' entry), with the given
+# propagation policy.
+def delete_resource(namespace, res, propagation):
+    client = kubeutil.get_client()
+    from kubernetes.client.apis import autoscaling_v1_api, core_v1_api, \
+                                       extensions_v1beta1_api, policy_v1beta1_api
+    autoscalingv1 = autoscaling_v1_api.AutoscalingV1Api(client)
+    extv1beta1 = extensions_v1beta1_api.ExtensionsV1beta1Api(client)
+    policyv1beta1 = policy_v1beta1_api.PolicyV1beta1Api(client)
+    v1 = core_v1_api.CoreV1Api(client)
+    body = { 'propagationPolicy': propagation }
+
+    if res['kind'] == 'deployment':
+        extv1beta1.delete_namespaced_deployment(res['name'], namespace, body=body)
+    elif res['kind'] == 'volume':
+        v1.delete_namespaced_persistent_volume_claim(res['name'], namespace, body=body)
+    elif res['kind'] == 'secret':
+        v1.delete_namespaced_secret(res['name'], namespace, body=body)
+    elif res['kind'] == 'service':
+        # delete_namespaced_service doesn't accept DeleteOptions in this
+        # version of the client.
+        delete_path(client, '/api/v1/namespaces/' + namespace
+                            + '/services/' + res['name'], body)
+    elif res['kind'] == 'ingress':
+        extv1beta1.delete_namespaced_ingress(res['name'], namespace, body=body)
+    elif res['kind'] == 'autoscaler':
+        autoscalingv1.delete_namespaced_horizontal_pod_autoscaler(res['name'], namespace, body=body)
+    elif res['kind'] == 'disruptionbudget':
+        policyv1beta1.delete_namespaced_pod_disruption_budget(res['name'], namespace, body=body)
+    elif res['kind'] == 'database':
+        resource_path = ('/apis/torchbox.com/v1/namespaces/'
+                        + namespace
+                        + '/databases/'
+                        + res['name'])
+        delete_path(client, resource_path, body)
+    else:
+        raise ValueError('unknown resource kind "{}"'.format(res['kind']))
+
+# resource_exists: return True if the given resource still exists.
+def resource_exists(namespace, res):
+    client = kubeutil.get_client()
+    from kubernetes.client.apis import autoscaling_v1_api, core_v1_api, \
+                                       extensions_v1beta1_api, policy_v1beta1_api
+    from kubernetes.client.rest import ApiException
+    autoscalingv1 = autoscaling_v1_api.AutoscalingV1Api(client)
+    extv1beta1 = extensions_v1beta1_api.ExtensionsV1beta1Api(client)
+    policyv1beta1 = policy_v1beta1_api.PolicyV1beta1Api(client)
+    v1 = core_v1_api.CoreV1Api(client)
+
+    try:
+        if res['kind'] == 'deployment':
+            extv1beta1.read_namespaced_deployment(res['name'], namespace)
+        elif res['kind'] == 'volume':
+            v1.read_namespaced_persistent_volume_claim(res['name'], namespace)
+        elif res['kind'] == 'secret':
+            v1.read_namespaced_secret(res['name'], namespace)
+        elif res['kind'] == 'service':
+            v1.read_namespaced_service(res['name'], namespace)
+        elif res['kind'] == 'ingress':
+            extv1beta1.read_namespaced_ingress(res['name'], namespace)
+        elif res['kind'] == 'autoscaler':
+            autoscalingv1.read_namespaced_horizontal_pod_autoscaler(res['name'], namespace)
+        elif res['kind'] == 'disruptionbudget':
+            policyv1beta1.read_namespaced_pod_disruption_budget(res['name'], namespace)
+        elif res['kind'] == 'database':
+            resource_path = ('/apis/torchbox.com/v1/namespaces/'
+                            + namespace
+                            + '/databases/'
+                            + res['name'])
+
+            header_params = {}
+            header_params['Accept'] = client.select_header_accept(['application/json'])
+            header_params['Content-Type'] = client.select_header_content_type(['*/*'])
+            header_params.update(kubeutil.get_config().api_key)
+
+            client.call_api(resource_path, 'GET', {}, {}, header_params, None, [])
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+
+    return True
+
+# delete_resources: delete all the given resources concurrently, using at most
+# 'parallel' threads if given.  the request rate is limited by kubeutil's
+# request policy.  progress is written to stdout as each deletion completes.
+# returns the list of resources that could not be deleted.
+def delete_resources(namespace, resources, propagation, parallel=None):
+    failed = []
+
+    if not len(resources):
+        return failed
+
+    deployment.clear_cache()
+
+    with ThreadPoolExecutor(max_workers=parallel or len(resources)) as pool:
+        futures = {
+            pool.submit(delete_resource, namespace, res, propagation): res
+                for res in resources
+        }
+
+        for future in as_completed(futures):
+            res = futures[future]
+            try:
+                future.result()
+                stdout.write('deleted {} <{}/{}>\n'.format(
+                    res['kind'], namespace, res['name']))
+            except Exception as e:
+                # Something that's already gone counts as deleted.
+                if kubeutil.get_status(e) == 404:
+                    stdout.write('deleted {} <{}/{}> (already gone)\n'.format(
+                        res['kind'], namespace, res['name']))
+                    continue
+                stderr.write('cannot delete {} <{}/{}>: {}\n'.format(
+                    res['kind'], namespace, res['name'], kubeutil.get_error(e)))
+                failed.append(res)
+
+    return failed
+
+# wait_deleted: wait until all the given resources, and any pods matching the
+# given label selector, have been removed.  returns False on timeout.
+def wait_deleted(namespace, resources, selector, timeout):
+    client = kubeutil.get_client()
+    from kubernetes.client.apis import core_v1_api
+    v1 = core_v1_api.CoreV1Api(client)
+    label_selector = ",".join([ k+"="+v for k,v in selector.items() ])
+    deadline = time.time() + timeout
+    remaining = list(resources)
+
+    stdout.write('waiting for resources to be deleted...\n')
+
+    while True:
+        with ThreadPoolExecutor(max_workers=len(remaining) or 1) as pool:
+            exists = list(pool.map(
+                lambda res: resource_exists(namespace, res), remaining))
+        remaining = [ res for (res, e) in zip(remaining, exists) if e ]
+
+        npods = 0
+        if label_selector:
+            pods = v1.list_namespaced_pod(namespace, label_selector=label_selector)
+            npods = len(pods.items)
+
+        if not len(remaining) and npods == 0:
+            stdout.write('all resources deleted\n')
+            return True
+
+        if time.time() >= deadline:
+            for res in remaining:
+                stderr.write('still present: {} <{}/{}>\n'.format(
+                    res['kind'], namespace, res['name']))
+            if npods:
+                stderr.write('still present: {} pod(s)\n'.format(npods))
+            return False
+
+        time.sleep(WAIT_INTERVAL)
+
 def undeploy(args):
     try:
         dp = deployment.get_deployment(args.namespace, args.name)
@@ -21,20 +204,26 @@ def undeploy(args):
             args.name, kubeutil.get_error(e)))
         exit(1)
 
-    resources = None
     try:
-        resources = json.loads(dp['metadata']['annotations']['kdtool.torchbox.com/attached-resources'])
-    except KeyError:
-        pass
+        resources = deployment.get_attached_resources(dp)
     except ValueError as e:
         stderr.write("error: could not decode kdtool.torchbox.com/attached-resources annotation: {0}\n".format(str(e)))
         exit(1)
+    except Exception as e:
+        stderr.write('cannot load attached resources: {0}\n'.format(
+            kubeutil.get_error(e)))
+        exit(1)
+
+    dependents = [ res for res in resources if is_dependent(res) ]
+    resources = [ res for res in resources if not is_dependent(res) ]
 
     stdout.write("\nthis deployment will be removed:\n")
     stdout.write("- {0}/{1}\n".format(
         dp['metadata']['namespace'],
         dp['metadata']['name'],
     ))
+    for res in dependents:
+        stdout.write("- {0}: {1}\n".format(res['kind'], res['name']))
 
     if len(resources):
         if args.all:
@@ -67,44 +256,24 @@ def undeploy(args):
             stdout.write("okay, aborting\n")
             exit(0)
 
-    client = kubeutil.get_client()
-    extv1beta1 = extensions_v1beta1_api.ExtensionsV1beta1Api(client)
-    v1 = core_v1_api.CoreV1Api(client)
+    items = [{ 'kind': 'deployment', 'name': args.name }] + dependents
+    if args.all:
+        items.extend(resources)
 
-    stdout.write('deleting deployment <{}/{}>: '.format(args.namespace, args.name))
-    extv1beta1.delete_namespaced_deployment(args.name, args.namespace, body={})
-    stdout.write('ok\n')
+    failed = delete_resources(args.namespace, items, args.propagation)
 
-    if not args.all:
-        exit(0)
+    if args.wait and not failed:
+        # Orphaned pods are left running, so only wait for the objects we
+        # deleted.
+        selector = {}
+        if args.propagation != 'Orphan':
+            selector = dp['spec'].get('selector', {}).get('matchLabels', {})
+        if not wait_deleted(args.namespace, items, selector, args.timeout):
+            stderr.write('timed out waiting for resources to be deleted\n')
+            exit(1)
 
-    for res in resources:
-        stdout.write('deleting {} <{}>: '.format(res['kind'], res['name']))
-        if res['kind'] == 'volume':
-            v1.delete_namespaced_persistent_volume_claim(
-                res['name'], args.namespace, body={})
-        elif res['kind'] == 'secret':
-            v1.delete_namespaced_secret(res['name'], args.namespace, body={})
-        elif res['kind'] == 'database':
-            resource_path = ('/apis/torchbox.com/v1/namespaces/'
-                            + dp['metadata']['namespace']
-                            + '/databases/'
-                            + res['name'])
-
-            header_params = {}
-            header_params['Accept'] = client.select_header_accept(['application/json'])
-            header_params['Content-Type'] = client.select_header_content_type(['*/*'])
-            header_params.update(kubeutil.config.api_key)
+    exit(1 if failed else 0)
 
-            (resp, code, header) = client.call_api(
-                    resource_path, 'DELETE', {}, {}, header_params, None, [], _preload_content=False)
-        elif res['kind'] == 'service':
-            v1.delete_namespaced_service(res['name'], args.namespace)
-        elif res['kind'] == 'ingress':
-            extv1beta1.delete_namespaced_ingress(res['name'], args.namespace, body={})
-
-        stdout.write('ok\n')
-            
 undeploy.help = "undeploy an application"
 undeploy.arguments = (
     ( ('-M', '--manifest'), {
@@ -120,6 +289,22 @@ undeploy.arguments = (
         'action': 'store_true',
         'help': 'undeploy attached resources',
     }),
+    ( ('--propagation',), {
+        'type': str,
+        'choices': ('Foreground', 'Background', 'Orphan'),
+        'default': 'Foreground',
+        'help': 'deletion propagation policy for dependent objects',
+    }),
+    ( ('-w', '--wait'), {
+        'action': 'store_true',
+        'help': 'wait until all resources and pods have been deleted',
+    }),
+    ( ('--timeout',), {
+        'type': int,
+        'default': 300,
+        'metavar': 'SECONDS',
+        'help': 'maximum time to wait for deletion with --wait',
+    }),
     ( ('name',), {
         'type': str,
         'help': 'application name',
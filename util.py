@@ -13,3 +13,57 @@ import re
 def strip_hostname(hostname):
   # Strip https?:// from a hostname so --hostname=<URL> works.
   return re.sub(r"^https?://([^/]*)(/.*)?$", r'\1', hostname)
+
+def parse_size(size):
+  # Convert a human-readable size like "64m" or "1Gi" into bytes.
+  import humanfriendly
+  return humanfriendly.parse_size(size, binary=True)
+
+def parse_range(value):
+  # Parse a range of replicas like "2:10" into a (min, max) tuple, for
+  # argparse.
+  import argparse
+  try:
+    (lo, hi) = [ int(v) for v in value.split(':', 1) ]
+  except ValueError:
+    raise argparse.ArgumentTypeError('expected MIN:MAX, not "{0}"'.format(value))
+  if lo < 1 or hi < lo:
+    raise argparse.ArgumentTypeError('invalid range "{0}"'.format(value))
+  return (lo, hi)
+
+def parse_count(value):
+  # Parse a number of pods like "2", or a percentage of the replicas like
+  # "25%", for argparse.  Returns an int or the percentage string, as the
+  # API expects.
+  import argparse
+  if not re.match(r'^[0-9]+%?$', value):
+    raise argparse.ArgumentTypeError('expected a number or percentage, not "{0}"'.format(value))
+  if value.endswith('%'):
+    return value
+  return int(value)
+
+# Access modes for the mode= option of --volume.
+ACCESS_MODES = {
+  'rwo': 'ReadWriteOnce',
+  'rwx': 'ReadWriteMany',
+}
+
+def parse_volume(value):
+  # Parse a --volume argument like "media:/app/media:size=10Gi,mode=rwo" into
+  # a (name, path, options) tuple, for argparse.
+  import argparse
+  bits = value.split(':', 2)
+  if len(bits) < 2 or not bits[0] or not bits[1]:
+    raise argparse.ArgumentTypeError('expected NAME:PATH[:OPTIONS], not "{0}"'.format(value))
+
+  options = {}
+  for opt in bits[2].split(',') if len(bits) == 3 else []:
+    (k, v) = opt.split('=', 1) if '=' in opt else (opt, '')
+    if k not in ('size', 'class', 'mode') or not v:
+      raise argparse.ArgumentTypeError('invalid volume option "{0}"'.format(opt))
+    if k == 'mode' and v not in ACCESS_MODES:
+      raise argparse.ArgumentTypeError('volume mode must be one of: {0}'.format(
+        ', '.join(sorted(ACCESS_MODES))))
+    options[k] = v
+
+  return (bits[0], bits[1], options)